@@ -0,0 +1,21 @@
+"""
+Token check for the operator endpoints that expose other users' data.
+
+Set ADMIN_TOKEN and send it as `Authorization: Bearer <token>`. Without
+ADMIN_TOKEN the endpoints answer 404, as if they were not there.
+"""
+import os
+import secrets
+from typing import Optional
+from fastapi import Header, HTTPException
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def require_admin(authorization: Optional[str] = Header(default=None)) -> None:
+    """FastAPI dependency: 401 unless the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Admin token required", headers={"WWW-Authenticate": "Bearer"})
@@ -0,0 +1,380 @@
+"""
+Headless chat API for machine clients, bypassing Gradio.
+
+    POST /api/bots/{bot_id}/chat                       one turn, streamed as SSE or NDJSON (or plain JSON)
+    GET  /api/bots/{bot_id}/chat/{request_id}/stream   reattach to a turn and replay it from an offset
+    POST /api/bots/{bot_id}/chat/{request_id}/cancel   stop a running turn
+
+Reattaching and cancelling need the turn's conversation id as well as its
+request id.
+    WS   /api/bots/{bot_id}/chat/ws                    multi-turn session over a WebSocket
+
+Clients send only the new message and a conversation id; the history is kept
+server-side in the shared state (older conversations are loaded from the
+database), so consecutive turns may land on different workers. Turns run
+through the same BaseChat pipeline as the Gradio UI, as server-side
+generations: a client that disconnects mid-answer reattaches with the request
+id and the last offset it received (see generations.py).
+"""
+import os
+import json
+import uuid
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional
+from fastapi import APIRouter, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from .streaming import StreamEvent
+from .generations import Generation, generations
+from .scheduler import busy_message, scheduler
+from ..persistence import message_writer
+from ..shared_state import shared_state
+from ..repository import MAX_RESTORED_MESSAGES, conversations, valid_conversation_id
+
+# Server-side history of an API conversation expires after this many idle seconds
+API_SESSION_TTL = int(os.getenv("API_SESSION_TTL", "3600"))
+# Upper bound on one turn; a conversation locked by a worker that died is freed after this long
+API_TURN_LEASE = int(os.getenv("API_TURN_LEASE", "600"))
+
+
+class ChatRequest(BaseModel):
+    message: str
+    conversation_id: Optional[str] = None
+    stream: bool = True
+    # "sse" or "ndjson"; defaults from the Accept header, SSE otherwise
+    format: Optional[str] = None
+
+
+class ConversationSession:
+    def __init__(self, conversation_id: str, bot_id: str, history: List[Dict], seq_offset: int):
+        self.conversation_id = conversation_id
+        self.bot_id = bot_id
+        self.history = history
+        self.seq_offset = seq_offset
+
+    def append(self, message: str, response: str) -> None:
+        self.history = self.history + [{"role": "user", "content": message}, {"role": "assistant", "content": response}]
+        overflow = len(self.history) - MAX_RESTORED_MESSAGES
+        if overflow > 0:
+            # Drop whole turns so the history still starts with a user message
+            overflow += overflow % 2
+            self.history = self.history[overflow:]
+            self.seq_offset += overflow
+
+    def to_json(self) -> str:
+        return json.dumps({"bot_id": self.bot_id, "history": self.history, "seq_offset": self.seq_offset})
+
+    @classmethod
+    def from_json(cls, conversation_id: str, data: str) -> "ConversationSession":
+        fields = json.loads(data)
+        return cls(conversation_id, fields["bot_id"], fields["history"], fields["seq_offset"])
+
+
+class SessionStore:
+    """
+    Server-side history of API conversations, kept in the shared state so any
+    worker can serve the next turn of a conversation.
+    """
+
+    async def get(self, bot_id: str, conversation_id: Optional[str]) -> ConversationSession:
+        if not conversation_id:
+            return ConversationSession(str(uuid.uuid4()), bot_id, [], 0)
+        if not valid_conversation_id(conversation_id):
+            raise HTTPException(status_code=400, detail="conversation_id must be a UUID")
+
+        stored = await shared_state.get("api_session", conversation_id)
+        if stored is None:
+            return await self._load(bot_id, conversation_id)
+
+        session = ConversationSession.from_json(conversation_id, stored)
+        if session.bot_id != bot_id:
+            raise HTTPException(status_code=400, detail="Conversation belongs to another bot")
+        return session
+
+    async def save(self, session: ConversationSession) -> None:
+        await shared_state.set("api_session", session.conversation_id, session.to_json(), ttl=API_SESSION_TTL)
+
+    async def begin_turn(self, bot_id: str, conversation_id: Optional[str], request_id: str) -> Optional[ConversationSession]:
+        """
+        Claim a conversation for a turn and load its history.
+
+        The history is read only once the claim is held, so it includes the
+        turn that held the conversation before; read earlier, it could miss
+        that turn and the new one would reuse its seq numbers.
+
+        Returns:
+            The session, or None if another turn of it is running on any worker
+        """
+        if not conversation_id:
+            conversation_id, new = str(uuid.uuid4()), True
+        elif not valid_conversation_id(conversation_id):
+            raise HTTPException(status_code=400, detail="conversation_id must be a UUID")
+        else:
+            new = False
+
+        if not await shared_state.add("api_turn", conversation_id, request_id, ttl=API_TURN_LEASE):
+            return None
+        try:
+            session = ConversationSession(conversation_id, bot_id, [], 0) if new else await self.get(bot_id, conversation_id)
+            await shared_state.set("api_request", request_id, conversation_id, ttl=API_TURN_LEASE)
+        except BaseException:
+            await shared_state.delete("api_turn", conversation_id)
+            raise
+        return session
+
+    async def end_turn(self, session: ConversationSession, request_id: str) -> None:
+        await shared_state.delete("api_turn", session.conversation_id)
+        await shared_state.delete("api_request", request_id)
+
+    async def _load(self, bot_id: str, conversation_id: str) -> ConversationSession:
+        # Earlier turns may still sit in the write-behind queue
+        await message_writer.flush()
+        try:
+            conversation = await conversations.get_conversation(conversation_id)
+            messages = await conversations.load_history(conversation_id) if conversation else []
+        except Exception as e:
+            print(f"Error loading conversation {conversation_id}: {str(e)}")
+            conversation, messages = None, []
+
+        if conversation is not None and conversation.bot_id != bot_id:
+            raise HTTPException(status_code=400, detail="Conversation belongs to another bot")
+
+        history = [{"role": m["role"], "content": m["content"]} for m in messages]
+        return ConversationSession(conversation_id, bot_id, history, messages[0]["seq"] if messages else 0)
+
+
+def event_payload(event: StreamEvent) -> Dict:
+    payload = {"type": event.kind, "text": event.text}
+    if event.retry_after is not None:
+        payload["retry_after"] = event.retry_after
+    return payload
+
+
+def format_sse(payload: Dict) -> str:
+    # The offset is the event id, so an EventSource reconnecting sends it back as Last-Event-ID
+    event_id = f"id: {payload['offset']}\n" if "offset" in payload else ""
+    return f"{event_id}event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+
+
+def format_ndjson(payload: Dict) -> str:
+    return json.dumps(payload) + "\n"
+
+
+class ChatAPI:
+    def __init__(self, bot_loader):
+        self.bot_loader = bot_loader
+        self.sessions = SessionStore()
+        # Cancellations posted to another worker are forwarded to the one running the turn
+        shared_state.subscribe("api_cancel", lambda message: self.cancel(message["request_id"]))
+
+    def get_chat(self, bot_id: str):
+        if bot_id not in self.bot_loader.bots:
+            raise HTTPException(status_code=404, detail=f"Unknown bot: {bot_id}")
+        return self.bot_loader.get_chat(bot_id)
+
+    def start_turn(self, chat, session: ConversationSession, message: str, request_id: str) -> Generation:
+        """Start a turn as a generation addressed by the request id; it runs whether or not a client is attached."""
+        # The answer as saved to the database, if the turn got that far
+        saved: List[str] = []
+        events = chat.stream(
+            message, session.history,
+            conversation_id=session.conversation_id, seq_offset=session.seq_offset, on_saved=saved.append,
+        )
+        return generations.start(
+            chat.bot_id, events, request_id,
+            conversation_id=session.conversation_id,
+            message=message,
+            seq=session.seq_offset + len(session.history),
+            on_finish=lambda generation: self._finish_turn(session, generation, saved),
+        )
+
+    async def deliver(self, generation: Generation, offset: int = 0) -> AsyncGenerator[Dict, None]:
+        """Payloads of a turn from `offset`: start, status/delta/replace events, then done."""
+        yield {"type": "start", "conversation_id": generation.conversation_id, "request_id": generation.id, "offset": offset}
+        async for offset, event in generation.attach(offset):
+            yield {**event_payload(event), "offset": offset}
+        yield {"type": "done", "status": generation.status, "response": generation.text, "offset": generation.end}
+
+    async def _finish_turn(self, session: ConversationSession, generation: Generation, saved: List[str]) -> None:
+        try:
+            if saved:
+                # A turn saved to the database, cancelled or not, stays in the history (and the
+                # seq numbering); one cancelled before it got that far is left out of both
+                session.append(generation.message, saved[-1] or "(cancelled)")
+                await self.sessions.save(session)
+        finally:
+            await self.sessions.end_turn(session, generation.id)
+
+    def cancel(self, request_id: str) -> bool:
+        return generations.cancel(request_id)
+
+    async def cancel_anywhere(self, request_id: str, conversation_id: Optional[str]) -> bool:
+        """Cancel a turn of `conversation_id` running on this or any other worker."""
+        generation = generations.get(request_id)
+        if generation is not None and generation.conversation_id == conversation_id:
+            return self.cancel(request_id)
+        if not conversation_id or await shared_state.get("api_request", request_id) != conversation_id:
+            return False
+        await shared_state.publish("api_cancel", {"request_id": request_id})
+        return True
+
+
+def stream_response(payloads: AsyncIterator[Dict], output_format: Optional[str], request: Request) -> StreamingResponse:
+    output_format = output_format or ("ndjson" if "ndjson" in request.headers.get("accept", "") else "sse")
+    if output_format == "ndjson":
+        formatter, media_type = format_ndjson, "application/x-ndjson"
+    else:
+        formatter, media_type = format_sse, "text/event-stream"
+
+    async def body_iterator():
+        # Starlette cancels this generator when the client disconnects, which detaches it
+        # from the generation; the answer keeps running for the detach grace period
+        async for payload in payloads:
+            yield formatter(payload)
+
+    return StreamingResponse(
+        body_iterator(),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def create_chat_router(bot_loader) -> APIRouter:
+    router = APIRouter()
+    api = ChatAPI(bot_loader)
+
+    @router.post("/api/bots/{bot_id}/chat")
+    async def chat(bot_id: str, body: ChatRequest, request: Request):
+        if not body.message.strip():
+            raise HTTPException(status_code=400, detail="Empty message")
+        chat = api.get_chat(bot_id)
+
+        # Turn the request away before streaming when the bot's queue is already full
+        retry_after = scheduler.would_reject(bot_id, chat.admission_settings)
+        if retry_after is not None:
+            return JSONResponse(
+                {"error": "busy", "message": busy_message(retry_after), "retry_after": retry_after},
+                status_code=429,
+                headers={"Retry-After": str(retry_after)},
+            )
+
+        request_id = uuid.uuid4().hex
+        session = await api.sessions.begin_turn(bot_id, body.conversation_id, request_id)
+        if session is None:
+            raise HTTPException(status_code=409, detail="A turn is already running in this conversation")
+        turn = api.deliver(api.start_turn(chat, session, body.message, request_id))
+
+        if not body.stream:
+            result = {}
+            async for payload in turn:
+                if payload["type"] in ("start", "done"):
+                    result.update({key: value for key, value in payload.items() if key != "type"})
+                elif payload.get("retry_after") is not None:
+                    result["retry_after"] = payload["retry_after"]
+            return result
+
+        return stream_response(turn, body.format, request)
+
+    @router.get("/api/bots/{bot_id}/chat/{request_id}/stream")
+    async def reattach(bot_id: str, request_id: str, conversation_id: str, request: Request,
+                       offset: Optional[int] = None, format: Optional[str] = None):
+        generation = generations.get(request_id)
+        if generation is None or generation.bot_id != bot_id or generation.conversation_id != conversation_id:
+            # Unknown, expired, running on another worker, or not a turn of this conversation
+            raise HTTPException(status_code=404, detail="No generation with this id")
+        if offset is None:
+            offset = int(request.headers.get("last-event-id") or 0)
+        return stream_response(api.deliver(generation, offset), format, request)
+
+    @router.post("/api/bots/{bot_id}/chat/{request_id}/cancel")
+    async def cancel(bot_id: str, request_id: str, conversation_id: str):
+        if not await api.cancel_anywhere(request_id, conversation_id):
+            raise HTTPException(status_code=404, detail="No running turn with this id")
+        return {"cancelled": request_id}
+
+    @router.websocket("/api/bots/{bot_id}/chat/ws")
+    async def chat_socket(websocket: WebSocket, bot_id: str):
+        """
+        Multi-turn session. The client sends {"type": "message", "message": ...}
+        (optionally with "conversation_id" on the first one) and {"type": "cancel"};
+        the server answers with the same payloads as the SSE stream.
+        """
+        await websocket.accept()
+        try:
+            chat = api.get_chat(bot_id)
+        except HTTPException as e:
+            await websocket.close(code=4404, reason=e.detail)
+            return
+
+        conversation_id = websocket.query_params.get("conversation_id")
+        turn_task: Optional[asyncio.Task] = None
+        request_id: Optional[str] = None
+
+        async def send_turn(generation: Generation, offset: int = 0) -> None:
+            async for payload in api.deliver(generation, offset):
+                await websocket.send_json(payload)
+
+        try:
+            while True:
+                try:
+                    data = await websocket.receive_json()
+                except ValueError:
+                    # Not JSON; the socket itself is fine, so keep the session
+                    await websocket.send_json({"type": "error", "error": "Invalid JSON"})
+                    continue
+                if not isinstance(data, dict):
+                    await websocket.send_json({"type": "error", "error": "Expected a JSON object"})
+                    continue
+                kind = data.get("type", "message")
+                if kind == "cancel":
+                    if request_id:
+                        await api.cancel_anywhere(request_id, conversation_id)
+                    continue
+                if kind not in ("message", "resume"):
+                    await websocket.send_json({"type": "error", "error": f"Unknown message type: {kind}"})
+                    continue
+                if turn_task is not None and not turn_task.done():
+                    await websocket.send_json({"type": "error", "error": "A turn is already running"})
+                    continue
+                if kind == "resume":
+                    # Reattach after a dropped connection:
+                    # {"type": "resume", "request_id": ..., "conversation_id": ..., "offset": ...}
+                    generation = generations.get(data.get("request_id"))
+                    if (generation is None or generation.bot_id != bot_id
+                            or generation.conversation_id != (data.get("conversation_id") or conversation_id)):
+                        await websocket.send_json({"type": "error", "error": "No generation with this id"})
+                        continue
+                    request_id = generation.id
+                    conversation_id = generation.conversation_id
+                    turn_task = asyncio.create_task(send_turn(generation, int(data.get("offset") or 0)))
+                    continue
+
+                message = (data.get("message") or "").strip()
+                if not message:
+                    await websocket.send_json({"type": "error", "error": "Empty message"})
+                    continue
+                retry_after = scheduler.would_reject(bot_id, chat.admission_settings)
+                if retry_after is not None:
+                    await websocket.send_json({"type": "error", "error": "busy", "retry_after": retry_after})
+                    continue
+
+                request_id = uuid.uuid4().hex
+                try:
+                    session = await api.sessions.begin_turn(bot_id, data.get("conversation_id") or conversation_id, request_id)
+                except HTTPException as e:
+                    await websocket.send_json({"type": "error", "error": e.detail})
+                    continue
+                if session is None:
+                    await websocket.send_json({"type": "error", "error": "A turn is already running in this conversation"})
+                    continue
+                conversation_id = session.conversation_id
+                turn_task = asyncio.create_task(send_turn(api.start_turn(chat, session, message, request_id)))
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # Stops the delivery only; the generation runs on for its detach grace period
+            if turn_task is not None and not turn_task.done():
+                turn_task.cancel()
+                await asyncio.gather(turn_task, return_exceptions=True)
+
+    return router
@@ -1,15 +1,55 @@
 import os
+import asyncio
 from dotenv import load_dotenv
-from anthropic import AnthropicBedrock
-from typing import List, Dict, AsyncGenerator
+from typing import List, Dict, AsyncGenerator, Callable, Optional
 import time
-import asyncio
-import threading
-from ..database import async_session
-from ..models import ChatMessage
+from contextlib import aclosing
+from dataclasses import dataclass
+from ..persistence import message_writer
+from .history import HistorySettings, HistoryWindow
+from .cache import ResponseCache
+from .streaming import StreamEvent, StreamSettings, StreamStats, coalesce
+from .client_pool import client_pool
+from ..metrics import (
+    ERRORS, FALLBACKS, GENERATION_TIME, INPUT_TOKENS, INTER_TOKEN_GAP, METRICS_ENABLED, OUTPUT_TOKENS,
+    PROMPT_BUILD_TIME, SAVE_MESSAGE_TIME, TIME_TO_FIRST_TOKEN, ESCALATIONS, ROUTED_TTFT, ROUTED_TURNS, start_trace,
+    CANCELLED_TOKENS_SAVED, CANCELLED_TURNS,
+)
+from ..tokens import estimate_tokens
+from .scheduler import AdmissionRejected, AdmissionSettings, busy_message, is_throttling_error, scheduler
+from .routing import ModelRouter, ModelTier, RouteDecision, log_decision
+from .hedging import Hedger
+
+# How often the queue position is refreshed while waiting for admission
+QUEUE_STATUS_INTERVAL = 1.0
+
+# max_tokens of every call when the bot has no routing tiers
+DEFAULT_MAX_TOKENS = 2048
+
+# Weight of the newest answer in the running mean answer length
+ANSWER_TOKENS_DECAY = 0.1
+
+
+@dataclass(frozen=True)
+class PromptVersion:
+    system_prompt: str = None
+    knowledge_prompt: str = None
+    hash: str = None
 
 class BaseChat:
-    def __init__(self, system_prompt: str = None):
+    def __init__(
+        self,
+        system_prompt: str = None,
+        retriever=None,
+        knowledge_prompt: str = None,
+        bot_id: str = None,
+        history_settings: HistorySettings = None,
+        response_cache: ResponseCache = None,
+        stream_settings: StreamSettings = None,
+        admission_settings: AdmissionSettings = None,
+        router: ModelRouter = None,
+        hedger: Hedger = None,
+    ):
         if not os.getenv("AWS_BEDROCK_ACCESS_KEY"):
             load_dotenv()
             
@@ -21,15 +61,44 @@ class BaseChat:
         self.model_base = os.getenv("AWS_BEDROCK_MODEL_BASE", "anthropic.claude-3-7-sonnet-20240229-v1:0")
         
         # Generate full model ID
-        if self.model_base.startswith(f"{self.region_prefix}."):
-            self.model_id = self.model_base
-        else:
-            self.model_id = f"{self.region_prefix}.{self.model_base}"
+        self.model_id = self._model_id(self.model_base)
         
         print(f"Using model ID: {self.model_id}")
         
-        self.system_prompt = system_prompt
+        self.bot_id = bot_id
+        # With a retriever, only the chunks relevant to each turn are appended to the
+        # system prompt; knowledge_prompt (base prompt + full knowledge) is the fallback
+        self.retriever = retriever
+        self.prompt = PromptVersion(system_prompt, knowledge_prompt)
+        self.history_window = HistoryWindow(history_settings)
+        self.response_cache = response_cache
+        self.stream_settings = stream_settings or StreamSettings()
+        self.admission_settings = admission_settings or AdmissionSettings()
+        # Picks the model tier and max_tokens per turn; None sends every turn to model_id
+        self.router = router
+        # Races a second call against a region or prefix when the first token is late
+        self.hedger = hedger
+        # Running mean of answer lengths, to estimate what a cancelled turn would have generated
+        self.mean_answer_tokens: Optional[float] = None
         self.client = None
+
+    def _model_id(self, model_base: str) -> str:
+        if model_base.startswith(f"{self.region_prefix}."):
+            return model_base
+        return f"{self.region_prefix}.{model_base}"
+
+    @property
+    def system_prompt(self) -> str:
+        return self.prompt.system_prompt
+
+    @property
+    def knowledge_prompt(self) -> str:
+        return self.prompt.knowledge_prompt
+
+    def set_prompt(self, prompt: PromptVersion) -> None:
+        # One assignment: each turn reads self.prompt once, so a turn in flight
+        # finishes on the version it started with
+        self.prompt = prompt
     
     def format_messages(self, message: str, history: List[Dict] = None) -> List[Dict]:
         formatted_messages = []
@@ -45,200 +114,439 @@ class BaseChat:
         formatted_messages.append({"role": "user", "content": message})
         return formatted_messages
 
-    async def save_message(self, role: str, content: str) -> None:
+    async def build_system_prompt(self, message: str, prompt: PromptVersion = None) -> str:
+        prompt = prompt or self.prompt
+        if self.retriever is None:
+            return prompt.system_prompt
+
         try:
-            async with async_session() as session:
-                msg = ChatMessage(role=role, content=content)
-                session.add(msg)
-                await session.commit()
+            chunks = await self.retriever.retrieve(message)
         except Exception as e:
-            print(f"Error saving {role} message to database: {str(e)}")
+            print(f"Error retrieving knowledge: {str(e)}")
+            chunks = []
+
+        if not chunks:
+            # Nothing ingested yet or the vector store is unavailable
+            return prompt.knowledge_prompt or prompt.system_prompt
+
+        return (prompt.system_prompt or "") + self.retriever.format_context(chunks)
+
+    async def save_message(self, role: str, content: str, conversation_id: str = None, seq: int = None, status: str = None) -> None:
+        # Write-behind: the row is queued and committed in a batch later
+        row = {"role": role, "content": content, "bot_id": self.bot_id, "conversation_id": conversation_id, "seq": seq, "status": status}
+        with SAVE_MESSAGE_TIME.time(self.bot_id):
+            if not await message_writer.submit(row):
+                print(f"Dropped {role} message: write queue is full")
     
     def get_client(self):
         if self.client is None:
-            # Use AnthropicBedrock client
-            self.client = AnthropicBedrock(
-                aws_access_key=self.aws_access_key,
-                aws_secret_key=self.aws_secret_key,
-                aws_region=self.aws_region
-            )
+            # Async client from the process-wide pool, so all bots share warm connections
+            self.client = client_pool.get_client(self.aws_region)
         return self.client
 
-    async def get_response(self, message: str, history: List[Dict] = None) -> AsyncGenerator[str, None]:
+    def _request_params(self, system_prompt: str, formatted_messages: List[Dict], tier: ModelTier = None) -> Dict:
+        return {
+            "model": self._model_id(tier.model) if tier and tier.model else self.model_id,
+            "max_tokens": tier.max_tokens if tier else DEFAULT_MAX_TOKENS,
+            "temperature": 0.7,
+            "top_p": 0.999,
+            "top_k": 250,
+            "system": system_prompt if system_prompt else None,
+            "messages": formatted_messages,
+        }
+
+    @staticmethod
+    def _chunk_text(chunk) -> str:
+        # Extract text from chunk
+        if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
+            return chunk.delta.text or ""
+        elif hasattr(chunk, 'delta') and hasattr(chunk.delta, 'content'):
+            return chunk.delta.content or ""
+        return ""
+
+    async def _stream_text(self, client, params: Dict, usage: Dict = None) -> AsyncGenerator[str, None]:
+        stream = await client.messages.create(**params, stream=True)
+        async with stream:
+            async for chunk in stream:
+                text = self._chunk_text(chunk)
+                if text:
+                    yield text
+                else:
+                    self._count_tokens(chunk, usage)
+
+    async def _hedge_stream(self, client, params: Dict, usage: Dict = None) -> AsyncGenerator[str, None]:
+        # The hedge is an extra model call and holds its own pool slot
+        async with client_pool.slot():
+            async with aclosing(self._stream_text(client, params, usage)) as text_stream:
+                async for text in text_stream:
+                    yield text
+
+    def _open_stream(self, client, params: Dict, usage: Dict = None, hedger: Hedger = None) -> AsyncGenerator[str, None]:
+        if hedger is None:
+            return self._stream_text(client, params, usage)
+        return self._hedged_stream(hedger, client, params, usage)
+
+    async def _hedged_stream(self, hedger: Hedger, client, params: Dict, usage: Dict = None) -> AsyncGenerator[str, None]:
+        hedge_client = client_pool.get_client(hedger.settings.region) if hedger.settings.region else client
+        hedge_params = hedger.hedge_params(params, self.region_prefix)
+        # Each call counts its own tokens; only the one whose answer is used goes into the
+        # turn's usage, so the loser's tokens and stop reason do not skew routing and escalation
+        calls = {"primary": {}, "hedge": {}}
+        winner = []
+        stream = hedger.stream(
+            lambda: self._stream_text(client, params, calls["primary"]),
+            lambda: self._hedge_stream(hedge_client, hedge_params, calls["hedge"]),
+            on_winner=winner.append,
+        )
+        try:
+            async with aclosing(stream):
+                async for text in stream:
+                    yield text
+        finally:
+            if usage is not None:
+                for key, value in calls[winner[0] if winner else "primary"].items():
+                    usage[key] = value if key == "stop_reason" else usage.get(key, 0) + value
+
+    def _count_tokens(self, event, usage: Dict = None) -> None:
+        # Token usage arrives on the message_start (prompt) and message_delta (answer) events,
+        # the stop reason on message_delta
+        kind = getattr(event, "type", None)
+        if kind == "message_start":
+            INPUT_TOKENS.inc(self.bot_id, amount=event.message.usage.input_tokens)
+            if usage is not None:
+                usage["input"] = usage.get("input", 0) + event.message.usage.input_tokens
+        elif kind == "message_delta":
+            OUTPUT_TOKENS.inc(self.bot_id, amount=event.usage.output_tokens)
+            if usage is not None:
+                usage["output"] = usage.get("output", 0) + event.usage.output_tokens
+                usage["stop_reason"] = event.delta.stop_reason
+
+    def _continuation_params(self, system_prompt: str, formatted_messages: List[Dict], tier: ModelTier, partial: str) -> Dict:
+        """Params for a higher tier to continue `partial`, passed as a prefill of its answer."""
+        messages = formatted_messages
+        # The API rejects a final assistant turn that ends in whitespace
+        prefill = partial.rstrip()
+        if prefill:
+            messages = formatted_messages + [{"role": "assistant", "content": prefill}]
+        return self._request_params(system_prompt, messages, tier)
+
+    def _log_route(self, router: ModelRouter, decision: RouteDecision, tier_usage: Dict, ttft: Optional[float], started: float) -> None:
+        usage = {tier: {"input": tokens.get("input", 0), "output": tokens.get("output", 0)} for tier, tokens in tier_usage.items()}
+        log_decision(router, decision, usage, ttft, time.perf_counter() - started)
+
+    def _record_answer(self, answer: str) -> None:
+        tokens = estimate_tokens(answer)
+        if self.mean_answer_tokens is None:
+            self.mean_answer_tokens = float(tokens)
+        else:
+            self.mean_answer_tokens += ANSWER_TOKENS_DECAY * (tokens - self.mean_answer_tokens)
+
+    def _unspent_tokens(self, partial: str, params: Optional[Dict]) -> int:
+        """Estimated answer tokens a cancelled turn did not generate."""
+        expected = self.mean_answer_tokens
+        if expected is None:
+            expected = params["max_tokens"] if params else DEFAULT_MAX_TOKENS
+        return max(0, round(expected) - estimate_tokens(partial))
+
+    async def _create_response(self, client, params: Dict, tokens: Dict = None) -> str:
+        response = await client.messages.create(**params)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            INPUT_TOKENS.inc(self.bot_id, amount=usage.input_tokens)
+            OUTPUT_TOKENS.inc(self.bot_id, amount=usage.output_tokens)
+            if tokens is not None:
+                tokens["input"] = tokens.get("input", 0) + usage.input_tokens
+                tokens["output"] = tokens.get("output", 0) + usage.output_tokens
+        content = ""
+        if hasattr(response, 'content'):
+            if isinstance(response.content, list):
+                for block in response.content:
+                    if hasattr(block, 'text'):
+                        content += block.text
+                    elif isinstance(block, dict) and 'text' in block:
+                        content += block['text']
+            else:
+                content = response.content
+        return content
+
+    async def stream_events(
+        self,
+        message: str,
+        history: List[Dict] = None,
+        conversation_id: str = None,
+        seq_offset: int = 0,
+        on_saved: Callable[[str], None] = None,
+    ) -> AsyncGenerator[StreamEvent, None]:
         if not message or message.strip() == "":
-            yield "Please enter a message."
+            yield StreamEvent("replace", "Please enter a message.")
             return
-            
+        
+        # Sequence numbers follow the message's position in the conversation; seq_offset is
+        # the seq of history[0] when the history was restored from the middle of a conversation
+        user_seq = seq_offset + (len(history) if history else 0)
+        
+        # The turn is written once, when it is over: the question and the answer together
+        begun = saved = False
+
+        async def save_turn(content: str, status: str = None) -> None:
+            nonlocal saved
+            saved = True
+            await self.save_message("user", message, conversation_id, user_seq)
+            await self.save_message("assistant", content, conversation_id, user_seq + 1, status)
+            if on_saved is not None:
+                on_saved(content)
+        
+        # A reload swaps these; the turn keeps the ones it started with
+        prompt = self.prompt
+        response_cache = self.response_cache
+        hedger = self.hedger
+        trace = start_trace("chat_turn", bot=self.bot_id, prompt=prompt.hash)
+        timing = METRICS_ENABLED or self.router is not None
+        started = time.perf_counter() if timing else 0.0
+        # How far the turn got, for cancellation: preparing, queued, streaming
+        stage = "preparing"
+        full_response = ""
+        params = None
+        
         try:
+            # Example prompts and repeated questions are answered from the cache
+            if response_cache is not None:
+                with trace.span("cache_lookup"):
+                    cached = await response_cache.lookup(message, history, prompt.system_prompt)
+                if cached is not None:
+                    trace.finish(outcome="cache_hit")
+                    begun = True
+                    stage = "streaming"
+                    async for piece in response_cache.replay(cached):
+                        full_response += piece
+                        yield StreamEvent("delta", piece)
+                    await save_turn(cached)
+                    return
+            
             formatted_messages = self.format_messages(message, history)
-            await self.save_message("user", message)
+            begun = True
             
-            # Pre-warm the client connection
-            client = self.get_client()
-
-            print(f"[STREAM_DEBUG] Starting response streaming at {time.time()}")
+            # Send recent turns verbatim and fold older ones into a running summary
+            window = self.history_window.apply(formatted_messages[:-1], conversation_id)
+            formatted_messages = window.messages + formatted_messages[-1:]
+            if window.saved_tokens:
+                print(f"History window for {self.bot_id}: kept {len(window.messages)} messages, "
+                      f"saved ~{window.saved_tokens} of {window.full_tokens} tokens")
             
-            # Create a thread-safe queue for passing chunks between threads
-            chunk_queue = asyncio.Queue()
+            with trace.span("prompt_build"), PROMPT_BUILD_TIME.time(self.bot_id):
+                system_prompt = await self.build_system_prompt(message, prompt)
+            if window.summary:
+                system_prompt = (system_prompt or "") + HistoryWindow.format_summary(window.summary)
             
-            # Add a flag specifically for first chunk
-            first_chunk_received = [False]
-            streaming_done = [False]
-            streaming_error = [None]
+            # Pick the model tier for this turn; tokens are counted per tier for the routing log
+            decision = None
+            tier_usage: Dict[str, Dict] = {}
+            router = self.router
+            if router is not None:
+                decision = router.route(message, history)
+                ROUTED_TURNS.inc(self.bot_id, decision.tier.name, decision.reason)
+                trace.mark(f"routed_{decision.tier.name}")
+            routed = decision
+            ttft = None
+            params = self._request_params(system_prompt, formatted_messages, decision.tier if decision else None)
             
-            # Function to run in a separate thread
-            def stream_in_thread():
-                thread_loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(thread_loop)
-                
-                try:
-                    # Initialize stream with a lower temperature for faster first response
-                    stream = client.messages.create(
-                        model=self.model_id,
-                        max_tokens=2048,
-                        temperature=0.7,
-                        top_p=0.999,
-                        top_k=250,
-                        system=self.system_prompt if self.system_prompt else None,
-                        messages=formatted_messages,
-                        stream=True
-                    )
-                    
-                    # Process each chunk
-                    for chunk in stream:
-                        text = ""
-                        
-                        # Extract text from chunk
-                        if hasattr(chunk, 'delta') and hasattr(chunk.delta, 'text'):
-                            text = chunk.delta.text or ""
-                        elif hasattr(chunk, 'delta') and hasattr(chunk.delta, 'content'):
-                            text = chunk.delta.content or ""
-                        
-                        if text:
-                            # Signal first chunk received
-                            if not first_chunk_received[0]:
-                                first_chunk_received[0] = True
-                                
-                            # Put the chunk in the queue using the thread's event loop
-                            thread_loop.run_until_complete(chunk_queue.put(text))
-                            
-                except Exception as e:
-                    print(f"Error in streaming thread: {str(e)}")
-                    streaming_error[0] = str(e)
-                finally:
-                    streaming_done[0] = True
-                    thread_loop.run_until_complete(chunk_queue.put(None))
-                    thread_loop.close()
-            
-            # Start the streaming thread with higher priority
-            stream_thread = threading.Thread(target=stream_in_thread)
-            stream_thread.daemon = True
-            stream_thread.start()
+            client = self.get_client()
             
-            # Process chunks from the queue with optimized first-chunk handling
-            full_response = ""
-            waiting_time = 0
+            streaming_error = None
             
-            print(f"[STREAM_DEBUG] Sending 'Thinking...' message at {time.time()}")
             # Yield an immediate acknowledgment to reduce perceived delay
-            yield "Thinking..."
-            await asyncio.sleep(0.1)  # Force flush
+            yield StreamEvent("status", "Thinking...")
             
-            while True:
-                # Check for errors first
-                if streaming_error[0]:
-                    error_msg = f"Streaming error: {streaming_error[0]}"
-                    await self.save_message("assistant", error_msg)
-                    yield error_msg
-                    return
+            # Wait for admission; a full queue is turned away at once with a retry estimate
+            stage = "queued"
+            try:
+                ticket = scheduler.enqueue(self.bot_id or "default", self.admission_settings)
+            except AdmissionRejected as e:
+                print(f"Rejected turn for {self.bot_id}: {str(e)}")
+                ERRORS.inc(self.bot_id, "rejected")
+                trace.finish(outcome="rejected")
+                busy = busy_message(e.retry_after)
+                await save_turn(busy)
+                yield StreamEvent("replace", busy, retry_after=e.retry_after)
+                return
+            
+            try:
+                position = 0
+                with trace.span("admission"):
+                    while not await ticket.wait(QUEUE_STATUS_INTERVAL):
+                        if ticket.position != position:
+                            position = ticket.position
+                            yield StreamEvent("status", f"Waiting for a free slot... (position {position} in line)")
+                if position:
+                    yield StreamEvent("status", "Thinking...")
                 
-                try:
-                    # Use a shorter timeout for the first chunk
-                    timeout = 0.2 if not first_chunk_received[0] else 0.5
-                    
-                    # Get chunk with the dynamic timeout
-                    chunk = await asyncio.wait_for(chunk_queue.get(), timeout=timeout)
-                    
-                    print(f"[STREAM_DEBUG] Processing chunk at {time.time()}")
-                    
-                    # Replace the "Thinking..." text with the real content once we receive it
-                    if full_response == "":
-                        full_response = "" # This will replace the "Thinking..." message
+                async with client_pool.slot():
+                    stage = "streaming"
+                    last_chunk = 0.0
+                    strip_next = False
+                    while True:
+                        usage = tier_usage.setdefault(decision.tier.name, {}) if decision else None
+                        text_stream = self._open_stream(client, params, usage, hedger)
+                        try:
+                            async for chunk in text_stream:
+                                if strip_next:
+                                    # The partial answer was prefilled without its trailing whitespace
+                                    chunk = chunk.lstrip()
+                                    if not chunk:
+                                        continue
+                                    strip_next = False
+                                if timing:
+                                    now = time.perf_counter()
+                                    if last_chunk:
+                                        INTER_TOKEN_GAP.observe(now - last_chunk, self.bot_id)
+                                    else:
+                                        ttft = now - started
+                                        TIME_TO_FIRST_TOKEN.observe(ttft, self.bot_id)
+                                        if routed is not None:
+                                            ROUTED_TTFT.observe(ttft, self.bot_id, routed.tier.name)
+                                        trace.mark("first_token")
+                                    last_chunk = now
+                                full_response += chunk
+                                yield StreamEvent("delta", chunk)
+                        except Exception as e:
+                            print(f"Error in stream: {str(e)}")
+                            streaming_error = e
+                        finally:
+                            await text_stream.aclose()
                         
-                    # None signals the end of streaming
-                    if chunk is None:
-                        break
-                    
-                    # Add the chunk to the full response
-                    full_response += chunk
-                    
-                    # Yield the updated full response
-                    yield full_response
-                    
-                except asyncio.TimeoutError:
-                    waiting_time += 0.2 if not first_chunk_received[0] else 0.5
-                    
-                    # Check if streaming is done
-                    if streaming_done[0]:
-                        break
-                        
-                    # If waiting too long for first chunk, give feedback
-                    if not first_chunk_received[0] and waiting_time > 3.0:
-                        # Don't change full_response - this keeps the "Thinking..." visible
-                        # but we'll update the dots to show activity
-                        yield f"Thinking{'.' * (int(waiting_time) % 4 + 1)}"
-                        
-                    # Otherwise, continue waiting
-                    continue
-            
-            # Save the complete response to the database
-            if full_response:
-                await self.save_message("assistant", full_response)
-            
-            # If streaming returned an empty response, try the non-streaming fallback
-            if not full_response and not streaming_error[0]:
-                print("Streaming returned an empty response. Trying non-streaming fallback.")
+                        if streaming_error or decision is None:
+                            break
+                        # An empty or truncated fast answer is continued by the standard tier
+                        escalation = router.escalation(decision, full_response, usage.get("stop_reason"))
+                        if escalation is None:
+                            break
+                        print(f"Escalating {self.bot_id} turn from {decision.tier.name} to "
+                              f"{escalation.tier.name}: {escalation.escalated} answer")
+                        ESCALATIONS.inc(self.bot_id, escalation.escalated)
+                        trace.mark("escalated")
+                        decision = escalation
+                        params = self._continuation_params(system_prompt, formatted_messages, decision.tier, full_response)
+                        strip_next = full_response != full_response.rstrip()
                 
-                def get_non_streaming_response():
-                    try:
-                        response = client.messages.create(
-                            model=self.model_id,
-                            max_tokens=2048,
-                            temperature=0.7,
-                            top_p=0.999,
-                            top_k=250,
-                            system=self.system_prompt if self.system_prompt else None,
-                            messages=formatted_messages
-                        )
-                        content = ""
-                        if hasattr(response, 'content'):
-                            if isinstance(response.content, list):
-                                for block in response.content:
-                                    if hasattr(block, 'text'):
-                                        content += block.text
-                                    elif isinstance(block, dict) and 'text' in block:
-                                        content += block['text']
-                            else:
-                                content = response.content
-                        return {"success": True, "response": content}
-                    except Exception as e:
-                        print(f"Non-streaming error: {str(e)}")
-                        return {"success": False, "error": str(e)}
+                if streaming_error:
+                    throttled = is_throttling_error(streaming_error)
+                    ERRORS.inc(self.bot_id, "throttled" if throttled else "stream")
+                    trace.finish(outcome="error")
+                    retry_after = scheduler.retry_after(ticket.bot_id) if throttled else None
+                    if throttled:
+                        error_msg = busy_message(retry_after)
+                    else:
+                        error_msg = f"Streaming error: {str(streaming_error)}"
+                    await save_turn(error_msg)
+                    yield StreamEvent("replace", error_msg, retry_after=retry_after)
+                    return
                 
-                loop = asyncio.get_event_loop()
-                fallback_result = await loop.run_in_executor(None, get_non_streaming_response)
+                # Save the complete response to the database
+                if full_response:
+                    if timing:
+                        GENERATION_TIME.observe(time.perf_counter() - started, self.bot_id)
+                    trace.finish(outcome="ok", chars=len(full_response))
+                    if decision is not None:
+                        self._log_route(router, decision, tier_usage, ttft, started)
+                    self._record_answer(full_response)
+                    await save_turn(full_response)
+                    if response_cache is not None:
+                        await response_cache.store(message, history, prompt.system_prompt, full_response)
+                    return
                 
-                if fallback_result["success"]:
-                    fallback_response = fallback_result["response"]
-                    await self.save_message("assistant", fallback_response)
-                    yield fallback_response
-                else:
-                    error_message = f"Error: {fallback_result.get('error', 'Both streaming and non-streaming failed')}"
-                    await self.save_message("assistant", error_message)
-                    yield error_message
+                # If streaming returned an empty response, try the non-streaming fallback
+                print("Streaming returned an empty response. Trying non-streaming fallback.")
+                FALLBACKS.inc(self.bot_id)
+                try:
+                    async with client_pool.slot():
+                        with trace.span("fallback"):
+                            fallback_response = await self._create_response(
+                                client, params, tier_usage.setdefault(decision.tier.name, {}) if decision else None)
+                except Exception as e:
+                    print(f"Non-streaming error: {str(e)}")
+                    ERRORS.inc(self.bot_id, "fallback")
+                    trace.finish(outcome="error")
+                    retry_after = scheduler.retry_after(ticket.bot_id) if is_throttling_error(e) else None
+                    if retry_after is not None:
+                        error_message = busy_message(retry_after)
+                    else:
+                        error_message = f"Error: {str(e) or 'Both streaming and non-streaming failed'}"
+                    await save_turn(error_message)
+                    yield StreamEvent("replace", error_message, retry_after=retry_after)
+                    return
+                
+                if timing:
+                    GENERATION_TIME.observe(time.perf_counter() - started, self.bot_id)
+                trace.finish(outcome="fallback", chars=len(fallback_response))
+                if decision is not None:
+                    self._log_route(router, decision, tier_usage, ttft, started)
+                self._record_answer(fallback_response)
+                await save_turn(fallback_response)
+                yield StreamEvent("replace", fallback_response)
+            finally:
+                ticket.release()
                 
+        except (asyncio.CancelledError, GeneratorExit):
+            # The user stopped the turn or left. Unwinding has already closed the model
+            # stream, which aborts the HTTP response; keep the part of the answer they saw
+            CANCELLED_TURNS.inc(self.bot_id, stage)
+            trace.finish(outcome="cancelled", stage=stage)
+            if begun and not saved:
+                CANCELLED_TOKENS_SAVED.inc(self.bot_id, amount=self._unspent_tokens(full_response, params))
+                await asyncio.shield(save_turn(full_response, status="cancelled"))
+            print(f"Cancelled {self.bot_id} turn while {stage} after {len(full_response)} chars")
+            raise
         except Exception as e:
             error_message = f"Error: {str(e)}"
             print(f"Error in get_response: {str(e)}")
-            await self.save_message("assistant", error_message)
-            yield error_message
\ No newline at end of file
+            ERRORS.inc(self.bot_id, "unexpected")
+            trace.finish(outcome="error")
+            await save_turn(error_message)
+            yield StreamEvent("replace", error_message)
+
+    async def stream(
+        self,
+        message: str,
+        history: List[Dict] = None,
+        conversation_id: str = None,
+        seq_offset: int = 0,
+        on_saved: Callable[[str], None] = None,
+    ) -> AsyncGenerator[StreamEvent, None]:
+        """
+        Stream a response as delta events, coalesced into frames.
+
+        Args:
+            message: The user message
+            history: Prior messages of the conversation
+            conversation_id: Conversation the turn belongs to
+            seq_offset: Sequence number of history[0]
+            on_saved: Called with the answer once the turn has been saved, cancelled or not
+
+        Yields:
+            StreamEvent frames; apply them with ResponseText to get the displayed text
+        """
+        settings = self.stream_settings
+        stats = StreamStats(mode="delta")
+        events = self.stream_events(message, history, conversation_id, seq_offset, on_saved)
+        frames = coalesce(events, settings.frame_interval_ms / 1000, settings.frame_max_bytes)
+        async with aclosing(frames):
+            async for event in frames:
+                stats.record(event)
+                yield event
+        print(f"Stream stats for {self.bot_id} (delta): {stats.summary()}")
+
+    async def get_response(
+        self,
+        message: str,
+        history: List[Dict] = None,
+        conversation_id: str = None,
+        seq_offset: int = 0,
+    ) -> AsyncGenerator[str, None]:
+        """Stream a response as the cumulative text after every chunk."""
+        stats = StreamStats(mode="cumulative")
+        events = self.stream_events(message, history, conversation_id, seq_offset)
+        async with aclosing(events):
+            async for event in events:
+                stats.record(event)
+                yield stats.response.text
+        print(f"Stream stats for {self.bot_id} (cumulative): {stats.summary()}")
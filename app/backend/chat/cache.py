@@ -0,0 +1,340 @@
+"""
+Response cache in front of the model call.
+
+Entries are keyed by bot id, a fingerprint of the bot's config and knowledge
+files, a hash of the system prompt and the normalized message (plus a hash of
+the history in "history" mode). Changing a bot's config or knowledge file
+changes the fingerprint, so stale answers are never served.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import datetime
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import delete, select, update
+from ..database import async_session
+from ..models import ResponseCacheEntry
+from ..knowledge.chunker import knowledge_file_path
+from ..knowledge.embeddings import get_embedder
+from ..repository import dialect_insert
+from ..shared_state import shared_state
+
+# The Postgres backend trims a bot's entries to max_entries every this many writes
+PRUNE_EVERY = 50
+
+
+@dataclass
+class CacheSettings:
+    enabled: bool = False
+    mode: str = "first_turn"        # "first_turn" or "history"
+    ttl: int = 3600                 # seconds
+    max_entries: int = 1000         # per bot
+    backend: str = None             # "memory" or "postgres"; default follows SHARED_STATE_BACKEND
+    semantic: bool = False          # also match near-duplicate questions by embedding
+    similarity: float = 0.92        # cosine similarity needed for a semantic hit
+    replay_chunk_chars: int = 24    # size of the simulated stream chunks on a hit
+    replay_interval: float = 0.01   # delay between simulated chunks
+
+    @classmethod
+    def from_config(cls, config: dict) -> "CacheSettings":
+        settings = config.get("cache") or {}
+        defaults = cls()
+        return cls(**{
+            field: settings.get(field, getattr(defaults, field))
+            for field in cls.__dataclass_fields__
+        })
+
+
+def normalize_message(message: str) -> str:
+    return " ".join(message.lower().split()).rstrip("?!. ")
+
+
+def _sha(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def history_hash(history: Optional[List[Dict]]) -> str:
+    parts = [f"{h['role']}\0{h['content']}" for h in (history or []) if isinstance(h, dict)]
+    return _sha("\0\0".join(parts))
+
+
+class BotFingerprint:
+    """Hash of a bot's config and knowledge files, recomputed only when their mtimes change."""
+
+    def __init__(self, bot_id: str):
+        self.paths = [f"app/config/{bot_id}-config.yaml", knowledge_file_path(bot_id)]
+        self._mtimes: Optional[Tuple] = None
+        self._value = ""
+
+    def _stat(self) -> Tuple:
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    @property
+    def value(self) -> str:
+        mtimes = self._stat()
+        if mtimes != self._mtimes:
+            hasher = hashlib.sha256()
+            for path in self.paths:
+                if os.path.exists(path):
+                    with open(path, 'rb') as file:
+                        hasher.update(file.read())
+                hasher.update(b"\0")
+            self._value = hasher.hexdigest()
+            self._mtimes = mtimes
+        return self._value
+
+
+class InMemoryCacheBackend:
+    """LRU + TTL cache local to the process."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        self.entries[key] = (time.time() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def clear(self) -> None:
+        self.entries.clear()
+
+
+class PostgresCacheBackend:
+    """Cache shared by every process, stored in the response_cache table."""
+
+    def __init__(self, bot_id: str, max_entries: int):
+        self.bot_id = bot_id
+        self.max_entries = max_entries
+        self.writes = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        now = datetime.datetime.utcnow()
+        async with async_session() as session:
+            result = await session.execute(
+                select(ResponseCacheEntry.response).where(
+                    ResponseCacheEntry.key == key,
+                    ResponseCacheEntry.expires_at > now,
+                )
+            )
+            value = result.scalar_one_or_none()
+            if value is not None:
+                await session.execute(
+                    update(ResponseCacheEntry).where(ResponseCacheEntry.key == key).values(last_hit_at=now)
+                )
+                await session.commit()
+            return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        now = datetime.datetime.utcnow()
+        async with async_session() as session:
+            insert = dialect_insert(session.bind.dialect.name)
+            statement = insert(ResponseCacheEntry).values(
+                key=key,
+                bot_id=self.bot_id,
+                response=value,
+                expires_at=now + datetime.timedelta(seconds=ttl),
+                last_hit_at=now,
+            )
+            await session.execute(statement.on_conflict_do_update(
+                index_elements=[ResponseCacheEntry.key],
+                set_={
+                    "response": statement.excluded.response,
+                    "expires_at": statement.excluded.expires_at,
+                    "last_hit_at": statement.excluded.last_hit_at,
+                },
+            ))
+
+            self.writes += 1
+            await session.commit()
+
+        if self.writes % PRUNE_EVERY == 0:
+            # One worker prunes at a time; the others skip their turn
+            async with shared_state.lock(f"response_cache_prune:{self.bot_id}", wait=False) as acquired:
+                if acquired:
+                    async with async_session() as session:
+                        await self._prune(session, now)
+                        await session.commit()
+
+    async def _prune(self, session, now: datetime.datetime) -> None:
+        await session.execute(delete(ResponseCacheEntry).where(ResponseCacheEntry.expires_at <= now))
+        keep = (
+            select(ResponseCacheEntry.key)
+            .where(ResponseCacheEntry.bot_id == self.bot_id)
+            .order_by(ResponseCacheEntry.last_hit_at.desc())
+            .limit(self.max_entries)
+        )
+        await session.execute(
+            delete(ResponseCacheEntry).where(
+                ResponseCacheEntry.bot_id == self.bot_id,
+                ResponseCacheEntry.key.not_in(keep),
+            )
+        )
+
+    async def clear(self) -> None:
+        # Entries of an old fingerprint can never be hit again; they age out through the TTL
+        return None
+
+
+class SemanticIndex:
+    """Embeddings of cached questions, searched for near-duplicates of a new question."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.keys: List[str] = []
+        self.contexts: List[str] = []
+        self.vectors: Optional[np.ndarray] = None
+
+    def add(self, key: str, context: str, vector: List[float]) -> None:
+        row = np.asarray(vector, dtype=np.float32)[None, :]
+        self.vectors = row if self.vectors is None else np.vstack([self.vectors, row])
+        self.keys.append(key)
+        self.contexts.append(context)
+        if len(self.keys) > self.max_entries:
+            self.vectors = self.vectors[1:]
+            self.keys.pop(0)
+            self.contexts.pop(0)
+
+    def nearest(self, context: str, vector: List[float], threshold: float) -> Optional[str]:
+        if self.vectors is None:
+            return None
+        scores = self.vectors @ np.asarray(vector, dtype=np.float32)
+        for row in np.argsort(-scores):
+            if scores[row] < threshold:
+                break
+            # Only reuse answers given in the same context (prompt, fingerprint and history)
+            if self.contexts[row] == context:
+                return self.keys[row]
+        return None
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.contexts.clear()
+        self.vectors = None
+
+
+class ResponseCache:
+    def __init__(self, bot_id: str, settings: CacheSettings):
+        self.bot_id = bot_id
+        self.settings = settings
+        self.fingerprint = BotFingerprint(bot_id)
+        self._fingerprint_seen = None
+
+        backend = settings.backend or ("postgres" if shared_state.distributed else "memory")
+        if backend == "postgres":
+            self.backend = PostgresCacheBackend(bot_id, settings.max_entries)
+        else:
+            self.backend = InMemoryCacheBackend(settings.max_entries)
+
+        self.semantic_index = SemanticIndex(settings.max_entries) if settings.semantic else None
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0}
+
+    async def _context(self, system_prompt: str, history: Optional[List[Dict]]) -> Optional[str]:
+        if self.settings.mode == "first_turn":
+            if history:
+                return None
+            history_part = ""
+        else:
+            history_part = history_hash(history)
+
+        fingerprint = self.fingerprint.value
+        if fingerprint != self._fingerprint_seen:
+            # Marked seen before clearing, so concurrent turns do not clear again
+            previous, self._fingerprint_seen = self._fingerprint_seen, fingerprint
+            if previous is not None:
+                print(f"Config or knowledge changed for {self.bot_id}; invalidating response cache")
+                if self.semantic_index:
+                    self.semantic_index.clear()
+                try:
+                    await self.backend.clear()
+                except Exception as e:
+                    # Old entries are keyed by the old fingerprint, so they are never served; they only take space
+                    print(f"Error clearing response cache for {self.bot_id}: {str(e)}")
+
+        return _sha(f"{self.bot_id}\0{fingerprint}\0{_sha(system_prompt or '')}\0{history_part}")
+
+    async def lookup(self, message: str, history: Optional[List[Dict]], system_prompt: str) -> Optional[str]:
+        """
+        Return a cached response for the message, if one exists.
+
+        Args:
+            message: The user message
+            history: Prior messages of the conversation
+            system_prompt: The bot's base system prompt
+
+        Returns:
+            The cached response text, or None on a miss
+        """
+        context = await self._context(system_prompt, history)
+        if context is None:
+            return None
+
+        try:
+            value = await self.backend.get(_sha(f"{context}\0{normalize_message(message)}"))
+            if value is not None:
+                self.stats["hits"] += 1
+                return value
+
+            if self.semantic_index is not None:
+                [vector] = await get_embedder().aembed([normalize_message(message)])
+                key = self.semantic_index.nearest(context, vector, self.settings.similarity)
+                if key is not None:
+                    value = await self.backend.get(key)
+                    if value is not None:
+                        self.stats["semantic_hits"] += 1
+                        return value
+        except Exception as e:
+            print(f"Error reading response cache for {self.bot_id}: {str(e)}")
+
+        self.stats["misses"] += 1
+        return None
+
+    async def store(self, message: str, history: Optional[List[Dict]], system_prompt: str, response: str) -> None:
+        context = await self._context(system_prompt, history)
+        if context is None or not response:
+            return
+
+        key = _sha(f"{context}\0{normalize_message(message)}")
+        try:
+            await self.backend.set(key, response, self.settings.ttl)
+            if self.semantic_index is not None:
+                [vector] = await get_embedder().aembed([normalize_message(message)])
+                self.semantic_index.add(key, context, vector)
+        except Exception as e:
+            print(f"Error writing response cache for {self.bot_id}: {str(e)}")
+
+    async def replay(self, response: str):
+        """Yield a cached response in pieces, as a simulated stream."""
+        step = max(1, self.settings.replay_chunk_chars)
+        for start in range(0, len(response), step):
+            yield response[start:start + step]
+            await asyncio.sleep(self.settings.replay_interval)
+
+
+def create_response_cache(bot_id: str, config: dict) -> Optional[ResponseCache]:
+    settings = CacheSettings.from_config(config)
+    if not settings.enabled:
+        return None
+    return ResponseCache(bot_id, settings)
@@ -0,0 +1,149 @@
+"""
+Process-wide Bedrock client pool shared by all bots.
+
+One AsyncAnthropicBedrock client per region sits on a shared httpx connection
+pool, so bots reuse warm TLS connections instead of each opening their own.
+A global semaphore caps the number of model calls in flight against the
+Bedrock quota.
+"""
+import os
+import asyncio
+import importlib.util
+import httpx
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from anthropic import AsyncAnthropicBedrock
+from dotenv import load_dotenv
+
+if not os.getenv("AWS_BEDROCK_ACCESS_KEY"):
+    load_dotenv()
+
+BEDROCK_MAX_CONNECTIONS = int(os.getenv("BEDROCK_MAX_CONNECTIONS", "100"))
+BEDROCK_MAX_KEEPALIVE = int(os.getenv("BEDROCK_MAX_KEEPALIVE", "20"))
+BEDROCK_KEEPALIVE_EXPIRY = float(os.getenv("BEDROCK_KEEPALIVE_EXPIRY", "60"))
+BEDROCK_MAX_INFLIGHT = int(os.getenv("BEDROCK_MAX_INFLIGHT", "64"))
+BEDROCK_PREWARM_CONNECTIONS = int(os.getenv("BEDROCK_PREWARM_CONNECTIONS", "2"))
+# HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+BEDROCK_HTTP2 = (
+    os.getenv("BEDROCK_HTTP2", "true").lower() == "true"
+    and importlib.util.find_spec("h2") is not None
+)
+
+
+class BedrockClientPool:
+    def __init__(
+        self,
+        max_connections: int = BEDROCK_MAX_CONNECTIONS,
+        max_keepalive: int = BEDROCK_MAX_KEEPALIVE,
+        keepalive_expiry: float = BEDROCK_KEEPALIVE_EXPIRY,
+        max_inflight: int = BEDROCK_MAX_INFLIGHT,
+        http2: bool = BEDROCK_HTTP2,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.max_inflight = max_inflight
+
+        self._clients: Dict[str, AsyncAnthropicBedrock] = {}
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.waiting = 0
+
+    def get_client(self, aws_region: str = None) -> AsyncAnthropicBedrock:
+        """
+        Return the shared client for a region, creating it on first use.
+
+        Args:
+            aws_region: Bedrock region; defaults to AWS_BEDROCK_REGION
+
+        Returns:
+            AsyncAnthropicBedrock client backed by the shared connection pool
+        """
+        region = aws_region or os.getenv("AWS_BEDROCK_REGION")
+        if region not in self._clients:
+            http_client = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+            self._http_clients[region] = http_client
+            self._clients[region] = AsyncAnthropicBedrock(
+                aws_access_key=os.getenv("AWS_BEDROCK_ACCESS_KEY"),
+                aws_secret_key=os.getenv("AWS_BEDROCK_SECRET_KEY"),
+                aws_region=region,
+                http_client=http_client,
+            )
+        return self._clients[region]
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the global in-flight model call slots."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_inflight)
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    async def prewarm(self, connections: int = BEDROCK_PREWARM_CONNECTIONS, aws_region: str = None) -> None:
+        """
+        Open connections to the Bedrock endpoint ahead of the first chat.
+
+        Any response (even 403 for the unsigned request) leaves a TLS
+        connection in the keep-alive pool.
+        """
+        if connections <= 0:
+            return
+
+        region = aws_region or os.getenv("AWS_BEDROCK_REGION")
+        client = self.get_client(region)
+        http_client = self._http_clients[region]
+        url = str(client.base_url)
+
+        async def touch():
+            try:
+                await http_client.get(url, timeout=5.0)
+            except Exception as e:
+                print(f"Error pre-warming Bedrock connection: {str(e)}")
+
+        await asyncio.gather(*(touch() for _ in range(connections)))
+        print(f"Pre-warmed {connections} Bedrock connections to {url}: {self.stats()['connections']}")
+
+    def stats(self) -> Dict:
+        active = idle = 0
+        for http_client in self._http_clients.values():
+            try:
+                # httpcore's pool is not public API; report what it exposes
+                for connection in http_client._transport._pool.connections:
+                    if connection.is_idle():
+                        idle += 1
+                    elif not connection.is_closed():
+                        active += 1
+            except AttributeError:
+                continue
+
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_inflight": self.max_inflight,
+            "http2": self.http2,
+            "connections": {"active": active, "idle": idle, "max": self.limits.max_connections},
+        }
+
+    async def close(self) -> None:
+        for http_client in self._http_clients.values():
+            await http_client.aclose()
+        self._clients.clear()
+        self._http_clients.clear()
+
+
+client_pool = BedrockClientPool()
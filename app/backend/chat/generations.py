@@ -0,0 +1,282 @@
+"""
+Resumable generations: answers run as server-side tasks, decoupled from the
+client that asked for them.
+
+A generation writes the stream events of one turn into a bounded ring buffer,
+addressed by offset (the position of an event in the generation). Clients
+attach at an offset and replay from there, so a client whose connection
+dropped reattaches with the last offset it saw instead of asking again and
+paying for the whole answer twice. Events that fell out of the ring are folded
+into the text they produced; a client asking for an offset before the ring
+gets that text as one "replace" event and continues from the ring.
+
+An unfinished generation with no client attached is cancelled after
+GENERATION_DETACH_GRACE seconds, which saves its partial answer as cancelled.
+Finished generations are kept for GENERATION_TTL seconds for late reattaches.
+Generations live in the worker that runs them; with several workers a
+reattach has to reach the same worker (sticky sessions).
+"""
+import os
+import time
+import uuid
+import asyncio
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from .streaming import ResponseText, StreamEvent
+from ..metrics import GENERATIONS, REATTACHES
+
+# Events kept per generation for replay; older ones are folded into a snapshot of the text
+GENERATION_BUFFER_EVENTS = int(os.getenv("GENERATION_BUFFER_EVENTS", "256"))
+# Seconds a finished generation stays available for reattaching
+GENERATION_TTL = float(os.getenv("GENERATION_TTL", "300"))
+# Seconds an unfinished generation keeps running with no client attached
+GENERATION_DETACH_GRACE = float(os.getenv("GENERATION_DETACH_GRACE", "30"))
+
+
+class Generation:
+    def __init__(
+        self,
+        generation_id: str,
+        bot_id: str,
+        capacity: int,
+        grace: float,
+        conversation_id: str = None,
+        message: str = None,
+        seq: int = None,
+    ):
+        self.id = generation_id
+        self.bot_id = bot_id
+        self.conversation_id = conversation_id
+        self.message = message
+        self.seq = seq                          # seq of the user message of the turn
+        self.capacity = capacity
+        self.grace = grace
+        self.buffer: Deque[StreamEvent] = deque()
+        self.start = 0                          # offset of buffer[0]
+        self.snapshot = ResponseText()          # the events before buffer[0], applied
+        self.response = ResponseText()          # every event so far, applied
+        self.status = "running"                 # running, complete, cancelled, error
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.readers = 0
+        self.attaches = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._detach_timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def end(self) -> int:
+        """Offset after the last event."""
+        return self.start + len(self.buffer)
+
+    @property
+    def done(self) -> bool:
+        return self.status != "running"
+
+    @property
+    def text(self) -> str:
+        """The answer so far, without a status placeholder."""
+        return "" if self.response.showing_status else self.response.text
+
+    def _wake(self) -> None:
+        # Readers wait on the event current when they caught up; a fresh one is armed for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def append(self, event: StreamEvent) -> None:
+        self.buffer.append(event)
+        self.response.apply(event)
+        if len(self.buffer) > self.capacity:
+            self.snapshot.apply(self.buffer.popleft())
+            self.start += 1
+        self._wake()
+
+    def finish(self, status: str) -> None:
+        self.status = status
+        self.finished_at = time.time()
+        self._cancel_detach_timer()
+        self._wake()
+
+    def events_from(self, offset: int) -> List[Tuple[int, StreamEvent]]:
+        """
+        The events from `offset` that are available now.
+
+        Returns:
+            (offset to resume from after the event, event) pairs
+        """
+        events = []
+        if offset < self.start:
+            kind = "status" if self.snapshot.showing_status else "replace"
+            events.append((self.start, StreamEvent(kind, self.snapshot.text)))
+            offset = self.start
+        for index in range(offset - self.start, len(self.buffer)):
+            events.append((self.start + index + 1, self.buffer[index]))
+        return events
+
+    async def attach(self, offset: int = 0) -> AsyncGenerator[Tuple[int, StreamEvent], None]:
+        """
+        Replay the generation from `offset`, then follow it until it finishes.
+
+        Args:
+            offset: The last offset the client received, 0 for the whole answer
+
+        Yields:
+            (offset to resume from after the event, event) pairs
+        """
+        self.readers += 1
+        self.attaches += 1
+        if self.attaches > 1:
+            REATTACHES.inc(self.bot_id)
+        self._cancel_detach_timer()
+        offset = max(0, min(offset, self.end))
+        try:
+            while True:
+                changed = self._changed
+                for offset, event in self.events_from(offset):
+                    yield offset, event
+                if offset >= self.end:
+                    if self.done:
+                        return
+                    await changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and not self.done:
+                self._start_detach_timer()
+
+    def cancel(self) -> bool:
+        if self.done or self.task is None:
+            return False
+        self.task.cancel()
+        return True
+
+    def _start_detach_timer(self) -> None:
+        self._cancel_detach_timer()
+        self._detach_timer = asyncio.get_running_loop().call_later(self.grace, self._abandoned)
+
+    def _cancel_detach_timer(self) -> None:
+        if self._detach_timer is not None:
+            self._detach_timer.cancel()
+            self._detach_timer = None
+
+    def _abandoned(self) -> None:
+        self._detach_timer = None
+        if self.readers == 0 and self.cancel():
+            print(f"Cancelled generation {self.id} for {self.bot_id}: no client for {self.grace}s")
+
+    def info(self) -> Dict:
+        # No ids: the request and conversation id are what a client reattaches or cancels with
+        return {
+            "bot": self.bot_id,
+            "status": self.status,
+            "offset": self.end,
+            "buffered": len(self.buffer),
+            "readers": self.readers,
+            "age_s": round(time.time() - self.created_at, 1),
+        }
+
+
+FinishCallback = Callable[[Generation], Awaitable[None]]
+
+
+class GenerationStore:
+    def __init__(
+        self,
+        capacity: int = GENERATION_BUFFER_EVENTS,
+        ttl: float = GENERATION_TTL,
+        grace: float = GENERATION_DETACH_GRACE,
+    ):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.grace = grace
+        self.generations: Dict[str, Generation] = {}
+
+    def start(
+        self,
+        bot_id: str,
+        events: AsyncIterator[StreamEvent],
+        generation_id: str = None,
+        conversation_id: str = None,
+        message: str = None,
+        seq: int = None,
+        on_finish: FinishCallback = None,
+    ) -> Generation:
+        """
+        Run a turn's events as a server-side task.
+
+        Args:
+            bot_id: Bot answering the turn
+            events: The turn's stream events (BaseChat.stream)
+            generation_id: Id to address the generation by; a new one if None
+            conversation_id: Conversation the turn belongs to
+            message: The user message of the turn
+            seq: Sequence number of the user message
+            on_finish: Awaited with the generation once it has finished, however it ended
+
+        Returns:
+            The running Generation; attach to it to receive the events
+        """
+        generation = Generation(
+            generation_id or uuid.uuid4().hex, bot_id, self.capacity, self.grace,
+            conversation_id=conversation_id, message=message, seq=seq,
+        )
+        self.generations[generation.id] = generation
+        generation.task = asyncio.create_task(self._run(generation, events, on_finish))
+        # Cancelled like a detached one if no client ever attaches
+        generation._start_detach_timer()
+        return generation
+
+    def get(self, generation_id: Optional[str]) -> Optional[Generation]:
+        if not generation_id:
+            return None
+        return self.generations.get(generation_id)
+
+    def cancel(self, generation_id: Optional[str]) -> bool:
+        generation = self.get(generation_id)
+        return generation is not None and generation.cancel()
+
+    async def _run(self, generation: Generation, events: AsyncIterator[StreamEvent], on_finish: Optional[FinishCallback]) -> None:
+        status = "error"
+        try:
+            async with aclosing(events):
+                async for event in events:
+                    generation.append(event)
+            status = "complete"
+        except asyncio.CancelledError:
+            # Closing the events on the way out aborted the model call and saved the partial answer
+            status = "cancelled"
+        except Exception as e:
+            print(f"Error in generation {generation.id} for {generation.bot_id}: {str(e)}")
+        finally:
+            generation.finish(status)
+            GENERATIONS.inc(generation.bot_id, status)
+            asyncio.get_running_loop().call_later(self.ttl, self._evict, generation.id)
+
+        if on_finish is not None:
+            try:
+                await on_finish(generation)
+            except Exception as e:
+                print(f"Error finishing generation {generation.id}: {str(e)}")
+
+    def _evict(self, generation_id: str) -> None:
+        self.generations.pop(generation_id, None)
+
+    async def close(self) -> None:
+        """Cancel the running generations, saving their partial answers."""
+        tasks = [generation.task for generation in self.generations.values() if generation.cancel()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        generations = list(self.generations.values())
+        return {
+            "running": sum(not generation.done for generation in generations),
+            "finished": sum(generation.done for generation in generations),
+            "buffered_events": sum(len(generation.buffer) for generation in generations),
+            "capacity": self.capacity,
+            "ttl_s": self.ttl,
+            "detach_grace_s": self.grace,
+            "generations": [generation.info() for generation in generations],
+        }
+
+
+generations = GenerationStore()
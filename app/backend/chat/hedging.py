@@ -0,0 +1,187 @@
+"""
+Hedged model calls: a second request when the first token is late.
+
+When a streaming call has produced no text within the bot's deadline, the same
+request is started again against an alternate region and/or model prefix (a
+cross-region inference profile such as "eu." instead of "us."). Whichever
+produces text first is streamed to the user and the other call is cancelled,
+which closes its HTTP response so Bedrock stops generating.
+
+Hedges are paid for by a budget: every call earns `max_rate` of a hedge, up to
+`burst` saved, and a hedge spends one. Over any longer stretch at most
+`max_rate` of calls are hedged, so a slow or throttled upstream cannot double
+the load on it. Hedges are also skipped while the client pool is saturated.
+"""
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Optional
+from .client_pool import client_pool
+from ..metrics import HEDGES
+
+StreamFactory = Callable[[], AsyncIterator[str]]
+
+
+@dataclass
+class HedgeSettings:
+    enabled: bool = False
+    deadline: float = 2.0               # seconds without a first token before hedging
+    max_rate: float = 0.05              # fraction of calls that may be hedged
+    burst: float = 2.0                  # hedges that may be saved up while the upstream is fast
+    region: Optional[str] = None        # AWS region of the hedge; None: the bot's region
+    region_prefix: Optional[str] = None  # model prefix of the hedge; None: AWS_BEDROCK_REGION_PREFIX
+
+    @classmethod
+    def from_config(cls, config: dict) -> "HedgeSettings":
+        settings = config.get("hedging") or {}
+        defaults = cls()
+        return cls(**{
+            field: settings.get(field, getattr(defaults, field))
+            for field in cls.__dataclass_fields__
+        })
+
+
+async def _first_chunk(stream: AsyncIterator[str]) -> Optional[str]:
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+class Hedger:
+    def __init__(self, bot_id: str, settings: HedgeSettings):
+        self.bot_id = bot_id
+        self.settings = settings
+        self.budget = settings.burst
+        self.calls = 0
+        self.hedged = 0
+
+    def _try_spend(self) -> bool:
+        if self.budget < 1.0:
+            return False
+        self.budget -= 1.0
+        return True
+
+    def hedge_params(self, params: Dict, region_prefix: str) -> Dict:
+        """Request params for the hedge: the same request on the alternate model prefix."""
+        prefix = self.settings.region_prefix
+        model = params["model"]
+        if prefix is None or prefix == region_prefix:
+            return params
+        if region_prefix and model.startswith(f"{region_prefix}."):
+            model = model[len(region_prefix) + 1:]
+        return {**params, "model": f"{prefix}.{model}" if prefix else model}
+
+    async def stream(
+        self,
+        primary: StreamFactory,
+        hedge: StreamFactory,
+        on_winner: Callable[[str], None] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Stream the text of `primary`, racing it against `hedge` if its first token is late.
+
+        Args:
+            primary: Starts the call as configured for the bot
+            hedge: Starts the same call against the alternate region or prefix
+            on_winner: Called with "primary" or "hedge", the call whose text is streamed
+
+        Raises:
+            The primary call's error if no call produced text and at least one failed
+        """
+        self.calls += 1
+        self.budget = min(self.settings.burst, self.budget + self.settings.max_rate)
+
+        streams = {}
+        first = primary()
+        streams[asyncio.ensure_future(_first_chunk(first))] = ("primary", first)
+        deadline: Optional[float] = self.settings.deadline
+        hedged = False
+        winner = None
+        chunk = None
+        error = None
+
+        try:
+            while streams and winner is None:
+                done, _ = await asyncio.wait(streams, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Deadline passed without a first token: the only chance to hedge this call
+                    deadline = None
+                    if client_pool.in_flight >= client_pool.max_inflight:
+                        HEDGES.inc(self.bot_id, "no_capacity")
+                    elif not self._try_spend():
+                        HEDGES.inc(self.bot_id, "no_budget")
+                    else:
+                        self.hedged += 1
+                        hedged = True
+                        print(f"Hedging {self.bot_id} call: no first token after {self.settings.deadline}s")
+                        second = hedge()
+                        streams[asyncio.ensure_future(_first_chunk(second))] = ("hedge", second)
+                    continue
+
+                for task in done:
+                    name, stream = streams.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        print(f"Error in {name} call for {self.bot_id}: {str(e)}")
+                        if error is None or name == "primary":
+                            error = e
+                        await stream.aclose()
+                        continue
+                    if text is None:
+                        # Finished without text; the other call may still produce some
+                        continue
+                    if winner is None:
+                        winner, chunk = (name, stream), text
+                    else:
+                        streams[task] = (name, stream)
+        finally:
+            # Cancel the losers: closing the stream aborts the HTTP response
+            for task in streams:
+                task.cancel()
+            for task, (_, stream) in streams.items():
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+
+        if hedged:
+            # Which call answered first: "primary", "hedge", or "failed" if neither produced text
+            HEDGES.inc(self.bot_id, winner[0] if winner else "failed")
+        if winner is None:
+            if error is not None:
+                raise error
+            return
+
+        name, stream = winner
+        if on_winner is not None:
+            on_winner(name)
+        try:
+            yield chunk
+            async for text in stream:
+                yield text
+        finally:
+            await stream.aclose()
+
+
+def create_hedger(bot_id: str, config: dict, previous: Optional[Hedger] = None) -> Optional[Hedger]:
+    """
+    Build the hedger described by a bot's `hedging` config block.
+
+    Args:
+        bot_id: ID of the bot
+        config: The bot configuration
+        previous: The bot's current hedger; kept, with its budget, if the settings are unchanged
+
+    Returns:
+        Hedger instance, or None when hedging is disabled for the bot
+    """
+    settings = HedgeSettings.from_config(config)
+    if previous is not None and previous.settings == settings:
+        # A reload must not refill the budget
+        return previous
+    if not settings.enabled:
+        return None
+    if settings.region is None and settings.region_prefix is None:
+        # The hedge would be the identical request to the same endpoint that is already slow
+        print(f"Hedging for {bot_id} needs a region or region_prefix to hedge to; hedging disabled")
+        return None
+    return Hedger(bot_id, settings)
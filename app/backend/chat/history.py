@@ -0,0 +1,156 @@
+import re
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from ..tokens import estimate_tokens
+
+# Running summaries kept in memory, least recently used are evicted first
+MAX_CACHED_SUMMARIES = 1024
+
+# Each folded message contributes at most this many characters to the summary
+SUMMARY_LINE_CHARS = 240
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+@dataclass
+class HistorySettings:
+    max_tokens: int = 8000      # budget for the history sent verbatim
+    keep_turns: int = 10        # most recent user/assistant turns kept verbatim
+    summary_tokens: int = 600   # cap on the running summary of older turns
+
+    @classmethod
+    def from_config(cls, config: dict) -> "HistorySettings":
+        settings = config.get("history") or {}
+        defaults = cls()
+        return cls(
+            max_tokens=settings.get("max_tokens", defaults.max_tokens),
+            keep_turns=settings.get("keep_turns", defaults.keep_turns),
+            summary_tokens=settings.get("summary_tokens", defaults.summary_tokens),
+        )
+
+
+@dataclass
+class HistoryWindowResult:
+    messages: List[Dict]
+    summary: str
+    full_tokens: int
+    sent_tokens: int
+
+    @property
+    def saved_tokens(self) -> int:
+        return max(0, self.full_tokens - self.sent_tokens)
+
+
+@dataclass
+class _SummaryState:
+    folded_count: int
+    folded_digest: str
+    lines: List[str]
+
+
+def _digest(messages: List[Dict]) -> str:
+    hasher = hashlib.sha256()
+    for message in messages:
+        hasher.update(message["role"].encode("utf-8"))
+        hasher.update(b"\0")
+        hasher.update(message["content"].encode("utf-8"))
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def _summary_line(message: Dict) -> str:
+    text = " ".join(message["content"].split())
+    first_sentence = SENTENCE_END.split(text, maxsplit=1)[0]
+    if len(first_sentence) > SUMMARY_LINE_CHARS:
+        first_sentence = first_sentence[:SUMMARY_LINE_CHARS].rstrip() + "..."
+    speaker = "User" if message["role"] == "user" else "Assistant"
+    return f"{speaker}: {first_sentence}"
+
+
+class HistoryWindow:
+    """
+    Keeps the prompt size of long conversations bounded.
+
+    The most recent turns are sent verbatim within a token budget; everything
+    older is folded into a running summary that is extended as more turns
+    fall out of the window, instead of being rebuilt on every turn.
+    """
+
+    def __init__(self, settings: HistorySettings = None):
+        self.settings = settings or HistorySettings()
+        self._summaries: "OrderedDict[str, _SummaryState]" = OrderedDict()
+
+    def _split_index(self, messages: List[Dict]) -> int:
+        """Index of the first message kept verbatim."""
+        turns = 0
+        used = 0
+        split = len(messages)
+        for index in range(len(messages) - 1, -1, -1):
+            used += estimate_tokens(messages[index]["content"])
+            if used > self.settings.max_tokens:
+                break
+            if messages[index]["role"] == "user":
+                turns += 1
+                split = index
+                if turns >= self.settings.keep_turns:
+                    break
+        return split
+
+    def _summarize(self, key: Optional[str], folded: List[Dict]) -> str:
+        # Without a conversation id there is nothing that safely identifies the chat, so nothing is cached
+        state = self._summaries.get(key) if key else None
+        if state is not None and (
+            state.folded_count > len(folded)
+            or _digest(folded[:state.folded_count]) != state.folded_digest
+        ):
+            # The history was edited (e.g. a retried turn); start over for this conversation
+            state = None
+
+        if state is None:
+            state = _SummaryState(folded_count=0, folded_digest=_digest([]), lines=[])
+
+        if state.folded_count < len(folded):
+            state.lines.extend(_summary_line(message) for message in folded[state.folded_count:])
+            while len(state.lines) > 1 and estimate_tokens("\n".join(state.lines)) > self.settings.summary_tokens:
+                state.lines.pop(0)
+            state.folded_count = len(folded)
+            state.folded_digest = _digest(folded)
+
+        if not key:
+            return "\n".join(state.lines)
+        self._summaries[key] = state
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > MAX_CACHED_SUMMARIES:
+            self._summaries.popitem(last=False)
+
+        return "\n".join(state.lines)
+
+    def apply(self, messages: List[Dict], conversation_id: Optional[str] = None) -> HistoryWindowResult:
+        """
+        Window a conversation's history.
+
+        Args:
+            messages: Prior user/assistant messages, oldest first
+            conversation_id: Key for the cached summary; without one the summary is built from scratch
+
+        Returns:
+            HistoryWindowResult with the verbatim messages, the summary of the rest and token counts
+        """
+        full_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+
+        split = self._split_index(messages)
+        if split == 0:
+            return HistoryWindowResult(messages=messages, summary="", full_tokens=full_tokens, sent_tokens=full_tokens)
+
+        summary = self._summarize(conversation_id, messages[:split])
+        kept = messages[split:]
+        sent_tokens = estimate_tokens(summary) + sum(estimate_tokens(message["content"]) for message in kept)
+        return HistoryWindowResult(messages=kept, summary=summary, full_tokens=full_tokens, sent_tokens=sent_tokens)
+
+    @staticmethod
+    def format_summary(summary: str) -> str:
+        if not summary:
+            return ""
+        return f"\n\nSummary of the earlier part of this conversation:\n{summary}"
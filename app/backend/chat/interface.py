@@ -1,91 +1,193 @@
 import gradio as gr
 import os
-import yaml
-import asyncio
-from pathlib import Path
-from .base_chat import BaseChat
+import uuid
+import functools
+from .base_chat import BaseChat, PromptVersion
+from .history import HistorySettings, HistoryWindow
+from .cache import CacheSettings, create_response_cache
+from .streaming import ResponseText, RunningStreams, StreamSettings
+from .scheduler import AdmissionSettings
+from .generations import Generation, generations
+from .routing import create_router
+from .hedging import create_hedger
+from .registry import CompiledBot, bot_registry
+from ..knowledge.retriever import create_retriever
+from ..repository import conversations, valid_conversation_id
+
+@functools.lru_cache(maxsize=None)
+def load_theme_js() -> str:
+    """The theme script shared by every bot's Blocks, read once per process."""
+    js_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 
+                          'static', 'gradio_force_theme.js')
+    with open(js_path, 'r') as f:
+        return f.read()
 
 class ChatInterface:
     def __init__(self, bot_id: str = None):
         self.bot_id = bot_id
-        self.config = self._load_config(bot_id)
-        
-        # Get the base prompt from the config
-        base_prompt = self.config.get("base_prompt", "")
-        
-        # Append knowledge base if it exists
-        system_prompt = self._append_knowledge_base(bot_id, base_prompt)
+        # Config and system prompt are compiled once by the registry and replaced when the files change
+        compiled = bot_registry.get(bot_id) if bot_id else None
+        if bot_id and compiled is None:
+            print(f"No config file found for {bot_id}. Using empty config.")
+        self.config = compiled.config if compiled else {}
         
-        self.chat = BaseChat(system_prompt=system_prompt)
+        # With retrieval enabled the knowledge is fetched per turn instead
+        retriever = create_retriever(bot_id, self.config) if bot_id else None
+        settings = {
+            "bot_id": bot_id,
+            "history_settings": HistorySettings.from_config(self.config),
+            "response_cache": create_response_cache(bot_id, self.config) if bot_id else None,
+            "stream_settings": StreamSettings.from_config(self.config),
+            "admission_settings": AdmissionSettings.from_config(self.config),
+            "router": create_router(bot_id, self.config),
+            "hedger": create_hedger(bot_id, self.config),
+        }
+        self.chat = BaseChat(retriever=retriever, **settings)
+        self._retrieval = self.config.get("retrieval") or {}
+        # The generation each browser session is reading
+        self.running = RunningStreams()
+        if compiled:
+            self._apply_version(compiled)
+        bot_registry.subscribe(self._apply_version)
     
-    def _load_config(self, bot_id: str) -> dict:
+    def _apply_version(self, compiled: CompiledBot) -> None:
         """
-        Load the bot configuration from YAML file.
+        Switch new turns to a newly compiled version of this bot.
+
+        Every setting read from the config is rebuilt, so the version the
+        registry reports as active is the one new turns run with.
         
         Args:
-            bot_id: ID of the bot
-            
-        Returns:
-            Dict containing the bot configuration
+            compiled: The version installed by the registry
         """
-        if not bot_id:
-            return {}
-            
-        # Path to config file
-        config_file_path = f"app/config/{bot_id}-config.yaml"
-        
-        # Check if config file exists
-        if not os.path.exists(config_file_path):
-            print(f"No config file found for {bot_id}. Using empty config.")
-            return {}
-            
-        try:
-            # Load config from YAML
-            with open(config_file_path, 'r') as file:
-                config_data = yaml.safe_load(file)
-                return config_data
-                
-        except Exception as e:
-            print(f"Error loading config for {bot_id}: {str(e)}")
-            return {}
+        if compiled.bot_id != self.bot_id:
+            return
+        self.config = compiled.config
+        # Tiers are read per turn, so a routing change applies to the next turn
+        self.chat.router = create_router(self.bot_id, self.config)
+        self.chat.hedger = create_hedger(self.bot_id, self.config, previous=self.chat.hedger)
+        self.chat.stream_settings = StreamSettings.from_config(self.config)
+        self.chat.admission_settings = AdmissionSettings.from_config(self.config)
+        # The history summaries and cached answers are kept unless their own settings changed
+        history_settings = HistorySettings.from_config(self.config)
+        if history_settings != self.chat.history_window.settings:
+            self.chat.history_window = HistoryWindow(history_settings)
+        cache = self.chat.response_cache
+        if CacheSettings.from_config(self.config) != (cache.settings if cache else CacheSettings()):
+            self.chat.response_cache = create_response_cache(self.bot_id, self.config)
+        retrieval = self.config.get("retrieval") or {}
+        if retrieval != self._retrieval:
+            self._retrieval = retrieval
+            self.chat.retriever = create_retriever(self.bot_id, self.config)
+        if self.chat.retriever:
+            prompt = PromptVersion(compiled.base_prompt, compiled.system_prompt, compiled.hash)
+        else:
+            prompt = PromptVersion(compiled.system_prompt, None, compiled.hash)
+        self.chat.set_prompt(prompt)
     
-    def _append_knowledge_base(self, bot_id: str, base_prompt: str) -> str:
+    async def restore_conversation(self, conversation_id: str, request: gr.Request = None):
         """
-        Simple approach to append knowledge base content to the base prompt.
-        
+        Resume a conversation from the database when the page loads.
+
+        A `conversation_id` query parameter takes precedence over the id the
+        browser remembers from its last visit. A conversation of another bot
+        is not resumed; the page starts a new one instead.
+
         Args:
-            bot_id: ID of the bot
-            base_prompt: The base system prompt for the bot
-            
+            conversation_id: Conversation id stored in the browser, if any
+            request: The Gradio request for the page load
+
         Returns:
-            Combined system prompt with knowledge base appended
+            Tuple of (chat history, conversation id, seq offset of the first restored message)
         """
-        if not bot_id:
-            return base_prompt
-            
-        # Path to knowledge file
-        knowledge_file_path = f"app/knowledge/{bot_id}.yaml"
-        
-        # Check if knowledge file exists
-        if not os.path.exists(knowledge_file_path):
-            print(f"No knowledge file found for {bot_id}. Using base prompt only.")
-            return base_prompt
-            
+        if request is not None and request.query_params.get("conversation_id"):
+            conversation_id = request.query_params["conversation_id"]
+
+        if not conversation_id or not valid_conversation_id(conversation_id):
+            # Nothing to resume, or an id that cannot be one of ours: start a new conversation
+            return [], str(uuid.uuid4()), 0
+
         try:
-            # Load knowledge from YAML
-            with open(knowledge_file_path, 'r') as file:
-                knowledge_data = yaml.safe_load(file)
-                
-            # Convert knowledge to string representation and append to base prompt
-            knowledge_str = "\n\nHere is additional knowledge you have:\n"
-            knowledge_str += yaml.dump(knowledge_data, default_flow_style=False)
-            
-            return base_prompt + knowledge_str
-                
+            conversation = await conversations.get_conversation(conversation_id)
+            if conversation is not None and conversation.bot_id != self.bot_id:
+                # Another bot's conversation: do not show its history or append to it
+                return [], str(uuid.uuid4()), 0
+            messages = await conversations.load_history(conversation_id) if conversation else []
         except Exception as e:
-            print(f"Error loading knowledge for {bot_id}: {str(e)}")
-            return base_prompt
-    
+            print(f"Error restoring conversation {conversation_id}: {str(e)}")
+            messages = []
+
+        history = [{"role": m["role"], "content": m["content"]} for m in messages]
+        seq_offset = messages[0]["seq"] if messages else 0
+        return history, conversation_id, seq_offset
+
+    def start_generation(self, message: str, history: list, conversation_id: str, seq_offset: int) -> Generation:
+        """Start answering `message` as a server-side generation."""
+        if self.chat.stream_settings.mode == "cumulative":
+            # Every chunk is its own frame
+            events = self.chat.stream_events(message, history, conversation_id=conversation_id, seq_offset=seq_offset)
+        else:
+            # Delta mode: coalesced frames instead of an update per token
+            events = self.chat.stream(message, history, conversation_id=conversation_id, seq_offset=seq_offset)
+        return generations.start(
+            self.bot_id, events,
+            conversation_id=conversation_id, message=message, seq=seq_offset + len(history),
+        )
+
+    async def follow(self, generation: Generation, history: list, request: gr.Request = None):
+        """Show a generation from its start in the last message of `history`, until it finishes."""
+        # Gradio drops the generator of an abandoned event without closing it, so the
+        # reader is tracked per session and closed by detach_session instead
+        key = request.session_hash if request else None
+        response = ResponseText()
+        events = self.running.track(key, generation.attach())
+        try:
+            async for _, event in events:
+                history[-1]["content"] = response.apply(event)
+                yield history
+        finally:
+            self.running.release(key, events)
+
+    async def resume(self, history: list, conversation_id: str, seq_offset: int, generation_id: str, request: gr.Request = None):
+        """
+        Reattach a reloaded page to the generation it was showing.
+
+        Turns are saved when they finish, so a generation still running (or
+        finished but not yet written) is missing from the restored history.
+
+        Yields:
+            Tuples of (chat history, generation id)
+        """
+        generation = generations.get(generation_id)
+        if (generation is None or generation.conversation_id != conversation_id
+                or seq_offset + len(history) > generation.seq):
+            # Expired, from another conversation, or already restored from the database
+            yield history, None
+            return
+        history = history + [{"role": "user", "content": generation.message}, {"role": "assistant", "content": ""}]
+        async for history in self.follow(generation, history, request):
+            yield history, gr.skip()
+        yield history, None
+
+    async def stop_generation(self, generation_id: str, conversation_id: str) -> None:
+        """Cancel a generation of the conversation; the model call is aborted and the partial answer saved."""
+        generation = generations.get(generation_id)
+        if generation is not None and generation.conversation_id == conversation_id and generation.cancel():
+            print(f"Stopped {self.bot_id} generation {generation_id}")
+
+    async def detach_session(self, request: gr.Request = None) -> None:
+        """
+        Stop showing a generation to a browser session that went away.
+
+        The generation keeps running for its detach grace period, so a page
+        that reconnects can reattach to it.
+
+        Args:
+            request: The Gradio request of the session
+        """
+        if request is not None:
+            await self.running.cancel(request.session_hash)
+
     def get_examples(self):
         """
         Get examples from the bot configuration.
@@ -96,11 +198,7 @@ class ChatInterface:
         return self.config.get("examples", [])
         
     def create_interface(self):
-        js_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 
-                              'static', 'gradio_force_theme.js')
-        
-        with open(js_path, 'r') as f:
-            js_func = f.read()
+        js_func = load_theme_js()
         
         with gr.Blocks(css="footer{display:none !important}", theme=gr.themes.Default(), js=js_func) as chat_interface:
             with gr.Column(scale=1, min_width=600):
@@ -110,6 +208,12 @@ class ChatInterface:
                     label="Chat"
                 )
                 
+                # The conversation id survives page reloads so the chat can be resumed from the database
+                conversation_id = gr.BrowserState(None, storage_key=f"ragnode-{self.bot_id}-conversation")
+                seq_offset = gr.State(0)
+                # The generation being shown, so a page that lost its connection can reattach to it
+                generation_id = gr.BrowserState(None, storage_key=f"ragnode-{self.bot_id}-generation")
+                
                 with gr.Row():
                     with gr.Column(scale=8):
                         msg = gr.Textbox(
@@ -119,26 +223,33 @@ class ChatInterface:
                         )
                     with gr.Column(scale=1, min_width=50):
                         submit_btn = gr.Button("Send", variant="primary")
+                        stop_btn = gr.Button("Stop", variant="secondary")
                 
-                async def user(user_message, history):
+                async def user(user_message, history, generation_id, conversation_id):
+                    # A new message supersedes an answer still being generated
+                    await self.stop_generation(generation_id, conversation_id)
                     # Add user message to history and return immediately
                     return "", history + [{"role": "user", "content": user_message}]
                     
-                async def bot(history):
+                async def bot(history, conversation_id, seq_offset, request: gr.Request):
 
                     if not history:
                     # nothing for us to do
                         return
+                    # The browser state is client-controlled; restore_conversation only vetted the stored value
+                    if not valid_conversation_id(conversation_id):
+                        raise gr.Error("Invalid conversation id. Clear the chat to start a new conversation.")
                     # Get the last user message
                     user_message = history[-1]["content"]
+                    generation = self.start_generation(user_message, history[:-1], conversation_id, seq_offset)
                     
                     # Add empty assistant message that will be updated during streaming
                     history.append({"role": "assistant", "content": ""})
+                    yield history, generation.id
                     
-                    # Stream the response and update UI in real-time
-                    async for full_response in self.chat.get_response(user_message, history[:-1]):
-                        history[-1]["content"] = full_response
-                        yield history
+                    async for history in self.follow(generation, history, request):
+                        yield history, gr.skip()
+                    yield history, None
                 
                 # Add examples directly in the chat interface
                 examples = self.get_examples()
@@ -157,27 +268,49 @@ class ChatInterface:
                                 queue=False
                             ).then(
                                 fn=user,
-                                inputs=[msg, chatbot],
+                                inputs=[msg, chatbot, generation_id, conversation_id],
                                 outputs=[msg, chatbot],
                                 queue=False
                             ).then(
                                 fn=bot,
-                                inputs=[chatbot],
-                                outputs=[chatbot]
+                                inputs=[chatbot, conversation_id, seq_offset],
+                                outputs=[chatbot, generation_id]
                             )
                 
                 # Set up event handlers for regular user input
-                msg.submit(user, [msg, chatbot], [msg, chatbot], queue=False).then(
-                    bot, chatbot, chatbot
+                msg.submit(user, [msg, chatbot, generation_id, conversation_id], [msg, chatbot], queue=False).then(
+                    bot, [chatbot, conversation_id, seq_offset], [chatbot, generation_id]
                 )
-                submit_btn.click(user, [msg, chatbot], [msg, chatbot], queue=False).then(
-                    bot, chatbot, chatbot
+                submit_btn.click(user, [msg, chatbot, generation_id, conversation_id], [msg, chatbot], queue=False).then(
+                    bot, [chatbot, conversation_id, seq_offset], [chatbot, generation_id]
                 )
                 
-                # Set a timeout for websocket connections
-                if hasattr(chat_interface, '_queue'):
-                    chat_interface._queue.timeout = 120  # 2-minute timeout for idle connections
-        
+                stop_btn.click(self.stop_generation, inputs=[generation_id, conversation_id], queue=False)
+                # A closed or disconnected page stops reading; the answer is cancelled
+                # unless the page reconnects within the detach grace period
+                chat_interface.unload(self.detach_session)
+                
+                # Clearing the chat starts a new conversation
+                chatbot.clear(lambda: (str(uuid.uuid4()), 0), outputs=[conversation_id, seq_offset], queue=False)
+                
+                chat_interface.load(
+                    self.restore_conversation,
+                    inputs=[conversation_id],
+                    outputs=[chatbot, conversation_id, seq_offset]
+                ).then(
+                    self.resume,
+                    inputs=[chatbot, conversation_id, seq_offset, generation_id],
+                    outputs=[chatbot, generation_id]
+                )
+
+        # Gradio runs each event one at a time by default; concurrency is bounded by the
+        # admission scheduler instead (admission.max_concurrent in the bot config)
+        chat_interface.queue(default_concurrency_limit=None)
+
+        # Set a timeout for websocket connections; queue() replaces _queue, so this comes after it
+        if hasattr(chat_interface, '_queue'):
+            chat_interface._queue.timeout = 120  # 2-minute timeout for idle connections
+
         return chat_interface
 
 # Helper function to get all available bot configs
@@ -188,22 +321,4 @@ def get_available_bots():
     Returns:
         Dict containing bot configurations
     """
-    bots = {}
-    config_dir = Path("app/config")
-    
-    if not config_dir.exists():
-        return bots
-        
-    for config_file in config_dir.glob("*-config.yaml"):
-        try:
-            with open(config_file, 'r') as file:
-                config = yaml.safe_load(file)
-                
-                if config and "id" in config:
-                    bot_id = config["id"]
-                    bots[bot_id] = config
-                    
-        except Exception as e:
-            print(f"Error loading config from {config_file}: {str(e)}")
-            
-    return bots
\ No newline at end of file
+    return bot_registry.load()
@@ -0,0 +1,166 @@
+"""
+Bot loading for the FastAPI app.
+
+BOT_LOADING selects how the Gradio UIs are created:
+    eager   build and mount every bot at import time (the original behaviour)
+    lazy    mount a lightweight ASGI app per bot that builds its Blocks on the first request
+    warmup  like lazy, and additionally build all bots in a background task after startup
+"""
+import os
+import time
+import asyncio
+import threading
+import gradio as gr
+from contextlib import AsyncExitStack
+from typing import Dict, Optional
+from fastapi import FastAPI
+from .interface import ChatInterface
+
+BOT_LOADING = os.getenv("BOT_LOADING", "eager")
+
+# Gradio tracks the Blocks being defined in a process-wide context, so two UIs
+# must not be built at the same time in different threads
+_blocks_lock = threading.Lock()
+
+
+class BotApp:
+    """ASGI app serving one bot's Gradio UI, built on first use."""
+
+    def __init__(self, bot_id: str, chat_path: str):
+        self.bot_id = bot_id
+        self.chat_path = chat_path
+        self.state = "pending"
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+
+        self.interface: Optional[ChatInterface] = None
+        self.blocks = None
+        self.app: Optional[FastAPI] = None
+        self._lock = asyncio.Lock()
+        self._interface_lock = threading.Lock()
+        self._exit_stack: Optional[AsyncExitStack] = None
+
+    def ensure_interface(self) -> ChatInterface:
+        """Build the ChatInterface (config, system prompt, BaseChat) without any UI."""
+        # Called from the event loop (API requests) and from the build thread
+        with self._interface_lock:
+            if self.interface is None:
+                started = time.perf_counter()
+                self.interface = ChatInterface(bot_id=self.bot_id)
+                self.timings["prompt_seconds"] = round(time.perf_counter() - started, 4)
+        return self.interface
+
+    def build_blocks(self):
+        interface = self.ensure_interface()
+        started = time.perf_counter()
+        with _blocks_lock:
+            self.blocks = interface.create_interface()
+        self.timings["blocks_seconds"] = round(time.perf_counter() - started, 4)
+        return self.blocks
+
+    async def ensure_built(self) -> None:
+        if self.app is not None:
+            return
+
+        async with self._lock:
+            if self.app is not None:
+                return
+            if self.state == "error":
+                raise RuntimeError(self.error)
+
+            self.state = "building"
+            started = time.perf_counter()
+            try:
+                # Building the Blocks takes long enough to stall every other request
+                blocks = await asyncio.to_thread(self.build_blocks)
+                app = gr.mount_gradio_app(FastAPI(), blocks, path="/")
+
+                # Run the Gradio startup events (queue workers etc.) that the parent app's
+                # lifespan would have run for an eagerly mounted interface
+                self._exit_stack = AsyncExitStack()
+                await self._exit_stack.enter_async_context(app.router.lifespan_context(app))
+                self.app = app
+                self.state = "ready"
+            except Exception as e:
+                self.state = "error"
+                self.error = str(e)
+                print(f"Error building interface for {self.bot_id}: {str(e)}")
+                raise
+            finally:
+                self.timings["total_seconds"] = round(time.perf_counter() - started, 4)
+
+        print(f"Built {self.bot_id} interface in {self.timings['total_seconds']}s")
+
+    async def __call__(self, scope, receive, send):
+        await self.ensure_built()
+        await self.app(scope, receive, send)
+
+    async def close(self) -> None:
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+            self._exit_stack = None
+
+
+class BotLoader:
+    """Creates and mounts the bot UIs and reports their startup state."""
+
+    def __init__(self, bots: Dict[str, dict], mode: str = BOT_LOADING):
+        if mode not in ("eager", "lazy", "warmup"):
+            raise ValueError(f"Unknown BOT_LOADING mode: {mode}")
+        self.mode = mode
+        self.bots = {
+            bot_id: BotApp(bot_id, config.get("chat_path", f"/{bot_id}/"))
+            for bot_id, config in bots.items()
+        }
+        self.started_at = time.perf_counter()
+        self.warmup_task: Optional[asyncio.Task] = None
+
+    def mount_all(self, app: FastAPI) -> FastAPI:
+        for bot_id, bot in self.bots.items():
+            try:
+                if self.mode == "eager":
+                    app = gr.mount_gradio_app(app, bot.build_blocks(), path=bot.chat_path)
+                    bot.state = "ready"
+                else:
+                    app.mount(bot.chat_path, bot)
+                print(f"Mounted {bot_id} interface at {bot.chat_path} ({self.mode})")
+            except Exception as e:
+                bot.state = "error"
+                bot.error = str(e)
+                print(f"Error mounting interface for {bot_id}: {str(e)}")
+        return app
+
+    def get_chat(self, bot_id: str):
+        """The BaseChat of a bot, building only its prompt if the UI isn't built yet."""
+        return self.bots[bot_id].ensure_interface().chat
+
+    def start_warmup(self) -> None:
+        if self.mode == "warmup" and self.warmup_task is None:
+            self.warmup_task = asyncio.get_running_loop().create_task(self.warmup())
+
+    async def warmup(self) -> None:
+        for bot_id, bot in self.bots.items():
+            try:
+                await bot.ensure_built()
+            except Exception:
+                continue
+            # Let requests that arrived meanwhile run between bots
+            await asyncio.sleep(0)
+        print(f"All bots warm after {time.perf_counter() - self.started_at:.2f}s")
+
+    def all_warm(self) -> bool:
+        return all(bot.state == "ready" for bot in self.bots.values())
+
+    def report(self) -> Dict:
+        return {
+            "mode": self.mode,
+            "all_warm": self.all_warm(),
+            "bots": {
+                bot_id: {"state": bot.state, "error": bot.error, **bot.timings}
+                for bot_id, bot in self.bots.items()
+            },
+        }
+
+    async def close(self) -> None:
+        for bot in self.bots.values():
+            await bot.close()
@@ -0,0 +1,252 @@
+"""
+Bot registry: parsed configs and compiled system prompts, reloaded while serving.
+
+Each bot's final system prompt (base prompt + compiled knowledge) is compiled
+once and keyed by a hash of the raw config and knowledge files, so identical
+content is never re-parsed or re-serialized. A background task polls the mtimes
+of app/config and app/knowledge; when a bot's files change, the new version is
+compiled and swapped in with a single assignment. Turns already streaming keep
+the version they started with, new turns get the new one.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import yaml
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from ..knowledge.chunker import KNOWLEDGE_DIR
+from ..knowledge.compiler import compile_knowledge
+from ..tokens import estimate_tokens
+
+CONFIG_DIR = "app/config"
+# Seconds between mtime scans; 0 disables hot reloading
+REGISTRY_POLL_INTERVAL = float(os.getenv("REGISTRY_POLL_INTERVAL", "2.0"))
+# Compiled versions kept by content hash, so reverting a change is a lookup
+REGISTRY_CACHE_SIZE = int(os.getenv("REGISTRY_CACHE_SIZE", "64"))
+
+KNOWLEDGE_HEADER = "\n\nHere is additional knowledge you have:\n"
+
+
+@dataclass(frozen=True)
+class CompiledBot:
+    bot_id: str
+    config: dict
+    base_prompt: str
+    # Base prompt with the whole knowledge file appended
+    system_prompt: str
+    hash: str
+    compiled_at: float = field(default_factory=time.time)
+
+    @property
+    def size(self) -> int:
+        return len(self.system_prompt)
+
+
+def content_hash(config_bytes: bytes, knowledge_bytes: Optional[bytes]) -> str:
+    hasher = hashlib.sha256(config_bytes)
+    hasher.update(b"\0")
+    hasher.update(knowledge_bytes or b"")
+    return hasher.hexdigest()[:16]
+
+
+def compile_bot(bot_id: str, config: dict, knowledge_bytes: Optional[bytes], prompt_hash: str) -> CompiledBot:
+    """
+    Build a bot's final system prompt.
+
+    Args:
+        bot_id: ID of the bot
+        config: The parsed bot configuration
+        knowledge_bytes: Raw knowledge file, or None if the bot has none
+        prompt_hash: Content hash of the config and knowledge files
+
+    Returns:
+        CompiledBot with the base prompt and the prompt including knowledge
+    """
+    base_prompt = config.get("base_prompt", "") or ""
+    system_prompt = base_prompt
+    if knowledge_bytes is not None:
+        # Path-prefixed lines without comments, annotations or repeats (knowledge/compiler.py)
+        system_prompt = base_prompt + KNOWLEDGE_HEADER + compile_knowledge(bot_id, knowledge_bytes)
+    return CompiledBot(bot_id, config, base_prompt, system_prompt, prompt_hash)
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _read(path: str) -> Optional[bytes]:
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+class BotRegistry:
+    """Current compiled version of every bot, keyed by bot id."""
+
+    def __init__(self, config_dir: str = CONFIG_DIR, knowledge_dir: str = KNOWLEDGE_DIR,
+                 poll_interval: float = REGISTRY_POLL_INTERVAL):
+        self.config_dir = config_dir
+        self.knowledge_dir = knowledge_dir
+        self.poll_interval = poll_interval
+        self.bots: Dict[str, CompiledBot] = {}
+        self.version = 0
+        self.reloads = 0
+        self.loaded = False
+        self.errors: Dict[str, str] = {}
+
+        # config file -> bot id it declared, and that bot's (config, knowledge) mtimes at the last scan
+        self._config_bots: Dict[str, str] = {}
+        self._mtimes: Dict[str, Tuple] = {}
+        self._compiled: "OrderedDict[str, CompiledBot]" = OrderedDict()
+        self._listeners: List[Callable[[CompiledBot], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _knowledge_path(self, bot_id: str) -> str:
+        return os.path.join(self.knowledge_dir, f"{bot_id}.yaml")
+
+    def _load_file(self, config_path: str) -> Optional[CompiledBot]:
+        config_bytes = _read(config_path)
+        if config_bytes is None:
+            return None
+        config = yaml.safe_load(config_bytes)
+        if not config or "id" not in config:
+            return None
+
+        bot_id = config["id"]
+        knowledge_path = self._knowledge_path(bot_id)
+        # Stat before reading so a write racing the read is picked up by the next scan
+        self._mtimes[config_path] = (_mtime(config_path), _mtime(knowledge_path))
+        knowledge_bytes = _read(knowledge_path)
+
+        prompt_hash = content_hash(config_bytes, knowledge_bytes)
+        compiled = self._compiled.get(prompt_hash)
+        if compiled is None:
+            compiled = compile_bot(bot_id, config, knowledge_bytes, prompt_hash)
+            self._compiled[prompt_hash] = compiled
+            while len(self._compiled) > REGISTRY_CACHE_SIZE:
+                self._compiled.popitem(last=False)
+        else:
+            self._compiled.move_to_end(prompt_hash)
+        return compiled
+
+    def _install(self, compiled: CompiledBot) -> bool:
+        current = self.bots.get(compiled.bot_id)
+        if current is not None and current.hash == compiled.hash:
+            return False
+        self.bots[compiled.bot_id] = compiled
+        self.version += 1
+        for listener in list(self._listeners):
+            try:
+                listener(compiled)
+            except Exception as e:
+                print(f"Error applying new version of {compiled.bot_id}: {str(e)}")
+        return current is not None
+
+    def load(self) -> Dict[str, dict]:
+        """Compile every bot found in the config directory. Returns the configs by bot id."""
+        self.refresh()
+        self.loaded = True
+        return self.configs()
+
+    def refresh(self) -> List[str]:
+        """
+        Recompile the bots whose config or knowledge file changed since the last scan.
+
+        A file that fails to parse leaves the bot on its previous version.
+
+        Returns:
+            IDs of the bots that got a new version
+        """
+        config_paths = sorted(str(path) for path in Path(self.config_dir).glob("*-config.yaml"))
+        changed = []
+
+        for config_path in config_paths:
+            known_bot = self._config_bots.get(config_path)
+            knowledge_path = self._knowledge_path(known_bot) if known_bot else None
+            mtimes = (_mtime(config_path), _mtime(knowledge_path) if knowledge_path else None)
+            if self._mtimes.get(config_path) == mtimes:
+                continue
+
+            try:
+                compiled = self._load_file(config_path)
+            except Exception as e:
+                self._mtimes[config_path] = mtimes
+                self.errors[known_bot or config_path] = str(e)
+                print(f"Error loading config from {config_path}: {str(e)}")
+                continue
+            if compiled is None:
+                continue
+
+            self._config_bots[config_path] = compiled.bot_id
+            self.errors.pop(compiled.bot_id, None)
+            self.errors.pop(config_path, None)
+            if self._install(compiled):
+                self.reloads += 1
+                changed.append(compiled.bot_id)
+                print(f"Reloaded {compiled.bot_id}: prompt {compiled.hash} ({compiled.size} chars)")
+
+        for config_path in set(self._config_bots) - set(config_paths):
+            # Removed config: the mounted bot keeps serving its last version until restart
+            bot_id = self._config_bots.pop(config_path)
+            self._mtimes.pop(config_path, None)
+            print(f"Config for {bot_id} was removed; keeping version {self.bots[bot_id].hash} until restart")
+
+        return changed
+
+    def get(self, bot_id: str) -> Optional[CompiledBot]:
+        if not self.loaded:
+            self.load()
+        return self.bots.get(bot_id)
+
+    def configs(self) -> Dict[str, dict]:
+        return {bot_id: compiled.config for bot_id, compiled in self.bots.items()}
+
+    def subscribe(self, listener: Callable[[CompiledBot], None]) -> None:
+        """Call `listener` with every newly installed version."""
+        self._listeners.append(listener)
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error refreshing bot registry: {str(e)}")
+
+    def start(self) -> None:
+        if self.poll_interval > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.watch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def report(self) -> Dict:
+        return {
+            "poll_interval": self.poll_interval,
+            "version": self.version,
+            "reloads": self.reloads,
+            "bots": {
+                bot_id: {
+                    "hash": compiled.hash,
+                    "prompt_chars": compiled.size,
+                    "prompt_tokens": estimate_tokens(compiled.system_prompt),
+                    "compiled_at": compiled.compiled_at,
+                    "error": self.errors.get(bot_id),
+                }
+                for bot_id, compiled in self.bots.items()
+            },
+        }
+
+
+bot_registry = BotRegistry()
@@ -0,0 +1,204 @@
+"""
+Model tiering: pick a model and max_tokens for each turn before calling Bedrock.
+
+A bot's `routing` config block defines its tiers. Each turn is classified with
+cheap local heuristics (length, small talk, the bot's complex-intent keywords,
+follow-ups asking for more detail) and sent to the fast tier or the standard
+tier. When the fast tier's answer comes back empty or cut off at max_tokens,
+the turn escalates: the standard tier continues the partial answer (passed as
+an assistant prefill), so the user sees one uninterrupted answer.
+
+Decisions are kept in memory (last ROUTING_LOG_SIZE turns) with their TTFT and
+token counts, and summarized at /api/routing with the estimated cost compared
+to sending every turn to the standard tier.
+"""
+import os
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional
+
+ROUTING_LOG_SIZE = int(os.getenv("ROUTING_LOG_SIZE", "1000"))
+
+SMALL_TALK = re.compile(
+    r"^(hi|hello|hey|hallo|thanks|thank you|thx|ok|okay|cool|great|nice|perfect|bye|goodbye|"
+    r"good (morning|afternoon|evening|night))\b[\s!.?]*$",
+    re.IGNORECASE,
+)
+# Follow-ups that ask to expand the previous answer need the room of the standard tier
+MORE_DETAIL = re.compile(r"\b(more detail|in detail|elaborate|go deeper|explain (that|this|it) (further|more)|tell me more)\b", re.IGNORECASE)
+DEFAULT_COMPLEX_KEYWORDS = [
+    "step by step", "explain", "compare", "comparison", "difference between", "pros and cons",
+    "why", "plan", "strategy", "itinerary", "detailed", "in depth", "example",
+]
+
+
+@dataclass
+class ModelTier:
+    name: str
+    model: Optional[str] = None     # Bedrock model id without region prefix; None: AWS_BEDROCK_MODEL_BASE
+    max_tokens: int = 2048
+    input_cost: float = 0.0         # USD per million input tokens, for the savings estimate
+    output_cost: float = 0.0        # USD per million output tokens
+
+
+@dataclass
+class RoutingSettings:
+    enabled: bool = False
+    tiers: Dict[str, dict] = field(default_factory=dict)
+    fast_tier: str = "fast"
+    standard_tier: str = "standard"
+    fast_max_chars: int = 160           # longer messages go to the standard tier
+    complex_keywords: List[str] = field(default_factory=lambda: list(DEFAULT_COMPLEX_KEYWORDS))
+    escalate: bool = True               # continue empty or truncated fast answers on the standard tier
+
+    @classmethod
+    def from_config(cls, config: dict) -> "RoutingSettings":
+        settings = config.get("routing") or {}
+        defaults = cls()
+        return cls(**{
+            field: settings.get(field, getattr(defaults, field))
+            for field in cls.__dataclass_fields__
+        })
+
+
+@dataclass
+class RouteDecision:
+    tier: ModelTier
+    reason: str
+    # Set on the decision that continues an escalated turn: "empty" or "truncated"
+    escalated: Optional[str] = None
+
+
+class ModelRouter:
+    def __init__(self, bot_id: str, settings: RoutingSettings):
+        self.bot_id = bot_id
+        self.settings = settings
+        self.tiers = {
+            name: ModelTier(name=name, **(values or {}))
+            for name, values in settings.tiers.items()
+        }
+        self.tiers.setdefault(settings.standard_tier, ModelTier(name=settings.standard_tier))
+        self.keywords = [keyword.lower() for keyword in settings.complex_keywords]
+
+    @property
+    def standard(self) -> ModelTier:
+        return self.tiers[self.settings.standard_tier]
+
+    def classify(self, message: str, history: Optional[List[Dict]] = None) -> str:
+        """
+        Reason for routing a turn, from local heuristics only.
+
+        Returns:
+            "small_talk" or "short" for the fast tier; "long", "multi_question",
+            "complex_intent" or "more_detail" for the standard tier
+        """
+        text = message.strip()
+        if SMALL_TALK.match(text):
+            return "small_talk"
+        if len(text) > self.settings.fast_max_chars or "\n" in text:
+            return "long"
+        if text.count("?") > 1:
+            return "multi_question"
+        lowered = text.lower()
+        if any(keyword in lowered for keyword in self.keywords):
+            return "complex_intent"
+        if history and MORE_DETAIL.search(text):
+            return "more_detail"
+        return "short"
+
+    def route(self, message: str, history: Optional[List[Dict]] = None) -> RouteDecision:
+        reason = self.classify(message, history)
+        fast = self.tiers.get(self.settings.fast_tier)
+        if fast is not None and reason in ("small_talk", "short"):
+            return RouteDecision(fast, reason)
+        return RouteDecision(self.standard, reason)
+
+    def escalation(self, decision: RouteDecision, answer: str, stop_reason: Optional[str]) -> Optional[RouteDecision]:
+        """The standard-tier decision that continues a fast answer, or None if it can stand."""
+        if not self.settings.escalate or decision.tier.name == self.settings.standard_tier:
+            return None
+        if not answer.strip():
+            cause = "empty"
+        elif stop_reason == "max_tokens":
+            cause = "truncated"
+        else:
+            return None
+        return RouteDecision(self.standard, decision.reason, escalated=cause)
+
+
+def create_router(bot_id: str, config: dict) -> Optional[ModelRouter]:
+    settings = RoutingSettings.from_config(config)
+    if not settings.enabled:
+        return None
+    return ModelRouter(bot_id, settings)
+
+
+# Recent routed turns, newest last
+routing_log: Deque[Dict] = deque(maxlen=ROUTING_LOG_SIZE)
+
+
+def log_decision(router: ModelRouter, decision: RouteDecision, usage: Dict[str, Dict[str, int]],
+                 ttft: Optional[float], total: float) -> None:
+    """
+    Record a routed turn.
+
+    Args:
+        router: The bot's router
+        decision: The final decision (the escalated one if the turn escalated)
+        usage: Tokens per tier name, {"input": n, "output": n}
+        ttft: Seconds to the first answer text, None if there was none
+        total: Seconds for the whole turn
+    """
+    cost = baseline = 0.0
+    for tier_name, tokens in usage.items():
+        tier = router.tiers.get(tier_name, router.standard)
+        cost += (tokens["input"] * tier.input_cost + tokens["output"] * tier.output_cost) / 1e6
+        baseline += (tokens["input"] * router.standard.input_cost + tokens["output"] * router.standard.output_cost) / 1e6
+
+    routing_log.append({
+        "at": time.time(),
+        "bot": router.bot_id,
+        "tier": decision.tier.name if not decision.escalated else router.settings.fast_tier,
+        "reason": decision.reason,
+        "escalated": decision.escalated,
+        "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+        "total_ms": round(total * 1000, 1),
+        "usage": usage,
+        "cost_usd": round(cost, 8),
+        "baseline_cost_usd": round(baseline, 8),
+    })
+
+
+def summarize(entries: List[Dict]) -> Dict:
+    """Turns, TTFT and estimated cost per bot and tier, against an all-standard baseline."""
+    groups: Dict[str, Dict] = {}
+    for entry in entries:
+        group = groups.setdefault(f"{entry['bot']}/{entry['tier']}", {
+            "turns": 0, "escalated": 0, "ttft_ms": [], "output_tokens": 0, "cost_usd": 0.0, "baseline_cost_usd": 0.0,
+        })
+        group["turns"] += 1
+        group["escalated"] += entry["escalated"] is not None
+        if entry["ttft_ms"] is not None:
+            group["ttft_ms"].append(entry["ttft_ms"])
+        group["output_tokens"] += sum(tokens["output"] for tokens in entry["usage"].values())
+        group["cost_usd"] += entry["cost_usd"]
+        group["baseline_cost_usd"] += entry["baseline_cost_usd"]
+
+    for group in groups.values():
+        ttfts = sorted(group.pop("ttft_ms"))
+        group["ttft_p50_ms"] = ttfts[len(ttfts) // 2] if ttfts else None
+        group["ttft_mean_ms"] = round(sum(ttfts) / len(ttfts), 1) if ttfts else None
+        group["cost_usd"] = round(group["cost_usd"], 6)
+        group["baseline_cost_usd"] = round(group["baseline_cost_usd"], 6)
+
+    cost = sum(group["cost_usd"] for group in groups.values())
+    baseline = sum(group["baseline_cost_usd"] for group in groups.values())
+    return {
+        "turns": len(entries),
+        "cost_usd": round(cost, 6),
+        "baseline_cost_usd": round(baseline, 6),
+        "savings_usd": round(baseline - cost, 6),
+        "tiers": groups,
+    }
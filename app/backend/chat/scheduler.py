@@ -0,0 +1,305 @@
+"""
+Admission control in front of the model calls.
+
+Every chat turn takes a ticket before calling Bedrock. A ticket is granted when
+both its bot and the process are below their concurrency limits; otherwise it
+waits in a bounded queue. Waiting tickets are granted in weighted fair queuing
+order: each gets a virtual finish tag of max(virtual time, the bot's last tag)
++ 1 / weight, and the lowest eligible tag goes next, so a busy bot cannot
+starve the others. When a queue is full the ticket is rejected straight away
+with an estimate of when to retry.
+
+With a distributed shared state (several workers), every worker publishes its
+per-bot active counts every SCHEDULER_SYNC_INTERVAL seconds. Each bot's
+max_concurrent is then split between the live workers, and a worker never
+grants more than its share or than what the other workers leave free, so the
+limit holds across the cluster even for a burst arriving on all workers at once.
+"""
+import os
+import json
+import math
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from .client_pool import client_pool
+from ..shared_state import WORKER_ID
+
+SCHEDULER_MAX_ACTIVE = int(os.getenv("SCHEDULER_MAX_ACTIVE", str(client_pool.max_inflight)))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "256"))
+# How often per-worker active counts are exchanged in multi-worker mode
+SCHEDULER_SYNC_INTERVAL = float(os.getenv("SCHEDULER_SYNC_INTERVAL", "0.5"))
+
+# Weight of the newest sample in the moving average of how long a ticket is held
+HOLD_TIME_SMOOTHING = 0.2
+
+
+@dataclass
+class AdmissionSettings:
+    max_concurrent: int = 8     # model calls of this bot running at once
+    max_queue: int = 32         # turns of this bot waiting for a slot
+    weight: float = 1.0         # share of the capacity relative to other bots when contended
+    retry_after: int = 10       # seconds suggested on rejection until a hold time has been measured
+
+    @classmethod
+    def from_config(cls, config: dict) -> "AdmissionSettings":
+        settings = config.get("admission") or {}
+        defaults = cls()
+        return cls(**{
+            field: settings.get(field, getattr(defaults, field))
+            for field in cls.__dataclass_fields__
+        })
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, bot_id: str, retry_after: int):
+        super().__init__(f"Admission queue for {bot_id} is full; retry after {retry_after}s")
+        self.bot_id = bot_id
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, scheduler: "AdmissionScheduler", bot_id: str, tag: float):
+        self.scheduler = scheduler
+        self.bot_id = bot_id
+        self.tag = tag
+        self.state = "queued"       # queued -> active -> done
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self._granted = asyncio.Event()
+
+    @property
+    def position(self) -> int:
+        """1-based place among all waiting tickets; 0 once granted."""
+        return self.scheduler.position(self)
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the ticket to be granted."""
+        try:
+            await asyncio.wait_for(self._granted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._granted.is_set()
+
+    def release(self) -> None:
+        self.scheduler.release(self)
+
+
+class _BotState:
+    def __init__(self, settings: AdmissionSettings):
+        self.settings = settings
+        self.active = 0
+        self.waiting: List[Ticket] = []
+        self.last_tag = 0.0
+        self.hold_time: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        # Turns of this bot active on the other workers, as of the last sync
+        self.remote_active = 0
+
+    def share(self, workers: int, rank: int) -> int:
+        """This worker's part of max_concurrent when `workers` workers split it."""
+        share, remainder = divmod(self.settings.max_concurrent, workers)
+        return max(1, share + (1 if rank < remainder else 0))
+
+    def has_capacity(self, workers: int = 1, rank: int = 0) -> bool:
+        limit = min(self.share(workers, rank), self.settings.max_concurrent - self.remote_active)
+        return self.active < limit
+
+
+class AdmissionScheduler:
+    def __init__(self, max_active: int = SCHEDULER_MAX_ACTIVE, max_queue: int = SCHEDULER_MAX_QUEUE):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.virtual_time = 0.0
+        self.bots: Dict[str, _BotState] = {}
+        # Live workers sharing the limits and this worker's place among them, as of the last sync
+        self.workers = 1
+        self.rank = 0
+        self.sync_task: Optional[asyncio.Task] = None
+
+    def _bot(self, bot_id: str, settings: Optional[AdmissionSettings]) -> _BotState:
+        bot = self.bots.get(bot_id)
+        if bot is None:
+            bot = self.bots[bot_id] = _BotState(settings or AdmissionSettings())
+        elif settings is not None:
+            bot.settings = settings
+        return bot
+
+    def would_reject(self, bot_id: str, settings: AdmissionSettings = None) -> Optional[int]:
+        """Retry-after seconds if a turn for the bot would be rejected right now, else None."""
+        bot = self._bot(bot_id, settings)
+        if bot.has_capacity(self.workers, self.rank) and self.active < self.max_active:
+            return None
+        if len(bot.waiting) >= bot.settings.max_queue or self.queued >= self.max_queue:
+            return self.retry_after(bot_id)
+        return None
+
+    def enqueue(self, bot_id: str, settings: AdmissionSettings = None) -> Ticket:
+        """
+        Ask for a model call slot.
+
+        Args:
+            bot_id: Bot making the call
+            settings: The bot's limits
+
+        Returns:
+            A Ticket; wait() on it until granted, and release() it when the call is done
+
+        Raises:
+            AdmissionRejected: The bot's queue or the global queue is full
+        """
+        retry_after = self.would_reject(bot_id, settings)
+        bot = self.bots[bot_id]
+        if retry_after is not None:
+            bot.rejected += 1
+            raise AdmissionRejected(bot_id, retry_after)
+
+        bot.last_tag = max(self.virtual_time, bot.last_tag) + 1.0 / max(bot.settings.weight, 0.001)
+        ticket = Ticket(self, bot_id, bot.last_tag)
+        bot.waiting.append(ticket)
+        self.queued += 1
+        self._dispatch()
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self.active < self.max_active:
+            best: Optional[Ticket] = None
+            for bot in self.bots.values():
+                if bot.waiting and bot.has_capacity(self.workers, self.rank) and (best is None or bot.waiting[0].tag < best.tag):
+                    best = bot.waiting[0]
+            if best is None:
+                return
+
+            bot = self.bots[best.bot_id]
+            bot.waiting.pop(0)
+            self.queued -= 1
+            self.virtual_time = best.tag
+
+            bot.active += 1
+            self.active += 1
+            bot.admitted += 1
+            best.state = "active"
+            best.granted_at = time.monotonic()
+            bot.total_wait += best.granted_at - best.enqueued_at
+            best._granted.set()
+
+    def release(self, ticket: Ticket) -> None:
+        bot = self.bots[ticket.bot_id]
+        if ticket.state == "active":
+            bot.active -= 1
+            self.active -= 1
+            held = time.monotonic() - ticket.granted_at
+            if bot.hold_time is None:
+                bot.hold_time = held
+            else:
+                bot.hold_time += HOLD_TIME_SMOOTHING * (held - bot.hold_time)
+        elif ticket.state == "queued":
+            # Gave up while waiting (client went away)
+            bot.waiting.remove(ticket)
+            self.queued -= 1
+        ticket.state = "done"
+        self._dispatch()
+
+    def position(self, ticket: Ticket) -> int:
+        if ticket.state != "queued":
+            return 0
+        ahead = sum(
+            1
+            for bot in self.bots.values()
+            for other in bot.waiting
+            if other.tag < ticket.tag
+        )
+        return ahead + 1
+
+    def retry_after(self, bot_id: str) -> int:
+        """Seconds until the bot's queue has likely drained enough to accept a new turn."""
+        bot = self.bots.get(bot_id)
+        if bot is None or bot.hold_time is None:
+            return bot.settings.retry_after if bot else AdmissionSettings().retry_after
+        concurrency = max(1, min(bot.settings.max_concurrent, self.max_active))
+        return max(1, math.ceil(bot.hold_time * (len(bot.waiting) + 1) / concurrency))
+
+    async def sync(self, state) -> None:
+        """Publish this worker's active counts and take in the other workers'."""
+        counts = {bot_id: bot.active for bot_id, bot in self.bots.items() if bot.active}
+        await state.set("admission", WORKER_ID, json.dumps(counts), ttl=SCHEDULER_SYNC_INTERVAL * 4)
+
+        workers = await state.items("admission")
+        remote: Dict[str, int] = {}
+        for worker_id, payload in workers.items():
+            if worker_id == WORKER_ID:
+                continue
+            for bot_id, active in json.loads(payload).items():
+                remote[bot_id] = remote.get(bot_id, 0) + active
+
+        live = sorted(set(workers) | {WORKER_ID})
+        self.workers = len(live)
+        self.rank = live.index(WORKER_ID)
+        for bot_id, bot in self.bots.items():
+            bot.remote_active = remote.get(bot_id, 0)
+        # Slots freed on other workers may let waiting tickets through
+        self._dispatch()
+
+    async def _sync_loop(self, state) -> None:
+        while True:
+            try:
+                await self.sync(state)
+            except Exception as e:
+                print(f"Error syncing admission counts: {str(e)}")
+            await asyncio.sleep(SCHEDULER_SYNC_INTERVAL)
+
+    def start_sync(self, state) -> None:
+        if state.distributed and self.sync_task is None:
+            self.sync_task = asyncio.get_running_loop().create_task(self._sync_loop(state))
+
+    async def stop_sync(self, state) -> None:
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            await asyncio.gather(self.sync_task, return_exceptions=True)
+            self.sync_task = None
+            await state.delete("admission", WORKER_ID)
+
+    def stats(self) -> Dict:
+        return {
+            "worker": WORKER_ID,
+            "workers": self.workers,
+            "active": self.active,
+            "queued": self.queued,
+            "max_active": self.max_active,
+            "max_queue": self.max_queue,
+            "bots": {
+                bot_id: {
+                    "active": bot.active,
+                    "remote_active": bot.remote_active,
+                    "queued": len(bot.waiting),
+                    "admitted": bot.admitted,
+                    "rejected": bot.rejected,
+                    "avg_wait_seconds": round(bot.total_wait / bot.admitted, 4) if bot.admitted else 0.0,
+                    "hold_seconds": round(bot.hold_time, 4) if bot.hold_time is not None else None,
+                    "max_concurrent": bot.settings.max_concurrent,
+                    "worker_share": bot.share(self.workers, self.rank),
+                    "max_queue": bot.settings.max_queue,
+                    "weight": bot.settings.weight,
+                }
+                for bot_id, bot in self.bots.items()
+            },
+        }
+
+
+def is_throttling_error(error: Exception) -> bool:
+    """Whether Bedrock rejected the call for exceeding the account's quota."""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    text = str(error)
+    return "ThrottlingException" in text or "Too many requests" in text
+
+
+def busy_message(retry_after: int) -> str:
+    return f"This bot is handling a lot of questions right now. Please try again in {retry_after} seconds."
+
+
+scheduler = AdmissionScheduler()
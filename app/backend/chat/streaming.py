@@ -0,0 +1,220 @@
+import asyncio
+import weakref
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, AsyncIterator, Dict, Optional, Tuple
+
+
+@dataclass
+class StreamEvent:
+    # "status": transient placeholder shown until the answer starts (e.g. "Thinking...")
+    # "delta":  text to append to the answer
+    # "replace": the whole answer is this text (errors, fallback responses)
+    kind: str
+    text: str
+    # Set on "replace" events that turn the user away because the bot is busy
+    retry_after: Optional[int] = None
+
+
+@dataclass
+class StreamSettings:
+    mode: str = "delta"             # "delta" or "cumulative"
+    frame_interval_ms: int = 30     # coalesce deltas arriving within this window into one frame
+    frame_max_bytes: int = 1024     # emit a frame early once this many bytes are buffered
+
+    @classmethod
+    def from_config(cls, config: dict) -> "StreamSettings":
+        settings = config.get("streaming") or {}
+        defaults = cls()
+        return cls(
+            mode=settings.get("mode", defaults.mode),
+            frame_interval_ms=settings.get("frame_interval_ms", defaults.frame_interval_ms),
+            frame_max_bytes=settings.get("frame_max_bytes", defaults.frame_max_bytes),
+        )
+
+
+class ResponseText:
+    """Applies stream events to the text shown for an answer."""
+
+    def __init__(self):
+        self.text = ""
+        self.showing_status = False
+
+    def apply(self, event: StreamEvent) -> str:
+        if event.kind == "delta":
+            if self.showing_status:
+                self.text = ""
+                self.showing_status = False
+            self.text += event.text
+        elif event.kind == "status":
+            self.text = event.text
+            self.showing_status = True
+        else:
+            self.text = event.text
+            self.showing_status = False
+        return self.text
+
+
+@dataclass
+class StreamStats:
+    mode: str
+    frames: int = 0
+    bytes_sent: int = 0
+    # What the same frames would have cost if each carried the full response so far
+    cumulative_bytes: int = 0
+    response: ResponseText = field(default_factory=ResponseText)
+
+    def record(self, event: StreamEvent) -> None:
+        text = self.response.apply(event)
+        size = len(text.encode("utf-8"))
+        self.frames += 1
+        self.cumulative_bytes += size
+        if self.mode == "delta":
+            self.bytes_sent += len(event.text.encode("utf-8"))
+        else:
+            self.bytes_sent += size
+
+    def summary(self) -> str:
+        return (f"{self.frames} frames, {self.bytes_sent} bytes sent "
+                f"({self.cumulative_bytes} bytes as cumulative frames)")
+
+
+async def coalesce(
+    events: AsyncIterator[StreamEvent],
+    interval: float,
+    max_bytes: int,
+) -> AsyncGenerator[StreamEvent, None]:
+    """
+    Merge consecutive deltas into frames.
+
+    The first delta is passed through immediately so time-to-first-token is
+    not delayed. After that, deltas are buffered until `interval` seconds have
+    passed since the first buffered one or `max_bytes` are buffered. Status
+    and replace events flush the buffer and pass through unchanged.
+
+    Args:
+        events: Source of stream events
+        interval: Maximum time a delta waits in the buffer
+        max_bytes: Buffer size that triggers an early frame
+
+    Yields:
+        Coalesced stream events
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    pending = ""
+    deadline = 0.0
+    first_delta_sent = False
+    next_event: Optional[asyncio.Future] = None
+
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = max(0.0, deadline - loop.time()) if pending else None
+            done, _ = await asyncio.wait({next_event}, timeout=timeout)
+            if not done:
+                yield StreamEvent("delta", pending)
+                pending = ""
+                continue
+
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_event = None
+
+            if event.kind != "delta":
+                if pending:
+                    yield StreamEvent("delta", pending)
+                    pending = ""
+                yield event
+                continue
+
+            if not first_delta_sent:
+                first_delta_sent = True
+                yield event
+                continue
+
+            if not pending:
+                deadline = loop.time() + interval
+            pending += event.text
+            if len(pending.encode("utf-8")) >= max_bytes:
+                yield StreamEvent("delta", pending)
+                pending = ""
+
+        if pending:
+            yield StreamEvent("delta", pending)
+    finally:
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+async def until_cancelled(events: AsyncIterator, cancelled: asyncio.Event) -> AsyncGenerator:
+    """Pass events through until the source ends or `cancelled` is set, then close the source."""
+    iterator = events.__aiter__()
+    cancel_wait = asyncio.ensure_future(cancelled.wait())
+    next_event: Optional[asyncio.Future] = None
+    try:
+        while True:
+            next_event = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({next_event, cancel_wait}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_event.done():
+                return
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                if next_event.done():
+                    next_event = None
+            yield event
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+        cancel_wait.cancel()
+        await iterator.aclose()
+
+
+class RunningStreams:
+    """
+    The stream each key (a browser session) is currently reading, so it can be
+    closed from outside when the session disconnects.
+
+    Gradio drops an abandoned generator between frames without closing it; until
+    it is garbage collected it would keep what it reads from open. Streams are
+    held weakly, so an untracked end still leaves them to the garbage collector.
+    """
+
+    def __init__(self):
+        self.running: Dict[str, Tuple[asyncio.Event, "weakref.ref"]] = {}
+
+    def track(self, key: Optional[str], events: AsyncIterator) -> AsyncIterator:
+        if key is None:
+            return events
+        cancelled = asyncio.Event()
+        stream = until_cancelled(events, cancelled)
+        self.running[key] = (cancelled, weakref.ref(stream))
+        return stream
+
+    def release(self, key: Optional[str], stream: AsyncIterator) -> None:
+        entry = self.running.get(key)
+        if entry is not None and entry[1]() is stream:
+            del self.running[key]
+
+    async def cancel(self, key: Optional[str]) -> bool:
+        """Stop the stream running for `key`. Returns False if there was none."""
+        entry = self.running.pop(key, None)
+        stream = entry[1]() if entry else None
+        if stream is None:
+            return False
+        entry[0].set()
+        if not stream.ag_running:
+            # Parked between frames with nobody left to pull it: close it here
+            await stream.aclose()
+        return True
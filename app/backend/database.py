@@ -1,17 +1,62 @@
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.ext.asyncio import async_sessionmaker
 import os
+import asyncio
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DATABASE_URL = f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_ENDPOINT')}/{os.getenv('DB_NAME')}"
+# DATABASE_URL overrides the Postgres settings, e.g. sqlite+aiosqlite:///bench.db for local benchmarks
+DATABASE_URL = os.getenv("DATABASE_URL") or f"postgresql+asyncpg://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_ENDPOINT')}/{os.getenv('DB_NAME')}"
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+# Statement logging is expensive on the hot path; enable it only for debugging
+engine = create_async_engine(DATABASE_URL, echo=os.getenv("DB_ECHO", "false").lower() == "true")
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 async def get_session() -> AsyncSession:
     async with async_session() as session:
-        yield session
\ No newline at end of file
+        yield session
+
+# create_all only creates missing tables; columns added to existing tables go here
+MIGRATIONS = [
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS conversation_id VARCHAR(36) REFERENCES conversations (id)",
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS bot_id VARCHAR",
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS seq INTEGER",
+    "ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS status VARCHAR",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_conversation_seq ON chat_messages (conversation_id, seq)",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_bot_timestamp ON chat_messages (bot_id, timestamp)",
+]
+
+async def init_db() -> None:
+    """Create the pgvector extension, any missing tables and columns, and this month's partitions."""
+    from . import models  # noqa: F401 - registers the tables on Base.metadata
+
+    async with engine.begin() as conn:
+        if engine.dialect.name != "postgresql":
+            # Stand-in databases (SQLite) start empty, so create_all covers every column
+            await conn.run_sync(Base.metadata.create_all)
+            return
+        from .retention import MESSAGE_EMBEDDING_DDL, RETENTION_LOCK, create_message_table, ensure_partitions
+        from .shared_state import lock_transaction
+
+        # Workers starting together would create the same tables and partitions; the lock is
+        # the retention job's, which creates partitions too
+        await lock_transaction(conn, RETENTION_LOCK)
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        # chat_messages is partitioned by month, which create_all cannot express
+        tables = [table for table in Base.metadata.sorted_tables if table.name != "chat_messages"]
+        await conn.run_sync(Base.metadata.create_all, tables=tables)
+        await create_message_table(conn)
+        for statement in MIGRATIONS + MESSAGE_EMBEDDING_DDL:
+            await conn.execute(text(statement))
+        await ensure_partitions(conn)
+
+if __name__ == "__main__":
+    # python -m app.backend.database
+    # Run the package module's init_db: under -m this file is __main__, and the models
+    # register their tables on app.backend.database.Base, not on this module's copy
+    from app.backend.database import init_db as package_init_db
+    asyncio.run(package_init_db())
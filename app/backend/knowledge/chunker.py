@@ -0,0 +1,126 @@
+import os
+import hashlib
+import yaml
+from dataclasses import dataclass
+from typing import Any, List, Optional
+from ..tokens import estimate_tokens
+
+KNOWLEDGE_DIR = "app/knowledge"
+
+# Upper bound for a single chunk. Subtrees larger than this are split along
+# their children; leaves larger than this are kept whole.
+DEFAULT_CHUNK_TOKENS = 350
+
+
+@dataclass
+class Chunk:
+    bot_id: str
+    path: str
+    content: str
+    token_count: int
+
+    @property
+    def content_hash(self) -> str:
+        return hashlib.sha256(f"{self.path}\n{self.content}".encode("utf-8")).hexdigest()
+
+
+def knowledge_file_path(bot_id: str) -> str:
+    return os.path.join(KNOWLEDGE_DIR, f"{bot_id}.yaml")
+
+
+def load_knowledge(bot_id: str) -> Optional[Any]:
+    """
+    Load the parsed knowledge file for a bot.
+
+    Args:
+        bot_id: ID of the bot
+
+    Returns:
+        Parsed YAML data, or None if the bot has no knowledge file
+    """
+    path = knowledge_file_path(bot_id)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def _dump(node: Any) -> str:
+    return yaml.dump(node, default_flow_style=False, allow_unicode=True, sort_keys=False).strip()
+
+
+def _make_chunk(bot_id: str, path: List[str], node: Any) -> Chunk:
+    label = " > ".join(path) if path else "root"
+    content = f"{label}:\n{_dump(node)}"
+    return Chunk(bot_id=bot_id, path=label, content=content, token_count=estimate_tokens(content))
+
+
+def _split(bot_id: str, path: List[str], node: Any, max_tokens: int) -> List[Chunk]:
+    chunk = _make_chunk(bot_id, path, node)
+    if chunk.token_count <= max_tokens:
+        return [chunk]
+
+    if isinstance(node, dict):
+        chunks = []
+        for key, value in node.items():
+            chunks.extend(_split(bot_id, path + [str(key)], value, max_tokens))
+        return chunks
+
+    if isinstance(node, list):
+        # Prefer an item's own name for its label so retrieved chunks stay readable
+        chunks = []
+        for index, item in enumerate(node):
+            name = None
+            if isinstance(item, dict):
+                name = item.get("id") or item.get("name") or item.get("civ")
+            label = f"{index}:{name}" if name else str(index)
+            chunks.extend(_split(bot_id, path + [label], item, max_tokens))
+        return _merge_small(chunks, max_tokens)
+
+    return [chunk]
+
+
+def _merge_small(chunks: List[Chunk], max_tokens: int) -> List[Chunk]:
+    """Pack consecutive small list items together so we don't emit one chunk per scalar."""
+    merged: List[Chunk] = []
+    for chunk in chunks:
+        if merged and merged[-1].token_count + chunk.token_count <= max_tokens:
+            last = merged[-1]
+            content = f"{last.content}\n{chunk.content}"
+            merged[-1] = Chunk(
+                bot_id=last.bot_id,
+                path=last.path,
+                content=content,
+                token_count=estimate_tokens(content),
+            )
+        else:
+            merged.append(chunk)
+    return merged
+
+
+def chunk_knowledge(bot_id: str, data: Any, max_tokens: int = DEFAULT_CHUNK_TOKENS) -> List[Chunk]:
+    """
+    Split a knowledge tree into chunks along its key hierarchy.
+
+    Each chunk carries the path of keys that leads to it, so a retrieved chunk
+    still tells the model where the information came from.
+
+    Args:
+        bot_id: ID of the bot the knowledge belongs to
+        data: Parsed knowledge YAML
+        max_tokens: Approximate upper bound for a chunk
+
+    Returns:
+        List of chunks in document order
+    """
+    if data is None:
+        return []
+
+    if isinstance(data, dict):
+        chunks = []
+        for key, value in data.items():
+            chunks.extend(_split(bot_id, [str(key)], value, max_tokens))
+        return chunks
+
+    return _split(bot_id, [], data, max_tokens)
@@ -0,0 +1,351 @@
+"""
+Compile a knowledge file into the compact text appended to a bot's prompt.
+
+The knowledge is sent with every turn that has no retrieval, so every byte of
+it is paid for in input tokens. Instead of re-dumping the parsed YAML (which
+re-indents everything and escapes non-ASCII text), the compiler emits one
+line per fact, prefixed with its key path:
+
+    festivals.badenfahrt: rhythm=every 10 years; next_edition=2033
+    attractions.old_town: Car-free alleys lined with pastel guild houses, ...
+    build_orders[1RA].steps[0]: v=6; eco=W0 F6(S) G0 S0; do=2H, 6S
+
+- Comments are dropped by the YAML parser; citation markers left in values
+  (":contentReference[oaicite:0]{index=0}" and the like) are stripped.
+- Mappings of short scalar values are written on a single line.
+- List items are addressed by their "id" or "name" when they have one; a
+  named item with a single other field is written as "[name]: value", one
+  with no other field as a bare "name" line.
+- Repeated long strings are written once and referenced by path afterwards;
+  repeated lines and list entries are dropped.
+
+Compiled text is cached per bot in KNOWLEDGE_COMPILED_DIR, keyed by a hash of
+the knowledge file, so workers only compile a file once per change. `report`
+exits 1 if a value of a knowledge file is missing from its compiled text,
+which would be a compiler bug.
+
+Usage:
+    python -m app.backend.knowledge.compiler report [--json] [--max-tokens N]
+    python -m app.backend.knowledge.compiler show baden-guide
+"""
+import os
+import re
+import sys
+import json
+import hashlib
+import datetime
+import yaml
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from .chunker import KNOWLEDGE_DIR
+from ..tokens import estimate_tokens
+
+COMPILED_DIR = os.getenv("KNOWLEDGE_COMPILED_DIR", "app/knowledge/.compiled")
+# "compact" (this module) or "yaml" (the parsed file dumped back to YAML)
+KNOWLEDGE_FORMAT = os.getenv("KNOWLEDGE_FORMAT", "compact")
+# Bumped whenever the output format changes, so cached artifacts are rebuilt
+COMPILER_VERSION = 2
+
+# Mappings of scalars are put on one line while the line stays this short
+RECORD_MAX_CHARS = 160
+LIST_SEPARATOR = " | "
+# Strings at least this long are written once and referenced by path afterwards
+DEDUPE_MIN_CHARS = 48
+
+ANNOTATION_PATTERNS = [
+    re.compile(r":?contentReference\[oaicite:\d+\](\{index=\d+\})?"),
+    re.compile(r"\[oaicite:\d+\]"),
+    re.compile(r"【\d+(:\d+)?†[^】]*】"),
+]
+WHITESPACE = re.compile(r"\s+")
+
+
+def clean(value: str) -> str:
+    """Strip citation markers and fold whitespace (including newlines) to single spaces."""
+    for pattern in ANNOTATION_PATTERNS:
+        value = pattern.sub("", value)
+    return WHITESPACE.sub(" ", value).strip()
+
+
+def _scalar(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return clean(str(value))
+
+
+def _is_scalar(value: Any) -> bool:
+    return not isinstance(value, (dict, list))
+
+
+def _is_scalar_list(value: Any) -> bool:
+    return isinstance(value, list) and all(_is_scalar(item) for item in value)
+
+
+def _unique(values: List[str]) -> List[str]:
+    return list(dict.fromkeys(value for value in values if value))
+
+
+def _item_key(item: Any) -> Optional[str]:
+    if isinstance(item, dict):
+        for key in ("id", "name"):
+            if _is_scalar(item.get(key)) and item.get(key) is not None:
+                return key
+    return None
+
+
+def _join(path: Tuple[str, ...]) -> str:
+    return "".join(segment if segment.startswith("[") or index == 0 else f".{segment}"
+                   for index, segment in enumerate(path))
+
+
+class _Compiler:
+    def __init__(self):
+        self.lines: List[str] = []
+        self.section: Optional[Tuple[str, ...]] = None
+        self.seen = set()
+        self.first_path: Dict[str, str] = {}
+
+    def emit(self, path: Tuple[str, ...], body: str) -> None:
+        if not body or (path, body) in self.seen:
+            return
+        self.seen.add((path, body))
+        # Lines are grouped under a [parent.path] header, so each one carries only its last key
+        parent, key = path[:-1], path[-1] if path else ""
+        if parent != self.section:
+            self.lines.append(f"[{_join(parent)}]" if parent else "")
+            self.section = parent
+        self.lines.append(f"{key}: {body}" if key else body)
+
+    def value(self, path: Tuple[str, ...], value: Any) -> str:
+        text = _scalar(value)
+        if len(text) < DEDUPE_MIN_CHARS:
+            return text
+        first = self.first_path.setdefault(text, _join(path))
+        return text if first == _join(path) else f"(same as {first})"
+
+    def record(self, path: Tuple[str, ...], node: dict) -> Optional[str]:
+        """One-line body for a mapping of scalars, or None if it does not fit."""
+        parts = []
+        for key, value in node.items():
+            if value is None:
+                continue
+            if isinstance(value, list):
+                value = ", ".join(_unique([_scalar(item) for item in value if item is not None]))
+            else:
+                value = _scalar(value)
+            parts.append(f"{key}={value}")
+        body = "; ".join(parts)
+        if len(body) > RECORD_MAX_CHARS:
+            return None
+        # Register the record's long strings so later repeats can point here
+        for key, value in node.items():
+            if _is_scalar(value) and value is not None:
+                self.value(path + (str(key),), value)
+        return body
+
+    def node(self, path: Tuple[str, ...], node: Any) -> None:
+        if node is None:
+            return
+        if _is_scalar(node):
+            self.emit(path, self.value(path, node))
+        elif isinstance(node, dict):
+            if path and all(_is_scalar(value) or _is_scalar_list(value) for value in node.values()):
+                body = self.record(path, node)
+                if body is not None:
+                    self.emit(path, body)
+                    return
+            # Leaves first, so the mapping's own lines share one section header
+            items = sorted(node.items(), key=lambda item: not (_is_scalar(item[1]) or _is_scalar_list(item[1])))
+            for key, value in items:
+                self.node(path + (str(key),), value)
+        elif _is_scalar_list(node):
+            self.emit(path, LIST_SEPARATOR.join(_unique([self.value(path, item) for item in node if item is not None])))
+        else:
+            for index, item in enumerate(node):
+                key = _item_key(item)
+                if key is None:
+                    self.node(path + (f"[{index}]",), item)
+                else:
+                    rest = {name: value for name, value in item.items() if name != key and value is not None}
+                    if not rest:
+                        # Nothing but the id or name: that is the entry, a bare line in the list's section
+                        self.emit(path + ("",), self.value(path, item[key]))
+                        continue
+                    if len(rest) == 1:
+                        # "- name: X / description: Y" needs no field name: [X]: Y
+                        [rest] = rest.values()
+                    self.node(path + (f"[{clean(str(item[key]))}]",), rest)
+
+
+def compile_knowledge_data(data: Any) -> str:
+    """
+    Compile parsed knowledge into path-prefixed lines.
+
+    Args:
+        data: Parsed knowledge file
+
+    Returns:
+        The compiled text, one fact per line
+    """
+    compiler = _Compiler()
+    compiler.node((), data)
+    return "\n".join(compiler.lines).strip()
+
+
+def _leaves(node: Any):
+    if isinstance(node, dict):
+        for value in node.values():
+            yield from _leaves(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from _leaves(item)
+    elif node is not None:
+        yield node
+
+
+def missing_leaves(data: Any, text: str) -> List[str]:
+    """Scalar values of the parsed knowledge that do not appear in its compiled text."""
+    return _unique([value for value in map(_scalar, _leaves(data)) if value not in text])
+
+
+def dump_yaml(data: Any) -> str:
+    # The format knowledge was appended in before this compiler
+    return yaml.dump(data, default_flow_style=False)
+
+
+def source_hash(knowledge_bytes: bytes) -> str:
+    hasher = hashlib.sha256(knowledge_bytes)
+    hasher.update(f"\0{COMPILER_VERSION}".encode())
+    return hasher.hexdigest()[:16]
+
+
+def _artifact_paths(bot_id: str, compiled_dir: str):
+    directory = Path(compiled_dir)
+    return directory / f"{bot_id}.txt", directory / f"{bot_id}.json"
+
+
+def compile_knowledge(bot_id: str, knowledge_bytes: bytes, compiled_dir: str = COMPILED_DIR,
+                      knowledge_format: str = KNOWLEDGE_FORMAT) -> str:
+    """
+    The knowledge text for a bot's prompt, from the cached artifact when it is current.
+
+    Args:
+        bot_id: ID of the bot
+        knowledge_bytes: Raw knowledge file
+        compiled_dir: Directory of the cached artifacts
+        knowledge_format: "compact", or "yaml" for the parsed file dumped back to YAML
+
+    Returns:
+        The knowledge text
+    """
+    if knowledge_format == "yaml":
+        return dump_yaml(yaml.safe_load(knowledge_bytes))
+
+    digest = source_hash(knowledge_bytes)
+    text_path, manifest_path = _artifact_paths(bot_id, compiled_dir)
+    try:
+        with open(manifest_path, 'r') as file:
+            if json.load(file).get("hash") == digest:
+                with open(text_path, 'r', encoding="utf-8") as text_file:
+                    return text_file.read()
+    except (OSError, ValueError):
+        pass
+
+    text = compile_knowledge_data(yaml.safe_load(knowledge_bytes))
+    try:
+        _save_artifact(bot_id, knowledge_bytes, text, digest, text_path, manifest_path)
+    except OSError as e:
+        print(f"Error caching compiled knowledge for {bot_id}: {str(e)}")
+    return text
+
+
+def _save_artifact(bot_id: str, knowledge_bytes: bytes, text: str, digest: str, text_path: Path, manifest_path: Path) -> None:
+    text_path.parent.mkdir(parents=True, exist_ok=True)
+    manifest = {
+        "bot_id": bot_id,
+        "hash": digest,
+        "compiler_version": COMPILER_VERSION,
+        "raw_chars": len(knowledge_bytes.decode("utf-8", errors="replace")),
+        "compiled_chars": len(text),
+        "compiled_tokens": estimate_tokens(text),
+    }
+    # Text first, manifest last: a reader never sees a manifest for text that is not there yet
+    for path, content in ((text_path, text), (manifest_path, json.dumps(manifest, indent=2))):
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding="utf-8") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+
+def report(knowledge_dir: str = KNOWLEDGE_DIR) -> List[Dict]:
+    """Raw, YAML-dumped and compiled size of every bot's knowledge."""
+    from ..chat.registry import bot_registry
+
+    bot_registry.load()
+    rows = []
+    for path in sorted(Path(knowledge_dir).glob("*.yaml")):
+        bot_id = path.stem
+        raw = path.read_bytes()
+        raw_text = raw.decode("utf-8", errors="replace")
+        dumped = dump_yaml(yaml.safe_load(raw))
+        compiled = compile_knowledge(bot_id, raw)
+        missing = missing_leaves(yaml.safe_load(raw), compiled)
+        bot = bot_registry.bots.get(bot_id)
+        rows.append({
+            "bot_id": bot_id,
+            "raw_chars": len(raw_text),
+            "raw_tokens": estimate_tokens(raw_text),
+            "yaml_tokens": estimate_tokens(dumped),
+            "compiled_chars": len(compiled),
+            "compiled_tokens": estimate_tokens(compiled),
+            "saved_pct": round(100 * (1 - len(compiled) / len(dumped)), 1) if dumped else 0.0,
+            # Values the compiler lost; should always be empty
+            "missing": missing,
+            # What a turn without retrieval sends as system prompt
+            "prompt_tokens": estimate_tokens(bot.system_prompt) if bot else None,
+        })
+    return rows
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compile knowledge files and report their prompt size")
+    parser.add_argument("command", choices=["report", "show"])
+    parser.add_argument("bot_id", nargs="?")
+    parser.add_argument("--json", action="store_true", help="report: print JSON, e.g. to keep per build")
+    parser.add_argument("--max-tokens", type=int, help="report: exit 1 if a bot's prompt is over this many tokens")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        if not args.bot_id:
+            parser.error("show needs a bot id")
+        path = Path(KNOWLEDGE_DIR) / f"{args.bot_id}.yaml"
+        print(compile_knowledge(args.bot_id, path.read_bytes()))
+        return
+
+    rows = report()
+    if args.json:
+        print(json.dumps({"generated_at": datetime.datetime.utcnow().isoformat(), "bots": rows}, indent=2))
+    else:
+        print(f"{'bot':<18} {'raw':>9} {'yaml dump':>11} {'compiled':>10} {'saved':>7} {'prompt':>8}")
+        for row in rows:
+            print(f"{row['bot_id']:<18} {row['raw_tokens']:>9} {row['yaml_tokens']:>11} {row['compiled_tokens']:>10} "
+                  f"{row['saved_pct']:>6}% {row['prompt_tokens'] or '-':>8}")
+        print("(approximate tokens; prompt is the system prompt sent without retrieval)")
+
+    for row in rows:
+        if row["missing"]:
+            print(f"{row['bot_id']}: {len(row['missing'])} values missing from the compiled text, "
+                  f"e.g. {row['missing'][0]!r}", file=sys.stderr)
+    over = [row["bot_id"] for row in rows if args.max_tokens and (row["prompt_tokens"] or 0) > args.max_tokens]
+    if over:
+        print(f"Over {args.max_tokens} prompt tokens: {', '.join(over)}", file=sys.stderr)
+    if over or any(row["missing"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
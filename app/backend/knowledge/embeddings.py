@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import zlib
+import asyncio
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import List
+from dotenv import load_dotenv
+
+if not os.getenv("AWS_BEDROCK_ACCESS_KEY"):
+    load_dotenv()
+
+# Must match the dimension of the pgvector columns in models.py
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "1024"))
+
+
+class Embedder(ABC):
+    """Turns text into fixed-size vectors."""
+
+    name = "base"
+    dim = EMBEDDING_DIM
+
+    @abstractmethod
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.embed, texts)
+
+
+class BedrockEmbedder(Embedder):
+    """Amazon Titan text embeddings through the Bedrock runtime."""
+
+    def __init__(self, model_id: str = None, dim: int = EMBEDDING_DIM):
+        self.model_id = model_id or os.getenv("AWS_BEDROCK_EMBEDDING_MODEL", "amazon.titan-embed-text-v2:0")
+        self.name = f"bedrock:{self.model_id}"
+        self.dim = dim
+        self.client = None
+
+    def get_client(self):
+        if self.client is None:
+            import boto3
+
+            self.client = boto3.client(
+                "bedrock-runtime",
+                aws_access_key_id=os.getenv("AWS_BEDROCK_ACCESS_KEY"),
+                aws_secret_access_key=os.getenv("AWS_BEDROCK_SECRET_KEY"),
+                region_name=os.getenv("AWS_BEDROCK_REGION"),
+            )
+        return self.client
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        client = self.get_client()
+        vectors = []
+        # Titan embeds a single input per call
+        for text in texts:
+            response = client.invoke_model(
+                modelId=self.model_id,
+                body=json.dumps({"inputText": text, "dimensions": self.dim, "normalize": True}),
+            )
+            payload = json.loads(response["body"].read())
+            vectors.append(payload["embedding"])
+        return vectors
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic, CPU-only stand-in for a real embedding model.
+
+    Words and character trigrams are hashed into a fixed number of signed
+    buckets and the result is L2-normalized. Similar wording gives similar
+    vectors, which is enough for offline builds and tests.
+    """
+
+    TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.name = f"hashing:{dim}"
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = self.TOKEN_PATTERN.findall(text.lower())
+        features = list(words)
+        for word in words:
+            padded = f"#{word}#"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                vectors[row, digest % self.dim] += sign
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        # Cheap enough to run inline
+        return self.embed(texts)
+
+
+_embedder = None
+
+
+def get_embedder() -> Embedder:
+    """
+    Return the process-wide embedder.
+
+    Returns:
+        Embedder instance shared by ingestion and retrieval
+    """
+    global _embedder
+    if _embedder is None:
+        backend = os.getenv("EMBEDDING_BACKEND", "bedrock")
+        if backend == "hashing":
+            _embedder = HashingEmbedder()
+        else:
+            _embedder = BedrockEmbedder()
+    return _embedder
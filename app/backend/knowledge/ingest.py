@@ -0,0 +1,80 @@
+"""
+Chunk and embed the knowledge files into the knowledge_chunks table.
+
+Usage:
+    python -m app.backend.knowledge.ingest              # all bots
+    python -m app.backend.knowledge.ingest baden-guide  # selected bots
+
+Only chunks whose content hash changed are re-embedded; chunks that no longer
+exist in the YAML are deleted.
+"""
+import sys
+import asyncio
+from pathlib import Path
+from typing import List
+from sqlalchemy import delete, select
+from ..database import async_session, init_db
+from ..models import KnowledgeChunk
+from .chunker import KNOWLEDGE_DIR, chunk_knowledge, load_knowledge
+from .embeddings import get_embedder
+
+EMBED_BATCH_SIZE = 16
+
+
+async def ingest_bot(bot_id: str) -> None:
+    chunks = chunk_knowledge(bot_id, load_knowledge(bot_id))
+    wanted = {chunk.content_hash: chunk for chunk in chunks}
+
+    async with async_session() as session:
+        result = await session.execute(
+            select(KnowledgeChunk.content_hash).where(KnowledgeChunk.bot_id == bot_id)
+        )
+        existing = set(result.scalars().all())
+
+        stale = existing - wanted.keys()
+        if stale:
+            await session.execute(
+                delete(KnowledgeChunk).where(
+                    KnowledgeChunk.bot_id == bot_id,
+                    KnowledgeChunk.content_hash.in_(stale),
+                )
+            )
+
+        new_chunks = [chunk for digest, chunk in wanted.items() if digest not in existing]
+        embedder = get_embedder()
+        for start in range(0, len(new_chunks), EMBED_BATCH_SIZE):
+            batch = new_chunks[start:start + EMBED_BATCH_SIZE]
+            vectors = await embedder.aembed([chunk.content for chunk in batch])
+            session.add_all([
+                KnowledgeChunk(
+                    bot_id=bot_id,
+                    path=chunk.path,
+                    content=chunk.content,
+                    content_hash=chunk.content_hash,
+                    token_count=chunk.token_count,
+                    embedding=vector,
+                )
+                for chunk, vector in zip(batch, vectors)
+            ])
+
+        await session.commit()
+
+    print(f"Ingested {bot_id}: {len(chunks)} chunks ({len(new_chunks)} embedded, {len(stale)} removed)")
+
+
+async def ingest(bot_ids: List[str]) -> None:
+    await init_db()
+    for bot_id in bot_ids:
+        try:
+            await ingest_bot(bot_id)
+        except Exception as e:
+            print(f"Error ingesting knowledge for {bot_id}: {str(e)}")
+
+
+def main() -> None:
+    bot_ids = sys.argv[1:] or sorted(path.stem for path in Path(KNOWLEDGE_DIR).glob("*.yaml"))
+    asyncio.run(ingest(bot_ids))
+
+
+if __name__ == "__main__":
+    main()
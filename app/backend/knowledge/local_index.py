@@ -0,0 +1,306 @@
+"""
+In-process vector index for deployments without Postgres.
+
+Each bot gets a directory under KNOWLEDGE_INDEX_DIR with one subdirectory
+per build, holding:
+    embeddings.npy  float32 (n_chunks, dim), opened with mmap_mode="r" so all
+                    worker processes share the same page-cache pages
+    chunks.json     chunk metadata in row order
+    centroids.npy   IVF centroids (only for corpora above ivf_min_size)
+    lists.npy       IVF list id per row
+    manifest.json   knowledge file hash, embedder name and IVF settings the
+                    index was built with
+
+A build writes a new version directory and then swaps the CURRENT file, which
+names it, with os.replace, so another process reads either the old build or
+the new one, never a mix. In memory the loaded files form one immutable
+IndexSnapshot, replaced by a single assignment, so a search that runs during
+a reload scores one build throughout. The previous version is kept for
+readers that picked it up just before the swap.
+
+Usage:
+    python -m app.backend.knowledge.local_index [bot_id ...]
+"""
+import os
+import sys
+import json
+import hashlib
+import time
+import shutil
+import threading
+import numpy as np
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from .chunker import KNOWLEDGE_DIR, Chunk, chunk_knowledge, knowledge_file_path, load_knowledge
+from .embeddings import Embedder, get_embedder
+
+INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", "app/knowledge/.index")
+# Names the version directory of the current build
+POINTER_FILE = "CURRENT"
+# Files of the unversioned layout, removed by the next build
+LEGACY_FILES = ("embeddings.npy", "chunks.json", "centroids.npy", "lists.npy", "manifest.json")
+
+# Corpora smaller than this are searched exhaustively
+DEFAULT_IVF_MIN_SIZE = 2048
+DEFAULT_NPROBE = 4
+KMEANS_ITERATIONS = 10
+
+
+def file_hash(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def _save_json(path: Path, data) -> None:
+    with open(path, 'w') as file:
+        json.dump(data, file, ensure_ascii=False)
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = KMEANS_ITERATIONS) -> np.ndarray:
+    """
+    Spherical k-means with a fixed seed so rebuilds are reproducible.
+
+    Args:
+        vectors: L2-normalized float32 matrix
+        n_clusters: Number of centroids
+        iterations: Lloyd iterations
+
+    Returns:
+        Normalized centroid matrix of shape (n_clusters, dim)
+    """
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for cluster in range(n_clusters):
+            members = vectors[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids /= norms
+    return centroids.astype(np.float32)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+@dataclass(frozen=True)
+class IndexSnapshot:
+    """The files of one build, loaded together; searched as a unit and never mutated."""
+    version: str
+    embeddings: np.ndarray
+    chunks: Tuple[Chunk, ...]
+    centroids: Optional[np.ndarray]
+    lists: Optional[np.ndarray]
+    # Modification time of the knowledge file when this snapshot was loaded
+    knowledge_mtime: Optional[float] = None
+
+
+class LocalIndex:
+    """Memory-mapped embedding store for one bot's knowledge chunks."""
+
+    def __init__(
+        self,
+        bot_id: str,
+        embedder: Embedder = None,
+        index_dir: str = INDEX_DIR,
+        ivf_min_size: int = DEFAULT_IVF_MIN_SIZE,
+        nprobe: int = DEFAULT_NPROBE,
+    ):
+        self.bot_id = bot_id
+        self.embedder = embedder or get_embedder()
+        self.directory = Path(index_dir) / bot_id
+        self.ivf_min_size = ivf_min_size
+        self.nprobe = nprobe
+
+        # Swapped whole by ensure_current; readers take the reference once
+        self.snapshot: Optional[IndexSnapshot] = None
+        self._lock = threading.Lock()
+
+    @property
+    def knowledge_path(self) -> str:
+        return knowledge_file_path(self.bot_id)
+
+    def _current_version(self) -> Optional[str]:
+        try:
+            return (self.directory / POINTER_FILE).read_text().strip() or None
+        except OSError:
+            return None
+
+    def _read_manifest(self) -> Dict:
+        version = self._current_version()
+        if version is None:
+            return {}
+        try:
+            with open(self.directory / version / "manifest.json", 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def is_stale(self) -> bool:
+        manifest = self._read_manifest()
+        return (
+            manifest.get("knowledge_hash") != file_hash(self.knowledge_path)
+            or manifest.get("embedder") != self.embedder.name
+            # The IVF layout is decided at build time, so a retrieval config change rebuilds
+            or manifest.get("ivf_min_size") != self.ivf_min_size
+            or manifest.get("nprobe") != self.nprobe
+        )
+
+    def build(self) -> None:
+        """
+        Rebuild the index from the knowledge file.
+
+        Vectors of chunks whose content hash is unchanged are copied from the
+        previous build; only new or modified chunks are embedded.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        manifest = self._read_manifest()
+
+        reusable: Dict[str, np.ndarray] = {}
+        if manifest.get("embedder") == self.embedder.name:
+            previous = self._load()
+            if previous is not None:
+                for row, chunk in enumerate(previous.chunks):
+                    reusable[chunk.content_hash] = np.array(previous.embeddings[row])
+
+        chunks = chunk_knowledge(self.bot_id, load_knowledge(self.bot_id))
+        missing = [chunk for chunk in chunks if chunk.content_hash not in reusable]
+        if missing:
+            new_vectors = np.asarray(self.embedder.embed([chunk.content for chunk in missing]), dtype=np.float32)
+            for chunk, vector in zip(missing, new_vectors):
+                reusable[chunk.content_hash] = vector
+
+        embeddings = np.zeros((len(chunks), self.embedder.dim), dtype=np.float32)
+        for row, chunk in enumerate(chunks):
+            embeddings[row] = reusable[chunk.content_hash]
+
+        # A fresh directory nobody reads until CURRENT names it; sorts after the builds before it
+        version = f"v{time.time_ns()}-{os.getpid()}"
+        version_dir = self.directory / version
+        version_dir.mkdir()
+        np.save(version_dir / "embeddings.npy", embeddings)
+        _save_json(version_dir / "chunks.json", [
+            {"path": chunk.path, "content": chunk.content, "token_count": chunk.token_count}
+            for chunk in chunks
+        ])
+        if len(chunks) >= self.ivf_min_size:
+            centroids = kmeans(embeddings, n_clusters=max(1, int(np.sqrt(len(chunks)))))
+            np.save(version_dir / "centroids.npy", centroids)
+            np.save(version_dir / "lists.npy", np.argmax(embeddings @ centroids.T, axis=1).astype(np.int32))
+        _save_json(version_dir / "manifest.json", {
+            "knowledge_hash": file_hash(self.knowledge_path),
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "size": len(chunks),
+            "ivf_min_size": self.ivf_min_size,
+            "nprobe": self.nprobe,
+        })
+
+        pointer = self.directory / POINTER_FILE
+        tmp_path = pointer.with_name(f"{POINTER_FILE}.{os.getpid()}.tmp")
+        tmp_path.write_text(version)
+        os.replace(tmp_path, pointer)
+
+        print(f"Built local index for {self.bot_id}: {len(chunks)} chunks ({len(missing)} embedded)")
+        self._prune(version)
+
+    def _prune(self, current: str) -> None:
+        """Remove the builds before the previous one, and the files of the unversioned layout."""
+        versions = sorted(path.name for path in self.directory.iterdir() if path.is_dir() and path.name.startswith("v"))
+        older = [version for version in versions if version < current]
+        for version in older[:-1]:
+            shutil.rmtree(self.directory / version, ignore_errors=True)
+        for name in LEGACY_FILES:
+            (self.directory / name).unlink(missing_ok=True)
+
+    def _load(self, knowledge_mtime: Optional[float] = None) -> Optional[IndexSnapshot]:
+        """The current build as a snapshot, or None if there is none."""
+        version = self._current_version()
+        while version is not None:
+            version_dir = self.directory / version
+            try:
+                embeddings = np.load(version_dir / "embeddings.npy", mmap_mode="r")
+                with open(version_dir / "chunks.json", 'r') as file:
+                    chunks = tuple(
+                        Chunk(bot_id=self.bot_id, path=item["path"], content=item["content"], token_count=item["token_count"])
+                        for item in json.load(file)
+                    )
+                centroids = lists = None
+                if (version_dir / "centroids.npy").exists():
+                    centroids = np.load(version_dir / "centroids.npy")
+                    lists = np.load(version_dir / "lists.npy", mmap_mode="r")
+                return IndexSnapshot(version, embeddings, chunks, centroids, lists, knowledge_mtime)
+            except (OSError, ValueError):
+                # Pruned by a concurrent build after we read CURRENT: follow the pointer again
+                latest = self._current_version()
+                if latest == version:
+                    return None
+                version = latest
+        return None
+
+    def ensure_current(self) -> Optional[IndexSnapshot]:
+        """The loaded index, rebuilding first if the knowledge file changed since the last build."""
+        try:
+            mtime = os.stat(self.knowledge_path).st_mtime
+        except OSError:
+            mtime = None
+
+        snapshot = self.snapshot
+        if snapshot is not None and snapshot.knowledge_mtime == mtime:
+            return snapshot
+
+        with self._lock:
+            snapshot = self.snapshot
+            if snapshot is not None and snapshot.knowledge_mtime == mtime:
+                return snapshot
+            if self.is_stale():
+                self.build()
+            snapshot = self._load(mtime)
+            self.snapshot = snapshot
+            return snapshot
+
+    def search_vector(self, query: np.ndarray, k: int, snapshot: Optional[IndexSnapshot] = None) -> List[Chunk]:
+        snapshot = snapshot or self.snapshot
+        if snapshot is None or len(snapshot.chunks) == 0:
+            return []
+
+        if snapshot.centroids is not None and snapshot.lists is not None:
+            # IVF prefilter: only score rows in the nprobe closest clusters
+            probes = top_k(snapshot.centroids @ query, self.nprobe)
+            candidates = np.flatnonzero(np.isin(snapshot.lists, probes))
+            scores = snapshot.embeddings[candidates] @ query
+            rows = candidates[top_k(scores, k)]
+        else:
+            rows = top_k(snapshot.embeddings @ query, k)
+
+        return [snapshot.chunks[row] for row in rows]
+
+    def search(self, query: str, k: int) -> List[Chunk]:
+        snapshot = self.ensure_current()
+        vector = np.asarray(self.embedder.embed([query])[0], dtype=np.float32)
+        return self.search_vector(vector, k, snapshot)
+
+
+def main() -> None:
+    bot_ids = sys.argv[1:] or sorted(path.stem for path in Path(KNOWLEDGE_DIR).glob("*.yaml"))
+    for bot_id in bot_ids:
+        index = LocalIndex(bot_id)
+        if index.is_stale():
+            index.build()
+        else:
+            print(f"Local index for {bot_id} is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import asyncio
+from abc import ABC, abstractmethod
+from typing import List
+from sqlalchemy import select
+from ..database import async_session
+from ..models import KnowledgeChunk
+from .chunker import Chunk
+from .embeddings import get_embedder
+from .local_index import DEFAULT_IVF_MIN_SIZE, DEFAULT_NPROBE, LocalIndex
+
+DEFAULT_TOP_K = 5
+DEFAULT_MAX_TOKENS = 1500
+
+
+class Retriever(ABC):
+    """Looks up the knowledge chunks most relevant to a user message."""
+
+    def __init__(self, bot_id: str, top_k: int = DEFAULT_TOP_K, max_tokens: int = DEFAULT_MAX_TOKENS):
+        self.bot_id = bot_id
+        self.top_k = top_k
+        self.max_tokens = max_tokens
+
+    @abstractmethod
+    async def search(self, query: str, top_k: int) -> List[Chunk]:
+        raise NotImplementedError
+
+    async def retrieve(self, query: str) -> List[Chunk]:
+        """
+        Fetch the top-k chunks for a query, trimmed to the token budget.
+
+        Args:
+            query: The user message to retrieve knowledge for
+
+        Returns:
+            Chunks in relevance order whose combined size fits max_tokens
+        """
+        chunks = await self.search(query, self.top_k)
+
+        selected = []
+        used = 0
+        for chunk in chunks:
+            if used + chunk.token_count > self.max_tokens:
+                continue
+            selected.append(chunk)
+            used += chunk.token_count
+        return selected
+
+    @staticmethod
+    def format_context(chunks: List[Chunk]) -> str:
+        if not chunks:
+            return ""
+        body = "\n\n".join(chunk.content for chunk in chunks)
+        return f"\n\nHere is additional knowledge relevant to the question:\n{body}"
+
+
+class PgVectorRetriever(Retriever):
+    """Cosine-distance search over the knowledge_chunks table (HNSW index)."""
+
+    async def search(self, query: str, top_k: int) -> List[Chunk]:
+        [query_vector] = await get_embedder().aembed([query])
+
+        async with async_session() as session:
+            result = await session.execute(
+                select(KnowledgeChunk)
+                .where(KnowledgeChunk.bot_id == self.bot_id)
+                .order_by(KnowledgeChunk.embedding.cosine_distance(query_vector))
+                .limit(top_k)
+            )
+            rows = result.scalars().all()
+
+        return [
+            Chunk(bot_id=row.bot_id, path=row.path, content=row.content, token_count=row.token_count)
+            for row in rows
+        ]
+
+
+class LocalRetriever(Retriever):
+    """NumPy search over a memory-mapped per-bot index; needs no database."""
+
+    def __init__(self, bot_id: str, top_k: int = DEFAULT_TOP_K, max_tokens: int = DEFAULT_MAX_TOKENS,
+                 ivf_min_size: int = DEFAULT_IVF_MIN_SIZE, nprobe: int = DEFAULT_NPROBE):
+        super().__init__(bot_id, top_k=top_k, max_tokens=max_tokens)
+        self.index = LocalIndex(bot_id, ivf_min_size=ivf_min_size, nprobe=nprobe)
+
+    async def search(self, query: str, top_k: int) -> List[Chunk]:
+        # The first call (or a changed knowledge file) triggers a build, keep it off the event loop
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.index.search, query, top_k)
+
+
+def create_retriever(bot_id: str, config: dict):
+    """
+    Build the retriever described by a bot's `retrieval` config block.
+
+    Args:
+        bot_id: ID of the bot
+        config: The bot configuration
+
+    Returns:
+        Retriever instance, or None when retrieval is disabled for the bot
+    """
+    settings = config.get("retrieval") or {}
+    if not settings.get("enabled", False):
+        return None
+
+    top_k = settings.get("top_k", DEFAULT_TOP_K)
+    max_tokens = settings.get("max_tokens", DEFAULT_MAX_TOKENS)
+
+    backend = settings.get("backend") or os.getenv("RETRIEVAL_BACKEND", "pgvector")
+    if backend == "local":
+        return LocalRetriever(
+            bot_id,
+            top_k=top_k,
+            max_tokens=max_tokens,
+            ivf_min_size=settings.get("ivf_min_size", DEFAULT_IVF_MIN_SIZE),
+            nprobe=settings.get("nprobe", DEFAULT_NPROBE),
+        )
+
+    return PgVectorRetriever(bot_id, top_k=top_k, max_tokens=max_tokens)
@@ -0,0 +1,300 @@
+"""
+Semantic search over past user messages.
+
+`message_embedder` runs in the background of every worker (one at a time,
+under a shared lock) and embeds the user messages that have no embedding yet,
+MESSAGE_EMBED_BATCH_SIZE at a time, with the same embedder as the knowledge
+base (EMBEDDING_BACKEND=hashing embeds offline). New messages are picked up
+within MESSAGE_EMBED_INTERVAL seconds; existing ones are backfilled the same way.
+
+`search_messages` ranks the embedded questions by cosine similarity to a query,
+filtered by bot and time range, a page at a time. On Postgres it uses the HNSW
+index on chat_messages.embedding; time ranges only touch the months they cover.
+Messages archived to Parquet (retention.py) are no longer searchable.
+
+    python -m app.backend.message_search status          # embedded and pending messages
+    python -m app.backend.message_search embed           # embed everything pending now
+    python -m app.backend.message_search search "query" [--bot baden-guide] [--limit 10]
+"""
+import os
+import time
+import asyncio
+import datetime
+import numpy as np
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import bindparam, func, select, text, tuple_, update
+from .database import async_session, engine
+from .models import ChatMessage
+from .shared_state import shared_state
+from .knowledge.embeddings import EMBEDDING_DIM, get_embedder
+from .metrics import MESSAGE_SEARCH_TIME, MESSAGES_EMBEDDED
+
+MESSAGE_EMBED_BATCH_SIZE = int(os.getenv("MESSAGE_EMBED_BATCH_SIZE", "64"))
+# Seconds between looks for new messages; 0 disables the background worker
+MESSAGE_EMBED_INTERVAL = float(os.getenv("MESSAGE_EMBED_INTERVAL", "5"))
+# HNSW candidate list size (hnsw.ef_search); raised to cover the requested page
+MESSAGE_SEARCH_EF = int(os.getenv("MESSAGE_SEARCH_EF", "40"))
+# Bot filters are applied to the HNSW candidates, so filtered searches look at more of them
+MESSAGE_SEARCH_FILTER_FACTOR = int(os.getenv("MESSAGE_SEARCH_FILTER_FACTOR", "4"))
+# Deepest result reachable by paging (hnsw.ef_search is at most 1000)
+MESSAGE_SEARCH_MAX_RESULTS = 1000
+
+
+class MessageEmbedder:
+    def __init__(self, batch_size: int = MESSAGE_EMBED_BATCH_SIZE, interval: float = MESSAGE_EMBED_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"embedded": 0, "batches": 0, "errors": 0}
+        self.last_batch_ms: Optional[float] = None
+
+    async def embed_batch(self) -> int:
+        """Embed up to batch_size pending user messages, oldest first. Returns how many."""
+        table = ChatMessage.__table__
+        async with async_session() as session:
+            result = await session.execute(
+                select(table.c.id, table.c.timestamp, table.c.content)
+                .where(table.c.embedding.is_(None), table.c.role == "user")
+                .order_by(table.c.id)
+                .limit(self.batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                return 0
+
+            started = time.perf_counter()
+            vectors = await get_embedder().aembed([row.content or "" for row in rows])
+            # The timestamp in the key lets Postgres go straight to the row's partition
+            await session.execute(
+                update(table)
+                .where(table.c.id == bindparam("row_id"), table.c.timestamp == bindparam("row_timestamp"))
+                .values(embedding=bindparam("vector", type_=Vector(EMBEDDING_DIM))),
+                [
+                    {"row_id": row.id, "row_timestamp": row.timestamp, "vector": vector}
+                    for row, vector in zip(rows, vectors)
+                ],
+            )
+            await session.commit()
+
+        self.last_batch_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.stats["embedded"] += len(rows)
+        self.stats["batches"] += 1
+        MESSAGES_EMBEDDED.inc(amount=len(rows))
+        return len(rows)
+
+    async def run_once(self) -> Optional[int]:
+        """Embed until nothing is pending. Returns how many, None if another worker is on it."""
+        async with shared_state.lock("message_embedding", wait=False) as acquired:
+            if not acquired:
+                return None
+            total = 0
+            while True:
+                count = await self.embed_batch()
+                total += count
+                if count < self.batch_size:
+                    return total
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Error embedding chat messages: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.interval > 0 and self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def status(self) -> Dict:
+        async with async_session() as session:
+            result = await session.execute(
+                select(ChatMessage.embedding.is_(None), func.count())
+                .where(ChatMessage.role == "user")
+                .group_by(ChatMessage.embedding.is_(None))
+            )
+            counts = {pending: count for pending, count in result.all()}
+        return {
+            "embedder": get_embedder().name,
+            "embedded": counts.get(False, 0),
+            "pending": counts.get(True, 0),
+            # This worker's share since it started
+            "worker": {"running": self.task is not None, "last_batch_ms": self.last_batch_ms, **self.stats},
+        }
+
+
+@dataclass
+class SearchPage:
+    results: List[Dict]
+    next_offset: Optional[int]
+
+
+def _utc(value: datetime.datetime) -> datetime.datetime:
+    # Timestamps are stored as naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _filters(bot_id: Optional[str], start: Optional[datetime.datetime], end: Optional[datetime.datetime]) -> List:
+    filters = [ChatMessage.role == "user", ChatMessage.embedding.is_not(None)]
+    if bot_id is not None:
+        filters.append(ChatMessage.bot_id == bot_id)
+    if start is not None:
+        filters.append(ChatMessage.timestamp >= _utc(start))
+    if end is not None:
+        filters.append(ChatMessage.timestamp < _utc(end))
+    return filters
+
+
+async def _rank_pgvector(session, vector, filters: List, limit: int, offset: int, ef_search: int):
+    # SET LOCAL lasts until the end of this transaction, i.e. this search
+    await session.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+    distance = ChatMessage.embedding.cosine_distance(vector)
+    result = await session.execute(
+        select(
+            ChatMessage.id, ChatMessage.conversation_id, ChatMessage.bot_id, ChatMessage.seq,
+            ChatMessage.content, ChatMessage.timestamp, distance.label("distance"),
+        )
+        .where(*filters)
+        .order_by(distance)
+        .offset(offset)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def _rank_exact(session, vector, filters: List, limit: int, offset: int):
+    # Stand-in databases have no vector index: score every matching row in NumPy
+    result = await session.execute(
+        select(
+            ChatMessage.id, ChatMessage.conversation_id, ChatMessage.bot_id, ChatMessage.seq,
+            ChatMessage.content, ChatMessage.timestamp, ChatMessage.embedding,
+        ).where(*filters)
+    )
+    rows = result.all()
+    if not rows:
+        return []
+    matrix = np.array([row.embedding for row in rows], dtype=np.float32)
+    query = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+    norms[norms == 0] = 1.0
+    distances = 1.0 - matrix @ query / norms
+    order = np.argsort(distances, kind="stable")[offset:offset + limit]
+    return [(*rows[index][:6], float(distances[index])) for index in order]
+
+
+async def search_messages(
+    query: str,
+    bot_id: str = None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    limit: int = 20,
+    offset: int = 0,
+    answers: bool = True,
+    ef_search: int = None,
+) -> SearchPage:
+    """
+    Past user messages most similar to `query`.
+
+    Args:
+        query: Text to search for
+        bot_id: Only this bot's messages
+        start: Earliest timestamp (UTC), None for no lower bound
+        end: Timestamp (UTC) after the last one wanted, None for no upper bound
+        limit: Results per page
+        offset: Results to skip, from the previous page's next_offset
+        answers: Also return the bot's answer to each message
+        ef_search: HNSW candidate list size; MESSAGE_SEARCH_EF (or more, to cover the page) if None
+
+    Returns:
+        SearchPage, most similar first, with next_offset None on the last page
+
+    Raises:
+        ValueError: If the page lies beyond MESSAGE_SEARCH_MAX_RESULTS
+    """
+    if offset + limit > MESSAGE_SEARCH_MAX_RESULTS:
+        raise ValueError(f"Only the first {MESSAGE_SEARCH_MAX_RESULTS} results can be paged through")
+
+    started = time.perf_counter()
+    [vector] = await get_embedder().aembed([query])
+    filters = _filters(bot_id, start, end)
+
+    async with async_session() as session:
+        # One extra row tells whether there is a next page
+        if engine.dialect.name == "postgresql":
+            if ef_search is None:
+                ef_search = MESSAGE_SEARCH_EF * (MESSAGE_SEARCH_FILTER_FACTOR if bot_id else 1)
+            ef_search = min(max(ef_search, offset + limit + 1), MESSAGE_SEARCH_MAX_RESULTS)
+            rows = await _rank_pgvector(session, vector, filters, limit + 1, offset, ef_search)
+        else:
+            rows = await _rank_exact(session, vector, filters, limit + 1, offset)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        replies = {}
+        keys = [(row[1], row[3] + 1) for row in rows if row[1] is not None and row[3] is not None]
+        if answers and keys:
+            result = await session.execute(
+                select(ChatMessage.conversation_id, ChatMessage.seq, ChatMessage.content, ChatMessage.status)
+                .where(tuple_(ChatMessage.conversation_id, ChatMessage.seq).in_(keys), ChatMessage.role == "assistant")
+            )
+            replies = {(reply.conversation_id, reply.seq): reply for reply in result.all()}
+
+    results = []
+    for message_id, conversation_id, row_bot_id, seq, content, timestamp, distance in rows:
+        entry = {
+            "id": message_id,
+            "conversation_id": conversation_id,
+            "bot_id": row_bot_id,
+            "seq": seq,
+            "question": content,
+            "timestamp": timestamp,
+            "similarity": round(1.0 - float(distance), 4),
+        }
+        if answers:
+            reply = replies.get((conversation_id, seq + 1 if seq is not None else None))
+            entry["answer"] = reply.content if reply else None
+            entry["answer_status"] = reply.status if reply else None
+        results.append(entry)
+
+    MESSAGE_SEARCH_TIME.observe(time.perf_counter() - started)
+    return SearchPage(results=results, next_offset=offset + limit if has_more else None)
+
+
+message_embedder = MessageEmbedder()
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+    from .database import init_db
+
+    parser = argparse.ArgumentParser(description="Semantic search over chat messages")
+    parser.add_argument("command", choices=["status", "embed", "search"])
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--bot")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    async def main():
+        await init_db()
+        if args.command == "embed":
+            print(f"Embedded {await message_embedder.run_once()} messages")
+        elif args.command == "search":
+            page = await search_messages(args.query or "", bot_id=args.bot, limit=args.limit, answers=False)
+            for result in page.results:
+                print(f"{result['similarity']:.3f}  {result['bot_id']:<16} {result['timestamp']:%Y-%m-%d}  {result['question'][:100]}")
+        print(json.dumps(await message_embedder.status(), indent=2, default=str))
+        await engine.dispose()
+
+    asyncio.run(main())
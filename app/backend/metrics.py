@@ -0,0 +1,279 @@
+"""
+Counters, histograms and per-turn trace spans for the chat hot path.
+
+Metrics are rendered in the Prometheus text format at /metrics. With
+METRICS_ENABLED=false every metric and trace is a shared no-op object, so the
+instrumented code pays one method call that returns immediately: no clock
+reads, locks or allocations (bench/metrics_overhead.py measures this).
+"""
+import os
+import time
+import uuid
+import bisect
+from collections import deque
+from contextlib import nullcontext
+from typing import Callable, Deque, Dict, List, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# Per-turn trace spans are kept in memory (last METRICS_TRACE_BUFFER) and served at /api/traces
+METRICS_TRACING = METRICS_ENABLED and os.getenv("METRICS_TRACING", "false").lower() == "true"
+METRICS_TRACE_BUFFER = int(os.getenv("METRICS_TRACE_BUFFER", "200"))
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+FAST_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+_NULL_CONTEXT = nullcontext()
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ("bot",)):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        self.values[label_values] = self.values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ("bot",), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def time(self, *label_values) -> "_Timer":
+        """Context manager observing the duration of its block."""
+        return _Timer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, label_values)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class _Timer:
+    # A plain class rather than @contextmanager: entering a generator-based context costs several times more
+    __slots__ = ("histogram", "label_values", "started")
+
+    def __init__(self, histogram: Histogram, label_values: Tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+        return False
+
+
+class Gauge:
+    """Value read from a callback when /metrics is scraped, e.g. a queue length."""
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], Dict[Tuple, float]], labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.read = read
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.read()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {str(e)}")
+            return lines
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class NullMetric:
+    """Stands in for every metric when instrumentation is disabled."""
+
+    def inc(self, *label_values, amount: float = 1.0) -> None:
+        pass
+
+    def observe(self, value: float, *label_values) -> None:
+        pass
+
+    def time(self, *label_values):
+        return _NULL_CONTEXT
+
+    def render(self) -> List[str]:
+        return []
+
+
+NULL_METRIC = NullMetric()
+
+
+class Registry:
+    def __init__(self, enabled: bool = METRICS_ENABLED):
+        self.enabled = enabled
+        self.metrics: List = []
+
+    def _register(self, metric):
+        if not self.enabled:
+            return NULL_METRIC
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ("bot",)):
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = ("bot",), buckets: Sequence[float] = LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], Dict[Tuple, float]], labels: Sequence[str] = ()):
+        return self._register(Gauge(name, documentation, read, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """Spans of one chat turn, offsets in milliseconds from the start of the turn."""
+
+    def __init__(self, name: str, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.spans: List[Dict] = []
+        self.finished = False
+
+    def _offset_ms(self) -> float:
+        return round((time.perf_counter() - self._started) * 1000, 3)
+
+    def span(self, name: str) -> "_Span":
+        return _Span(self, name)
+
+    def mark(self, name: str) -> None:
+        self.spans.append({"name": name, "start_ms": self._offset_ms(), "duration_ms": 0.0})
+
+    def finish(self, **attributes) -> None:
+        if self.finished:
+            return
+        self.finished = True
+        self.attributes.update(attributes)
+        traces.append({
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": self._offset_ms(),
+            "attributes": self.attributes,
+            "spans": self.spans,
+        })
+
+
+class _Span:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.trace._offset_ms()
+
+    def __exit__(self, *exc_info):
+        duration = round(self.trace._offset_ms() - self.start, 3)
+        self.trace.spans.append({"name": self.name, "start_ms": self.start, "duration_ms": duration})
+        return False
+
+
+class NullTrace:
+    def span(self, name: str):
+        return _NULL_CONTEXT
+
+    def mark(self, name: str) -> None:
+        pass
+
+    def finish(self, **attributes) -> None:
+        pass
+
+
+NULL_TRACE = NullTrace()
+traces: Deque[Dict] = deque(maxlen=METRICS_TRACE_BUFFER)
+
+
+def start_trace(name: str, **attributes):
+    if not METRICS_TRACING:
+        return NULL_TRACE
+    return Trace(name, **attributes)
+
+
+registry = Registry()
+
+# Chat hot path
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    "ragnode_time_to_first_token_seconds", "Time from receiving a message to the first answer text")
+INTER_TOKEN_GAP = registry.histogram(
+    "ragnode_inter_token_gap_seconds", "Time between consecutive chunks of a streamed answer", buckets=GAP_BUCKETS)
+GENERATION_TIME = registry.histogram(
+    "ragnode_generation_seconds", "Time from receiving a message to the complete answer")
+SAVE_MESSAGE_TIME = registry.histogram(
+    "ragnode_save_message_seconds", "Time spent handing a message to the write-behind queue", buckets=FAST_BUCKETS)
+PROMPT_BUILD_TIME = registry.histogram(
+    "ragnode_prompt_build_seconds", "Time to build the system prompt (knowledge retrieval included)", buckets=FAST_BUCKETS)
+INPUT_TOKENS = registry.counter("ragnode_input_tokens_total", "Prompt tokens sent to the model")
+OUTPUT_TOKENS = registry.counter("ragnode_output_tokens_total", "Answer tokens received from the model")
+FALLBACKS = registry.counter("ragnode_fallbacks_total", "Turns answered by the non-streaming fallback")
+ERRORS = registry.counter("ragnode_errors_total", "Turns that ended in an error", labels=("bot", "kind"))
+ROUTED_TURNS = registry.counter("ragnode_routed_turns_total", "Turns per model tier and routing reason", labels=("bot", "tier", "reason"))
+ESCALATIONS = registry.counter("ragnode_escalations_total", "Fast-tier answers continued on the standard tier", labels=("bot", "cause"))
+ROUTED_TTFT = registry.histogram(
+    "ragnode_routed_time_to_first_token_seconds", "Time to first token per model tier", labels=("bot", "tier"))
+HEDGES = registry.counter(
+    "ragnode_hedges_total", "Model calls past the first-token deadline, by outcome", labels=("bot", "outcome"))
+CANCELLED_TURNS = registry.counter(
+    "ragnode_cancelled_turns_total", "Turns abandoned by the user before the answer finished", labels=("bot", "stage"))
+CANCELLED_TOKENS_SAVED = registry.counter(
+    "ragnode_cancelled_tokens_saved_total", "Estimated answer tokens not generated because the turn was cancelled")
+GENERATIONS = registry.counter(
+    "ragnode_generations_total", "Server-side generations by how they ended", labels=("bot", "status"))
+REATTACHES = registry.counter("ragnode_generation_reattaches_total", "Clients that reattached to a running or finished generation")
+MESSAGES_EMBEDDED = registry.counter("ragnode_messages_embedded_total", "User messages embedded for semantic search", labels=())
+MESSAGE_SEARCH_TIME = registry.histogram(
+    "ragnode_message_search_seconds", "Semantic message searches, query embedding included", labels=())
@@ -1,12 +1,89 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text
+from sqlalchemy import Column, Integer, String, DateTime, Text, Index, ForeignKey
+from sqlalchemy.orm import deferred
 from pgvector.sqlalchemy import Vector
 from .database import Base
+from .knowledge.embeddings import EMBEDDING_DIM
 import datetime
+import uuid
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    bot_id = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_conversations_bot_updated", "bot_id", "updated_at"),
+    )
 
 class ChatMessage(Base):
+    # On Postgres the table is partitioned by month on timestamp with the primary key
+    # (id, timestamp); it is created by retention.create_message_table, not create_all
     __tablename__ = "chat_messages"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(String(36), ForeignKey("conversations.id"), nullable=True)
+    bot_id = Column(String, nullable=True)
+    seq = Column(Integer, nullable=True)  # position of the message within its conversation
     role = Column(String)  # 'user' or 'assistant'
     content = Column(Text)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
\ No newline at end of file
+    status = Column(String, nullable=True)  # 'cancelled' for an answer cut short by the user; NULL: complete
+    # User messages are embedded in the background for semantic search (message_search.py);
+    # the HNSW index is created with the partitioned table. Deferred: history reads skip it
+    embedding = deferred(Column(Vector(EMBEDDING_DIM), nullable=True))
+    timestamp = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_chat_messages_conversation_seq", "conversation_id", "seq"),
+        Index("ix_chat_messages_bot_timestamp", "bot_id", "timestamp"),
+    )
+
+class ResponseCacheEntry(Base):
+    __tablename__ = "response_cache"
+
+    key = Column(String(64), primary_key=True)
+    bot_id = Column(String, nullable=False)
+    response = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    last_hit_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_response_cache_bot_last_hit", "bot_id", "last_hit_at"),
+    )
+
+class SharedStateEntry(Base):
+    __tablename__ = "shared_state"
+
+    namespace = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(Text, nullable=False)
+    expires_at = Column(DateTime, nullable=True)  # NULL: never expires
+
+    __table_args__ = (
+        Index("ix_shared_state_expires_at", "expires_at"),
+    )
+
+class KnowledgeChunk(Base):
+    __tablename__ = "knowledge_chunks"
+
+    id = Column(Integer, primary_key=True)
+    bot_id = Column(String, nullable=False, index=True)
+    path = Column(String, nullable=False)  # key hierarchy, e.g. 'festivals > badenfahrt'
+    content = Column(Text, nullable=False)
+    content_hash = Column(String(64), nullable=False)
+    token_count = Column(Integer, nullable=False)
+    embedding = Column(Vector(EMBEDDING_DIM), nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_knowledge_chunks_bot_hash", "bot_id", "content_hash", unique=True),
+        Index(
+            "ix_knowledge_chunks_embedding_hnsw",
+            embedding,
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
@@ -0,0 +1,52 @@
+"""
+Rendered HTML of the landing and bot pages, kept until the bots change.
+
+The pages depend only on the bot configs, so each one is rendered once per
+registry version and served from memory, compressed and with an ETag, so a
+reload costs a 304. A hot-reloaded bot bumps bot_registry.version, which
+drops every cached page on the next request.
+"""
+from typing import Callable, Dict, Hashable
+from starlette.requests import Request
+from starlette.responses import Response
+from .static_assets import REVALIDATE, Encoded
+
+
+class PageCache:
+    def __init__(self, render: Callable[[Hashable], str], version: Callable[[], int]):
+        """
+        Args:
+            render: Renders the page for a key to HTML
+            version: Current version of what the pages are rendered from
+        """
+        self.render = render
+        self.version = version
+        self.pages: Dict[Hashable, Encoded] = {}
+        self.rendered_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Encoded:
+        version = self.version()
+        if version != self.rendered_version:
+            self.pages.clear()
+            self.rendered_version = version
+        page = self.pages.get(key)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = Encoded.build(self.render(key).encode("utf-8"), "text/html; charset=utf-8")
+        self.pages[key] = page
+        return page
+
+    def response(self, request: Request, key: Hashable) -> Response:
+        return self.get(key).response(request, REVALIDATE)
+
+    def stats(self) -> Dict:
+        return {
+            "pages": len(self.pages),
+            "version": self.rendered_version,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,352 @@
+"""
+Write-behind persistence for chat messages.
+
+Chat turns hand their rows to `message_writer` and move on; a background task
+drains the queue and writes rows in batches with a multi-row INSERT. When the
+queue is full the overflow policy decides what happens:
+
+    block  wait up to MESSAGE_BLOCK_TIMEOUT seconds for room, then spill
+    spill  append the row to a JSONL file that is replayed once the queue drains
+    drop   discard the row
+
+A batch that keeps failing is spilled too, unless the database rejected the
+rows themselves (a value too long for its column, a broken reference): then
+the batch is split in halves until the rows at fault are isolated, the rest
+is written, and those rows are moved to MESSAGE_QUARANTINE_PATH instead of
+being replayed forever.
+
+`await message_writer.flush()` waits until every row queued before it has
+been written. Call `await message_writer.close()` on shutdown to flush what
+is still queued.
+"""
+import os
+import json
+import asyncio
+import datetime
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, StatementError
+from .database import async_session
+from .models import ChatMessage
+from .repository import upsert_conversations
+
+MESSAGE_QUEUE_SIZE = int(os.getenv("MESSAGE_QUEUE_SIZE", "10000"))
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.5"))
+MESSAGE_OVERFLOW_POLICY = os.getenv("MESSAGE_OVERFLOW_POLICY", "block")
+MESSAGE_BLOCK_TIMEOUT = float(os.getenv("MESSAGE_BLOCK_TIMEOUT", "0.05"))
+MESSAGE_SPILL_PATH = os.getenv("MESSAGE_SPILL_PATH", "chat_messages.spill.jsonl")
+# Rows the database refused; kept for inspection, never replayed
+MESSAGE_QUARANTINE_PATH = os.getenv("MESSAGE_QUARANTINE_PATH", "chat_messages.quarantine.jsonl")
+
+# Failed batches are retried this many times before they are spilled to disk
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def rejected_rows(error: Exception) -> bool:
+    """Whether an insert failed on the rows themselves rather than on the database being unavailable."""
+    if isinstance(error, (DataError, IntegrityError)):
+        return True
+    # asyncpg reports data errors as plain DBAPIErrors; the SQLSTATE class tells them apart
+    sqlstate = getattr(getattr(error, "orig", None), "sqlstate", None)
+    if sqlstate:
+        return sqlstate[:2] in ("22", "23")
+    # Refused before it was sent, e.g. a value of the wrong type
+    return isinstance(error, StatementError) and not isinstance(error, DBAPIError)
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        max_queue: int = MESSAGE_QUEUE_SIZE,
+        batch_size: int = MESSAGE_BATCH_SIZE,
+        flush_interval: float = MESSAGE_FLUSH_INTERVAL,
+        overflow_policy: str = MESSAGE_OVERFLOW_POLICY,
+        block_timeout: float = MESSAGE_BLOCK_TIMEOUT,
+        spill_path: str = MESSAGE_SPILL_PATH,
+        quarantine_path: str = MESSAGE_QUARANTINE_PATH,
+    ):
+        if overflow_policy not in ("block", "spill", "drop"):
+            raise ValueError(f"Unknown overflow policy: {overflow_policy}")
+
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.spill_path = spill_path
+        self.quarantine_path = quarantine_path
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "spilled": 0, "quarantined": 0, "failed_batches": 0}
+        # Rows queued so far, and rows the background task is done with (written, spilled or
+        # quarantined); it takes them in queue order, so flush() waits for the second to catch up
+        self.enqueued = 0
+        self.settled = 0
+        self._flush_waiters: List[Tuple[int, asyncio.Future]] = []
+        self._flush_requested: Optional[asyncio.Event] = None
+        self._batch: List[Dict] = []
+        # Spill file appends and the replay's rename run in threads, one at a time
+        self._file_lock: Optional[asyncio.Lock] = None
+
+    def _ensure_started(self) -> None:
+        if self.task is None or self.task.done():
+            if self.queue is None:
+                self.queue = asyncio.Queue(maxsize=self.max_queue)
+                self._flush_requested = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, row: Dict) -> bool:
+        """
+        Queue a message row for writing.
+
+        Never waits on the database; with the block policy it waits at most
+        block_timeout for queue space.
+
+        Args:
+            row: Column values for a ChatMessage
+
+        Returns:
+            True if the row was queued or spilled, False if it was dropped
+        """
+        row.setdefault("timestamp", datetime.datetime.utcnow())
+        if self.closed:
+            return await self._spill([row])
+
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(row)
+            self._queued()
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.overflow_policy == "block":
+            try:
+                await asyncio.wait_for(self.queue.put(row), timeout=self.block_timeout)
+                self._queued()
+                return True
+            except asyncio.TimeoutError:
+                return await self._spill([row])
+
+        if self.overflow_policy == "spill":
+            return await self._spill([row])
+
+        self.stats["dropped"] += 1
+        return False
+
+    def _queued(self) -> None:
+        self.stats["queued"] += 1
+        self.enqueued += 1
+
+    def _settle(self, count: int) -> None:
+        """Mark the next `count` queued rows as done and wake the flushes they were holding up."""
+        self.settled += count
+        waiting = []
+        for target, future in self._flush_waiters:
+            if target <= self.settled:
+                if not future.done():
+                    future.set_result(None)
+            else:
+                waiting.append((target, future))
+        self._flush_waiters = waiting
+        if not waiting:
+            self._flush_requested.clear()
+
+    async def _append(self, path: str, rows: List[Dict]) -> None:
+        if self._file_lock is None:
+            self._file_lock = asyncio.Lock()
+
+        def append() -> None:
+            with open(path, 'a') as file:
+                for row in rows:
+                    file.write(json.dumps(row, default=str) + "\n")
+
+        async with self._file_lock:
+            await asyncio.to_thread(append)
+
+    async def _spill(self, rows: List[Dict]) -> bool:
+        try:
+            await self._append(self.spill_path, rows)
+            self.stats["spilled"] += len(rows)
+            return True
+        except Exception as e:
+            print(f"Error spilling {len(rows)} messages to {self.spill_path}: {str(e)}")
+            self.stats["dropped"] += len(rows)
+            return False
+
+    async def _quarantine(self, row: Dict, error: Exception) -> None:
+        print(f"Quarantining a message the database refused: {str(error)}")
+        try:
+            await self._append(self.quarantine_path, [{**row, "error": str(error)}])
+            self.stats["quarantined"] += 1
+        except Exception as e:
+            print(f"Error quarantining a message to {self.quarantine_path}: {str(e)}")
+            self.stats["dropped"] += 1
+
+    async def _take_spilled(self) -> List[Dict]:
+        if self._file_lock is None:
+            self._file_lock = asyncio.Lock()
+
+        # Rename before reading so concurrent spills go to a fresh file
+        replay_path = f"{self.spill_path}.{os.getpid()}.replay"
+
+        def take() -> List[Dict]:
+            if not os.path.exists(self.spill_path):
+                return []
+            os.replace(self.spill_path, replay_path)
+            with open(replay_path, 'r') as file:
+                rows = [json.loads(line) for line in file if line.strip()]
+            os.remove(replay_path)
+            return rows
+
+        try:
+            async with self._file_lock:
+                rows = await asyncio.to_thread(take)
+        except Exception as e:
+            print(f"Error replaying spilled messages: {str(e)}")
+            return []
+
+        for row in rows:
+            # Rows spilled before the status column existed
+            row.setdefault("status", None)
+            if isinstance(row.get("timestamp"), str):
+                row["timestamp"] = datetime.datetime.fromisoformat(row["timestamp"])
+        return rows
+
+    async def _insert(self, rows: List[Dict]) -> None:
+        async with async_session() as session:
+            # Conversations are created lazily by the first batch that mentions them
+            await upsert_conversations(session, {
+                row["conversation_id"]: row.get("bot_id")
+                for row in rows if row.get("conversation_id")
+            })
+            # executemany of a single INSERT becomes multi-row VALUES batches
+            await session.execute(insert(ChatMessage), rows)
+            await session.commit()
+        self.stats["written"] += len(rows)
+
+    async def _write(self, rows: List[Dict]) -> None:
+        for attempt in range(1, MAX_FLUSH_ATTEMPTS + 1):
+            try:
+                await self._insert(rows)
+                return
+            except Exception as e:
+                print(f"Error writing {len(rows)} messages (attempt {attempt}): {str(e)}")
+                if rejected_rows(e):
+                    # Retrying the same rows cannot help; find the ones at fault
+                    await self._isolate(rows, e)
+                    return
+                if attempt < MAX_FLUSH_ATTEMPTS:
+                    await asyncio.sleep(0.5 * attempt)
+
+        self.stats["failed_batches"] += 1
+        await self._spill(rows)
+
+    async def _isolate(self, rows: List[Dict], error: Exception) -> None:
+        """Write `rows`, whose batch the database refused, in halves; quarantine the rows at fault."""
+        if len(rows) == 1:
+            await self._quarantine(rows[0], error)
+            return
+        middle = len(rows) // 2
+        for half in (rows[:middle], rows[middle:]):
+            try:
+                await self._insert(half)
+            except Exception as e:
+                if rejected_rows(e):
+                    await self._isolate(half, e)
+                else:
+                    # The database itself failed meanwhile; keep the rest for the replay
+                    print(f"Error writing {len(half)} messages: {str(e)}")
+                    self.stats["failed_batches"] += 1
+                    await self._spill(half)
+
+    async def _get(self, timeout: float) -> Optional[Dict]:
+        """The next queued row; None after `timeout` seconds, or at once if a flush is waiting."""
+        if self._flush_requested.is_set():
+            try:
+                return self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return None
+        get = asyncio.ensure_future(self.queue.get())
+        flush = asyncio.ensure_future(self._flush_requested.wait())
+        try:
+            await asyncio.wait((get, flush), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            # A cancelled get() leaves its row in the queue
+            get.cancel()
+            flush.cancel()
+        if get.done() and not get.cancelled():
+            return get.result()
+        return None
+
+    async def _drain(self, wait: float) -> List[Dict]:
+        """Collect up to batch_size rows, waiting at most `wait` seconds after the first one."""
+        rows = []
+        row = await self._get(wait)
+        if row is None:
+            return rows
+        rows.append(row)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                row = await self._get(remaining)
+                if row is None:
+                    break
+                rows.append(row)
+        return rows
+
+    async def _run(self) -> None:
+        while not (self.closed and self.queue.empty()):
+            self._batch = rows = await self._drain(self.flush_interval)
+            if rows:
+                await self._write(rows)
+                self._batch = []
+                self._settle(len(rows))
+            elif not self.closed and self.queue.empty():
+                # Idle: replay anything that overflowed earlier
+                spilled = await self._take_spilled()
+                for start in range(0, len(spilled), self.batch_size):
+                    await self._write(spilled[start:start + self.batch_size])
+
+    async def flush(self) -> None:
+        """Wait until every row queued before the call has been written (or spilled)."""
+        if self.queue is None or self.settled >= self.enqueued:
+            return
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._flush_waiters.append((self.enqueued, future))
+        # Stops the background task from waiting to fill its batch
+        self._flush_requested.set()
+        await future
+
+    async def close(self) -> None:
+        """Stop the background task and flush the remaining rows."""
+        self.closed = True
+        if self.task is not None:
+            # The loop exits once the queue is empty; give it a bounded time to get there
+            try:
+                await asyncio.wait_for(self.task, timeout=self.flush_interval + 30)
+            except asyncio.TimeoutError:
+                print("Timed out waiting for the message writer to drain")
+                self.task.cancel()
+                await asyncio.gather(self.task, return_exceptions=True)
+                # Whatever was not written survives in the spill file for the next start
+                rows = self._batch
+                while not self.queue.empty():
+                    rows.append(self.queue.get_nowait())
+                await self._spill(rows)
+                self._settle(len(rows))
+        print(f"Message writer closed: {self.stats}")
+
+
+message_writer = MessageWriter()
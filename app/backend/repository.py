@@ -0,0 +1,154 @@
+import uuid
+import datetime
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from .database import async_session
+from .models import ChatMessage, Conversation
+
+DEFAULT_PAGE_SIZE = 50
+
+# Upper bound on messages restored into a chat UI
+MAX_RESTORED_MESSAGES = 200
+
+
+def valid_conversation_id(conversation_id: str) -> bool:
+    """
+    Whether a client-supplied conversation id is a UUID.
+
+    Ids are stored in String(36) columns; a longer one would fail the whole
+    write-behind batch it lands in, so it is turned away before a turn starts.
+    """
+    if not isinstance(conversation_id, str) or len(conversation_id) > 36:
+        return False
+    try:
+        uuid.UUID(conversation_id)
+    except ValueError:
+        return False
+    return True
+
+
+@dataclass
+class HistoryPage:
+    messages: List[Dict]
+    # Pass as `before_seq` to fetch the next (older) page; None when there are no older messages
+    next_cursor: Optional[int]
+
+
+def dialect_insert(dialect_name: str):
+    """The dialect-specific insert() that supports on_conflict_do_update."""
+    if dialect_name == "sqlite":
+        return sqlite.insert
+    return postgresql.insert
+
+
+async def upsert_conversations(session, conversations: Dict[str, str]) -> None:
+    """
+    Make sure conversation rows exist and bump their updated_at.
+
+    Args:
+        session: Open async session; the caller commits
+        conversations: Mapping of conversation id to bot id
+    """
+    if not conversations:
+        return
+
+    now = datetime.datetime.utcnow()
+    insert = dialect_insert(session.bind.dialect.name)
+    statement = insert(Conversation).values([
+        {"id": conversation_id, "bot_id": bot_id, "created_at": now, "updated_at": now}
+        for conversation_id, bot_id in conversations.items()
+    ])
+    await session.execute(statement.on_conflict_do_update(
+        index_elements=[Conversation.id],
+        set_={"updated_at": statement.excluded.updated_at},
+    ))
+
+
+class ConversationRepository:
+    """Async access to conversations and their message history."""
+
+    async def create_conversation(self, bot_id: str) -> str:
+        async with async_session() as session:
+            conversation = Conversation(bot_id=bot_id)
+            session.add(conversation)
+            await session.commit()
+            return conversation.id
+
+    async def get_conversation(self, conversation_id: str) -> Optional[Conversation]:
+        async with async_session() as session:
+            return await session.get(Conversation, conversation_id)
+
+    async def fetch_history(
+        self,
+        conversation_id: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        before_seq: Optional[int] = None,
+    ) -> HistoryPage:
+        """
+        Fetch one page of a conversation, newest messages first in the query.
+
+        Uses keyset pagination on (conversation_id, seq), so each page is an
+        index range scan regardless of how deep into the history it is.
+
+        Args:
+            conversation_id: ID of the conversation
+            limit: Maximum number of messages in the page
+            before_seq: Cursor from the previous page; only older messages are returned
+
+        Returns:
+            HistoryPage with messages in chronological order
+        """
+        query = select(ChatMessage).where(ChatMessage.conversation_id == conversation_id)
+        if before_seq is not None:
+            query = query.where(ChatMessage.seq < before_seq)
+        query = query.order_by(ChatMessage.seq.desc()).limit(limit + 1)
+
+        async with async_session() as session:
+            result = await session.execute(query)
+            rows = list(result.scalars().all())
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+        messages = [
+            {"role": row.role, "content": row.content, "seq": row.seq, "status": row.status, "timestamp": row.timestamp}
+            for row in rows
+        ]
+        next_cursor = rows[0].seq if has_more and rows else None
+        return HistoryPage(messages=messages, next_cursor=next_cursor)
+
+    async def load_history(self, conversation_id: str, max_messages: int = MAX_RESTORED_MESSAGES) -> List[Dict]:
+        """
+        Load the most recent part of a conversation as chat history.
+
+        Args:
+            conversation_id: ID of the conversation
+            max_messages: Maximum number of messages to restore
+
+        Returns:
+            List of {"role", "content", "seq"} dicts in chronological order
+        """
+        messages: List[Dict] = []
+        cursor = None
+        while len(messages) < max_messages:
+            page = await self.fetch_history(
+                conversation_id,
+                limit=min(DEFAULT_PAGE_SIZE, max_messages - len(messages)),
+                before_seq=cursor,
+            )
+            messages = page.messages + messages
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+
+        # The model expects the history to start with a user turn
+        while messages and messages[0]["role"] != "user":
+            messages.pop(0)
+
+        return [{"role": m["role"], "content": m["content"], "seq": m["seq"]} for m in messages]
+
+
+conversations = ConversationRepository()
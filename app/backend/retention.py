@@ -0,0 +1,510 @@
+"""
+Monthly partitions of chat_messages, retention and Parquet archival.
+
+On Postgres chat_messages is partitioned by month on timestamp, with the
+primary key (id, timestamp). Queries with a time range only touch the months
+they cover, and expired months are removed as whole tables instead of being
+deleted row by row. Rows outside every month land in chat_messages_default.
+
+`message_retention` runs in the background of every worker (one at a time,
+under a shared lock) and
+    - creates the partitions for the current and the next PARTITION_PREMAKE months,
+    - exports each month older than CHAT_RETENTION_MONTHS to a zstd-compressed
+      Parquet file in CHAT_ARCHIVE_DIR, then drops its partition,
+    - deletes archive files older than CHAT_ARCHIVE_RETENTION_MONTHS (0 keeps them).
+
+`read_messages` reads a time range across the live partitions and the archive.
+With workers on several nodes CHAT_ARCHIVE_DIR must be storage every node
+mounts, or a node would miss the months another one archived; archiving is
+skipped in multi-worker mode until CHAT_ARCHIVE_SHARED=true says it is.
+
+    python -m app.backend.retention status     # partitions and archive files
+    python -m app.backend.retention maintain   # one maintenance run now
+    python -m app.backend.retention migrate    # convert an unpartitioned chat_messages table
+"""
+import os
+import re
+import asyncio
+import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+from sqlalchemy import select, text
+from .database import async_session, engine
+from .models import ChatMessage
+from .shared_state import shared_state
+from .knowledge.embeddings import EMBEDDING_DIM
+
+# Months kept in the database, the current month included; 0 keeps everything
+CHAT_RETENTION_MONTHS = int(os.getenv("CHAT_RETENTION_MONTHS", "12"))
+CHAT_ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", "archive/chat_messages")
+# Whether every worker sees the same CHAT_ARCHIVE_DIR (a shared mount)
+CHAT_ARCHIVE_SHARED = os.getenv("CHAT_ARCHIVE_SHARED", "false").lower() == "true"
+# Months of archive files kept; 0 keeps them forever
+CHAT_ARCHIVE_RETENTION_MONTHS = int(os.getenv("CHAT_ARCHIVE_RETENTION_MONTHS", "0"))
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", "2"))
+# Seconds between maintenance runs; 0 disables the background job
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+# Rows read from the database per Parquet row group
+ARCHIVE_BATCH_ROWS = 50000
+
+# Shared lock of the partition maintenance, also taken by init_db
+RETENTION_LOCK = "chat_retention"
+
+COLUMNS = ["id", "conversation_id", "bot_id", "seq", "role", "content", "status", "timestamp"]
+DEFAULT_PARTITION = "chat_messages_default"
+PARTITION_NAME = re.compile(r"^chat_messages_(\d{4})_(\d{2})$")
+
+MESSAGE_TABLE_DDL = [
+    "CREATE SEQUENCE IF NOT EXISTS chat_messages_id_seq",
+    f"""
+    CREATE TABLE chat_messages (
+        id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+        conversation_id VARCHAR(36) REFERENCES conversations (id),
+        bot_id VARCHAR,
+        seq INTEGER,
+        role VARCHAR,
+        content TEXT,
+        status VARCHAR,
+        embedding vector({EMBEDDING_DIM}),
+        "timestamp" TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        PRIMARY KEY (id, "timestamp")
+    ) PARTITION BY RANGE ("timestamp")
+    """,
+    "ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_conversation_seq ON chat_messages (conversation_id, seq)",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_bot_timestamp ON chat_messages (bot_id, timestamp)",
+    f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF chat_messages DEFAULT",
+]
+
+# Semantic search over user messages (message_search.py). Only embedded rows are in the HNSW
+# index; the partial index finds the rows still waiting for the embedding worker
+MESSAGE_EMBEDDING_DDL = [
+    f"ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS embedding vector({EMBEDDING_DIM})",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_embedding_hnsw ON chat_messages "
+    "USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)",
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_unembedded ON chat_messages (id) "
+    "WHERE embedding IS NULL AND role = 'user'",
+]
+
+# Indexes of an unpartitioned chat_messages table, renamed out of the way by migrate()
+LEGACY_INDEXES = [
+    "chat_messages_pkey", "ix_chat_messages_id", "ix_chat_messages_conversation_seq", "ix_chat_messages_bot_timestamp",
+    "ix_chat_messages_embedding_hnsw", "ix_chat_messages_unembedded",
+]
+
+
+def month_start(value: datetime.datetime) -> datetime.datetime:
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f"chat_messages_{month:%Y_%m}"
+
+
+def _month_of(name: str) -> Optional[datetime.datetime]:
+    match = PARTITION_NAME.match(Path(name).stem)
+    return datetime.datetime(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+async def table_kind(conn) -> Optional[str]:
+    """'partitioned', 'plain', or None if chat_messages does not exist."""
+    result = await conn.execute(text(
+        "SELECT relkind::text FROM pg_class WHERE oid = to_regclass('chat_messages')"
+    ))
+    kind = result.scalar_one_or_none()
+    if kind is None:
+        return None
+    return "partitioned" if kind == "p" else "plain"
+
+
+async def create_message_table(conn) -> None:
+    """Create chat_messages partitioned by month, unless it already exists."""
+    kind = await table_kind(conn)
+    if kind == "plain":
+        print("chat_messages is not partitioned; run python -m app.backend.retention migrate")
+        return
+    for statement in MESSAGE_TABLE_DDL + MESSAGE_EMBEDDING_DDL:
+        if kind == "partitioned" and statement.lstrip().startswith("CREATE TABLE chat_messages"):
+            continue
+        await conn.execute(text(statement))
+
+
+async def list_partitions(conn) -> List[datetime.datetime]:
+    """Months that have a partition, oldest first."""
+    result = await conn.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = to_regclass('chat_messages')"
+    ))
+    return sorted(month for month in (_month_of(name) for name in result.scalars()) if month)
+
+
+async def create_partition(conn, month: datetime.datetime) -> None:
+    """
+    Attach the partition for `month`.
+
+    Rows of that month already in the default partition are moved into it,
+    otherwise Postgres would refuse to attach the new range.
+    """
+    name = partition_name(month)
+    bounds = {"start": month, "end": add_months(month, 1)}
+    await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} (LIKE chat_messages INCLUDING DEFAULTS)"))
+    await conn.execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        f"WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ), bounds)
+    await conn.execute(text(
+        f"ALTER TABLE chat_messages ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{bounds['end']:%Y-%m-%d}')"
+    ))
+
+
+async def ensure_partitions(conn, now: datetime.datetime = None, ahead: int = PARTITION_PREMAKE) -> List[str]:
+    """
+    Create the partitions from the current month to `ahead` months later, and
+    for any month that has rows in the default partition (so they are archived
+    with their month).
+
+    Returns:
+        Names of the partitions created
+    """
+    if await table_kind(conn) != "partitioned":
+        return []
+    existing = set(await list_partitions(conn))
+    current = month_start(now or datetime.datetime.utcnow())
+    months = {add_months(current, offset) for offset in range(ahead + 1)}
+    result = await conn.execute(text(f"SELECT DISTINCT date_trunc('month', timestamp) FROM {DEFAULT_PARTITION}"))
+    months.update(result.scalars())
+
+    created = []
+    for month in sorted(months - existing):
+        await create_partition(conn, month)
+        created.append(partition_name(month))
+    return created
+
+
+def _frame(rows):
+    import pandas as pd
+    frame = pd.DataFrame.from_records(rows, columns=COLUMNS)
+    # Keep seq an integer column when some rows have none
+    frame["seq"] = frame["seq"].astype("Int32")
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"])
+    return frame
+
+
+def _arrow_table(rows):
+    import pyarrow as pa
+    # Fixed schema: a batch whose values are all NULL must not change a column's type
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("conversation_id", pa.string()),
+        ("bot_id", pa.string()),
+        ("seq", pa.int32()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("status", pa.string()),
+        ("timestamp", pa.timestamp("us")),
+    ])
+    return pa.Table.from_pandas(_frame(rows), schema=schema, preserve_index=False)
+
+
+class MessageRetention:
+    def __init__(
+        self,
+        retention_months: int = CHAT_RETENTION_MONTHS,
+        archive_dir: str = CHAT_ARCHIVE_DIR,
+        archive_retention_months: int = CHAT_ARCHIVE_RETENTION_MONTHS,
+        interval: float = RETENTION_INTERVAL,
+        archive_shared: bool = CHAT_ARCHIVE_SHARED,
+    ):
+        self.retention_months = retention_months
+        self.archive_dir = Path(archive_dir)
+        self.archive_shared = archive_shared
+        self.archive_retention_months = archive_retention_months
+        self.interval = interval
+        self.task: Optional[asyncio.Task] = None
+        self.last_run: Optional[Dict] = None
+
+    def archive_path(self, month: datetime.datetime) -> Path:
+        return self.archive_dir / f"{partition_name(month)}.parquet"
+
+    def archive_files(self) -> Dict[datetime.datetime, Path]:
+        if not self.archive_dir.is_dir():
+            return {}
+        files = {_month_of(path.name): path for path in self.archive_dir.glob("chat_messages_*.parquet")}
+        return {month: path for month, path in sorted(files.items()) if month}
+
+    async def archive_partition(self, month: datetime.datetime) -> int:
+        """
+        Export one month to Parquet and drop its partition.
+
+        The file is written under a temporary name and renamed once complete,
+        and the partition is only dropped after the file's row count matches.
+
+        Returns:
+            Number of rows archived
+        """
+        import pyarrow.parquet as pq
+
+        name = partition_name(month)
+        path = self.archive_path(month)
+        partial = path.with_suffix(".parquet.partial")
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+
+        rows = 0
+        writer = None
+        try:
+            async with engine.connect() as conn:
+                result = await conn.stream(text(f"SELECT {', '.join(COLUMNS)} FROM {name} ORDER BY id"))
+                async for batch in result.partitions(ARCHIVE_BATCH_ROWS):
+                    table = _arrow_table(batch)
+                    if writer is None:
+                        writer = pq.ParquetWriter(partial, table.schema, compression="zstd")
+                    await asyncio.to_thread(writer.write_table, table)
+                    rows += len(batch)
+            if writer is None:
+                # Empty month: still leave a file so the archive covers it
+                empty = _arrow_table([])
+                writer = pq.ParquetWriter(partial, empty.schema, compression="zstd")
+            writer.close()
+            writer = None
+
+            written = pq.ParquetFile(partial).metadata.num_rows
+            if written != rows:
+                raise RuntimeError(f"{partial} has {written} rows, expected {rows}")
+            os.replace(partial, path)
+        finally:
+            if writer is not None:
+                writer.close()
+            if partial.exists():
+                partial.unlink()
+
+        async with engine.begin() as conn:
+            # Rows written since the export (late clocks) would be lost with the partition
+            await conn.execute(text(f"LOCK TABLE {name} IN ACCESS EXCLUSIVE MODE"))
+            result = await conn.execute(text(f"SELECT count(*) FROM {name}"))
+            if result.scalar() != rows:
+                raise RuntimeError(f"{name} changed while it was archived; keeping it for the next run")
+            await conn.execute(text(f"DROP TABLE {name}"))
+        print(f"Archived {rows} messages of {month:%Y-%m} to {path}")
+        return rows
+
+    async def maintain(self, now: datetime.datetime = None) -> Dict:
+        """
+        Create upcoming partitions, archive expired months and prune old archive files.
+
+        Returns:
+            Partitions created, months archived with their row counts, archive files deleted
+        """
+        now = now or datetime.datetime.utcnow()
+        report = {"created": [], "archived": {}, "pruned": []}
+        if engine.dialect.name != "postgresql":
+            return report
+
+        async with engine.begin() as conn:
+            report["created"] = await ensure_partitions(conn, now)
+            months = await list_partitions(conn)
+
+        if self.retention_months > 0:
+            cutoff = add_months(month_start(now), -(self.retention_months - 1))
+            expired = [month for month in months if month < cutoff]
+            if expired and shared_state.distributed and not self.archive_shared:
+                # The file would exist on this node only; keep the partitions instead
+                print(f"Not archiving {len(expired)} expired months: set CHAT_ARCHIVE_SHARED=true "
+                      f"once CHAT_ARCHIVE_DIR is shared by every worker")
+                expired = []
+            for month in expired:
+                report["archived"][f"{month:%Y-%m}"] = await self.archive_partition(month)
+
+        if self.archive_retention_months > 0:
+            cutoff = add_months(month_start(now), -(self.archive_retention_months - 1))
+            for month, path in self.archive_files().items():
+                if month < cutoff:
+                    path.unlink()
+                    report["pruned"].append(path.name)
+
+        self.last_run = {"at": now.isoformat(), **report}
+        return report
+
+    async def run_once(self) -> Optional[Dict]:
+        # One worker at a time; the others skip this round
+        async with shared_state.lock(RETENTION_LOCK, wait=False) as acquired:
+            if not acquired:
+                return None
+            return await self.maintain()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error maintaining chat_messages partitions: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.interval > 0 and engine.dialect.name == "postgresql" and self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def read_messages(
+        self,
+        start: datetime.datetime = None,
+        end: datetime.datetime = None,
+        bot_id: str = None,
+        conversation_id: str = None,
+    ):
+        """
+        Messages in [start, end) from the live partitions and the archive.
+
+        Args:
+            start: Earliest timestamp (UTC), None for no lower bound
+            end: Timestamp (UTC) after the last one wanted, None for no upper bound
+            bot_id: Only this bot's messages
+            conversation_id: Only this conversation's messages
+
+        Returns:
+            pandas DataFrame with the chat_messages columns, ordered by timestamp and id
+        """
+        import pandas as pd
+
+        query = select(*(getattr(ChatMessage, column) for column in COLUMNS))
+        filters = []
+        if start is not None:
+            query = query.where(ChatMessage.timestamp >= start)
+            filters.append(("timestamp", ">=", start))
+        if end is not None:
+            query = query.where(ChatMessage.timestamp < end)
+            filters.append(("timestamp", "<", end))
+        if bot_id is not None:
+            query = query.where(ChatMessage.bot_id == bot_id)
+            filters.append(("bot_id", "==", bot_id))
+        if conversation_id is not None:
+            query = query.where(ChatMessage.conversation_id == conversation_id)
+            filters.append(("conversation_id", "==", conversation_id))
+
+        async with async_session() as session:
+            result = await session.execute(query)
+            frames = [_frame(result.all())]
+
+        # Only the files of months that overlap the range are opened
+        paths = [
+            path for month, path in self.archive_files().items()
+            if (start is None or add_months(month, 1) > start) and (end is None or month < end)
+        ]
+        for path in paths:
+            frames.append(await asyncio.to_thread(pd.read_parquet, path, filters=filters or None))
+
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return _frame([])
+        return pd.concat(frames, ignore_index=True).sort_values(["timestamp", "id"], ignore_index=True)
+
+    async def status(self) -> Dict:
+        live = []
+        kind = None
+        if engine.dialect.name == "postgresql":
+            async with engine.connect() as conn:
+                kind = await table_kind(conn)
+                result = await conn.execute(text(
+                    "SELECT child.relname, child.reltuples::bigint, pg_total_relation_size(child.oid) "
+                    "FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                    "WHERE pg_inherits.inhparent = to_regclass('chat_messages') ORDER BY child.relname"
+                ))
+                live = [{"partition": name, "rows_estimate": max(rows, 0), "bytes": size} for name, rows, size in result.all()]
+
+        archive = []
+        files = self.archive_files()
+        if files:
+            import pyarrow.parquet as pq
+            for month, path in files.items():
+                archive.append({"file": path.name, "rows": pq.ParquetFile(path).metadata.num_rows, "bytes": path.stat().st_size})
+        return {
+            "table": kind,
+            "retention_months": self.retention_months,
+            "archive_retention_months": self.archive_retention_months,
+            "archive_shared": self.archive_shared,
+            "partitions": live,
+            "archive": archive,
+            "last_run": self.last_run,
+        }
+
+
+async def migrate(now: datetime.datetime = None) -> int:
+    """
+    Convert an unpartitioned chat_messages table in place.
+
+    Runs in one transaction that locks the table, so writes wait (the
+    write-behind queue retries and spills) until it commits.
+
+    Returns:
+        Number of rows moved
+    """
+    async with engine.begin() as conn:
+        kind = await table_kind(conn)
+        if kind != "plain":
+            print(f"chat_messages is {kind or 'missing'}; nothing to migrate")
+            return 0
+
+        await conn.execute(text("ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS status VARCHAR"))
+        await conn.execute(text(MESSAGE_EMBEDDING_DDL[0]))
+        await conn.execute(text("ALTER TABLE chat_messages RENAME TO chat_messages_unpartitioned"))
+        for index in LEGACY_INDEXES:
+            await conn.execute(text(f"ALTER INDEX IF EXISTS {index} RENAME TO {index.replace('chat_messages', 'chat_messages_unpartitioned')}"))
+        await create_message_table(conn)
+
+        result = await conn.execute(text("SELECT min(timestamp) FROM chat_messages_unpartitioned"))
+        oldest = result.scalar()
+        current = month_start(now or datetime.datetime.utcnow())
+        month = month_start(oldest) if oldest else current
+        while month < current:
+            await create_partition(conn, month)
+            month = add_months(month, 1)
+        await ensure_partitions(conn, now)
+
+        result = await conn.execute(text(
+            f"INSERT INTO chat_messages ({', '.join(COLUMNS)}, embedding) "
+            "SELECT id, conversation_id, bot_id, seq, role, content, status, COALESCE(timestamp, now() AT TIME ZONE 'utc'), embedding "
+            "FROM chat_messages_unpartitioned"
+        ))
+        await conn.execute(text("DROP TABLE chat_messages_unpartitioned"))
+        print(f"Moved {result.rowcount} messages into monthly partitions")
+        return result.rowcount
+
+
+message_retention = MessageRetention()
+
+
+if __name__ == "__main__":
+    import json
+    import argparse
+
+    parser = argparse.ArgumentParser(description="chat_messages partitions, retention and archive")
+    parser.add_argument("command", choices=["status", "maintain", "migrate"])
+    args = parser.parse_args()
+
+    # Run the package module's singleton: under -m this file is __main__
+    from app.backend import retention
+
+    async def run():
+        try:
+            if args.command == "migrate":
+                await retention.migrate()
+                return await retention.message_retention.status()
+            if args.command == "maintain":
+                return await retention.message_retention.maintain()
+            return await retention.message_retention.status()
+        finally:
+            await engine.dispose()
+
+    print(json.dumps(asyncio.run(run()), indent=2, default=str))
@@ -0,0 +1,296 @@
+"""
+State shared by every worker serving the app.
+
+SHARED_STATE_BACKEND selects where it lives:
+    memory    dictionaries in this process (a single worker, the default)
+    postgres  the shared_state table, with advisory locks for mutual exclusion
+              and LISTEN/NOTIFY to push invalidations to the other workers
+
+Both backends expose the same interface: expiring key/value entries grouped
+in namespaces, named locks, and publish/subscribe on named channels. Callers
+store JSON-serializable strings and never need to know which one is active.
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import datetime
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict, List, Optional
+from sqlalchemy import delete, or_, select, text
+from .database import async_session, engine
+from .models import SharedStateEntry
+from .repository import dialect_insert
+
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+# Entries per namespace kept by the memory backend, least recently used are evicted first
+SHARED_STATE_MAX_ENTRIES = int(os.getenv("SHARED_STATE_MAX_ENTRIES", "10000"))
+# The Postgres backend deletes expired rows every this many writes
+PURGE_EVERY = 200
+# NOTIFY channels are prefixed so they don't collide with other users of the database
+CHANNEL_PREFIX = "ragnode_"
+
+# Identifies this process in published messages and per-worker entries
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+Listener = Callable[[Dict], None]
+
+
+def _lock_id(name: str) -> int:
+    # Advisory locks take a bigint key
+    return int.from_bytes(hashlib.sha256(name.encode("utf-8")).digest()[:8], "big", signed=True)
+
+
+async def lock_transaction(connection, name: str) -> None:
+    """
+    Hold the Postgres advisory lock `name` until the connection's transaction ends.
+
+    It is the lock PostgresSharedState.lock(name) takes, so the two exclude
+    each other; it works whatever SHARED_STATE_BACKEND is.
+    """
+    await connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": _lock_id(name)})
+
+
+class InMemorySharedState:
+    """Shared state for a single worker: everything lives in this process."""
+
+    distributed = False
+
+    def __init__(self, max_entries: int = SHARED_STATE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # namespace -> key -> (expires_at or None, value)
+        self.namespaces: Dict[str, "OrderedDict[str, tuple]"] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.listeners: Dict[str, List[Listener]] = {}
+
+    def _namespace(self, namespace: str) -> "OrderedDict[str, tuple]":
+        entries = self.namespaces.get(namespace)
+        if entries is None:
+            entries = self.namespaces[namespace] = OrderedDict()
+        return entries
+
+    def _live(self, namespace: str, key: str) -> Optional[str]:
+        entries = self._namespace(namespace)
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return value
+
+    async def start(self) -> None:
+        return None
+
+    async def close(self) -> None:
+        return None
+
+    async def get(self, namespace: str, key: str) -> Optional[str]:
+        return self._live(namespace, key)
+
+    async def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> None:
+        entries = self._namespace(namespace)
+        entries[key] = (time.time() + ttl if ttl else None, value)
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    async def add(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        if self._live(namespace, key) is not None:
+            return False
+        await self.set(namespace, key, value, ttl)
+        return True
+
+    async def delete(self, namespace: str, key: str) -> None:
+        self._namespace(namespace).pop(key, None)
+
+    async def items(self, namespace: str) -> Dict[str, str]:
+        now = time.time()
+        return {
+            key: value
+            for key, (expires_at, value) in list(self._namespace(namespace).items())
+            if expires_at is None or expires_at >= now
+        }
+
+    @asynccontextmanager
+    async def lock(self, name: str, wait: bool = True) -> AsyncIterator[bool]:
+        lock = self.locks.setdefault(name, asyncio.Lock())
+        if not wait and lock.locked():
+            yield False
+            return
+        async with lock:
+            yield True
+
+    def subscribe(self, channel: str, listener: Listener) -> None:
+        self.listeners.setdefault(channel, []).append(listener)
+
+    def _deliver(self, channel: str, message: Dict) -> None:
+        for listener in list(self.listeners.get(channel, [])):
+            try:
+                listener(message)
+            except Exception as e:
+                print(f"Error handling {channel} message: {str(e)}")
+
+    async def publish(self, channel: str, message: Dict) -> None:
+        self._deliver(channel, message)
+
+
+class PostgresSharedState(InMemorySharedState):
+    """
+    Shared state for many workers and nodes, stored in Postgres.
+
+    Entries live in the shared_state table. Locks are session-level advisory
+    locks held on a dedicated connection for the duration of the block.
+    Messages are sent with NOTIFY and received on one LISTEN connection per
+    worker; a worker delivers its own messages locally without the round trip.
+    """
+
+    distributed = True
+
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+        self._listen_connection = None
+        self._listening: set = set()
+
+    async def start(self) -> None:
+        if self._listen_connection is None:
+            self._listen_connection = await engine.connect()
+        for channel in list(self.listeners):
+            await self._listen(channel)
+
+    async def close(self) -> None:
+        if self._listen_connection is not None:
+            await self._listen_connection.close()
+            self._listen_connection = None
+            self._listening.clear()
+
+    async def _listen(self, channel: str) -> None:
+        if self._listen_connection is None or channel in self._listening:
+            return
+        raw = await self._listen_connection.get_raw_connection()
+        await raw.driver_connection.add_listener(CHANNEL_PREFIX + channel, self._on_notify)
+        self._listening.add(channel)
+
+    def _on_notify(self, connection, pid, channel: str, payload: str) -> None:
+        try:
+            envelope = json.loads(payload)
+        except ValueError:
+            return
+        if envelope.get("origin") == WORKER_ID:
+            return
+        self._deliver(channel[len(CHANNEL_PREFIX):], envelope["message"])
+
+    def subscribe(self, channel: str, listener: Listener) -> None:
+        super().subscribe(channel, listener)
+        if self._listen_connection is not None:
+            asyncio.ensure_future(self._listen(channel))
+
+    async def publish(self, channel: str, message: Dict) -> None:
+        self._deliver(channel, message)
+        payload = json.dumps({"origin": WORKER_ID, "message": message})
+        async with async_session() as session:
+            await session.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CHANNEL_PREFIX + channel, "payload": payload},
+            )
+            await session.commit()
+
+    @staticmethod
+    def _expiry(ttl: Optional[float]) -> Optional[datetime.datetime]:
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl) if ttl else None
+
+    @staticmethod
+    def _not_expired():
+        return or_(SharedStateEntry.expires_at.is_(None), SharedStateEntry.expires_at > datetime.datetime.utcnow())
+
+    async def get(self, namespace: str, key: str) -> Optional[str]:
+        async with async_session() as session:
+            result = await session.execute(
+                select(SharedStateEntry.value).where(
+                    SharedStateEntry.namespace == namespace,
+                    SharedStateEntry.key == key,
+                    self._not_expired(),
+                )
+            )
+            return result.scalar_one_or_none()
+
+    async def _upsert(self, namespace: str, key: str, value: str, ttl: Optional[float], only_if_expired: bool) -> bool:
+        async with async_session() as session:
+            insert = dialect_insert(session.bind.dialect.name)
+            statement = insert(SharedStateEntry).values(
+                namespace=namespace, key=key, value=value, expires_at=self._expiry(ttl),
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[SharedStateEntry.namespace, SharedStateEntry.key],
+                set_={"value": statement.excluded.value, "expires_at": statement.excluded.expires_at},
+                # add(): only take over an entry that has expired
+                where=(SharedStateEntry.expires_at <= datetime.datetime.utcnow()) if only_if_expired else None,
+            ).returning(SharedStateEntry.key)
+            result = await session.execute(statement)
+            written = result.first() is not None
+
+            self.writes += 1
+            if self.writes % PURGE_EVERY == 0:
+                await session.execute(delete(SharedStateEntry).where(
+                    SharedStateEntry.expires_at <= datetime.datetime.utcnow()
+                ))
+            await session.commit()
+            return written
+
+    async def set(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await self._upsert(namespace, key, value, ttl, only_if_expired=False)
+
+    async def add(self, namespace: str, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        return await self._upsert(namespace, key, value, ttl, only_if_expired=True)
+
+    async def delete(self, namespace: str, key: str) -> None:
+        async with async_session() as session:
+            await session.execute(delete(SharedStateEntry).where(
+                SharedStateEntry.namespace == namespace,
+                SharedStateEntry.key == key,
+            ))
+            await session.commit()
+
+    async def items(self, namespace: str) -> Dict[str, str]:
+        async with async_session() as session:
+            result = await session.execute(
+                select(SharedStateEntry.key, SharedStateEntry.value).where(
+                    SharedStateEntry.namespace == namespace,
+                    self._not_expired(),
+                )
+            )
+            return {key: value for key, value in result.all()}
+
+    @asynccontextmanager
+    async def lock(self, name: str, wait: bool = True) -> AsyncIterator[bool]:
+        lock_id = _lock_id(name)
+        async with engine.connect() as connection:
+            if wait:
+                await connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": lock_id})
+                acquired = True
+            else:
+                result = await connection.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": lock_id})
+                acquired = bool(result.scalar())
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    await connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": lock_id})
+                await connection.rollback()
+
+
+def create_shared_state(backend: str = SHARED_STATE_BACKEND):
+    if backend == "postgres":
+        return PostgresSharedState()
+    if backend != "memory":
+        raise ValueError(f"Unknown SHARED_STATE_BACKEND: {backend}")
+    return InMemorySharedState()
+
+
+shared_state = create_shared_state()
@@ -0,0 +1,264 @@
+"""
+Static assets with content-hashed URLs, precompressed variants and ETags.
+
+Every file in app/static is hashed when the app starts. Pages link to assets
+through `asset_url("styles.css")`, which gives `/static/styles.<hash>.css`;
+that URL never changes content, so it is served with a year-long immutable
+Cache-Control and browsers stop asking for it. The plain name keeps working
+with `Cache-Control: no-cache` and an ETag, so a revalidation costs a 304.
+
+Text assets are served gzip- or brotli-compressed when the client accepts it.
+The compressed variants are built ahead of time into STATIC_BUILD_DIR:
+
+    python -m app.backend.static_assets build
+
+Files without a current build are compressed once at startup instead. Brotli
+needs the optional `brotli` package; without it only gzip is offered.
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import hashlib
+import mimetypes
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+
+STATIC_DIR = "app/static"
+STATIC_BUILD_DIR = os.getenv("STATIC_BUILD_DIR", "app/static/.build")
+# Page cache and hashed/precompressed assets; false serves the templates and files as they are
+WEB_CACHE_ENABLED = os.getenv("WEB_CACHE_ENABLED", "true").lower() == "true"
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+HASH_LENGTH = 10
+# Smaller bodies gain nothing worth a Content-Encoding
+MIN_COMPRESS_SIZE = 256
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+HASHED_NAME = re.compile(rf"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{{{HASH_LENGTH}}})(?P<suffix>\.[^./]+)$")
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def content_type(name: str) -> str:
+    kind = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return f"{kind}; charset=utf-8" if kind.startswith("text/") else kind
+
+
+def compress(body: bytes, kind: str) -> Dict[str, bytes]:
+    """The encoded variants of `body` that are smaller than it, by encoding."""
+    if len(body) < MIN_COMPRESS_SIZE or not kind.startswith(COMPRESSIBLE_TYPES):
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    brotli = _brotli()
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=11)
+    return {encoding: data for encoding, data in variants.items() if len(data) < len(body)}
+
+
+def accepted_encodings(request: Request) -> List[str]:
+    """Encodings the client accepts (q > 0), best first."""
+    accepted = {}
+    for part in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if name and quality > 0:
+            accepted[name.strip().lower()] = quality
+    # Brotli first at equal quality: it is the smaller one
+    preference = {"br": 0, "gzip": 1}
+    return sorted(accepted, key=lambda name: (-accepted[name], preference.get(name, 2)))
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as If-None-Match asks for
+    return etag in {tag.strip().removeprefix("W/") for tag in header.split(",")}
+
+
+@dataclass
+class Encoded:
+    """One resource with its compressed variants, ready to serve."""
+    body: bytes
+    content_type: str
+    tag: str
+    variants: Dict[str, bytes] = field(default_factory=dict)
+
+    @classmethod
+    def build(cls, body: bytes, content_type: str) -> "Encoded":
+        return cls(body, content_type, hashlib.sha256(body).hexdigest()[:HASH_LENGTH], compress(body, content_type))
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        """
+        The response for `request`: the best encoding it accepts, or 304 if its ETag is current.
+
+        Each encoding has its own strong ETag, as the bytes differ.
+        """
+        encoding = next((name for name in accepted_encodings(request) if name in self.variants), None)
+        etag = f'"{self.tag}-{encoding}"' if encoding else f'"{self.tag}"'
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if self.variants:
+            headers["Vary"] = "Accept-Encoding"
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        body = self.variants[encoding] if encoding else self.body
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, headers=headers, media_type=self.content_type)
+
+
+def _read_manifest(build_dir: Path) -> Dict:
+    try:
+        return json.loads((build_dir / "manifest.json").read_text())["assets"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def _read_build(build_dir: Path, manifest: Dict, name: str, tag: str) -> Optional[Dict[str, bytes]]:
+    """Variants of `name` from the build directory, if it was built from this content."""
+    try:
+        entry = manifest[name]
+        if entry["hash"] != tag:
+            return None
+        return {encoding: (build_dir / path).read_bytes() for encoding, path in entry["variants"].items()}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class StaticAssets:
+    """ASGI app serving STATIC_DIR from memory; mount it at /static."""
+
+    def __init__(self, directory: str = STATIC_DIR, build_dir: str = STATIC_BUILD_DIR, prefix: str = "/static"):
+        self.directory = Path(directory)
+        self.build_dir = Path(build_dir)
+        self.prefix = prefix
+        self.assets: Dict[str, Encoded] = {}
+        self.prebuilt = 0
+
+    def load(self, use_build: bool = True) -> "StaticAssets":
+        """Hash every file and pick up (or make) its compressed variants."""
+        assets = {}
+        prebuilt = 0
+        manifest = _read_manifest(self.build_dir) if use_build else {}
+        for path in sorted(self.directory.rglob("*")):
+            name = path.relative_to(self.directory).as_posix()
+            # Dot directories hold build output, not assets
+            if not path.is_file() or any(part.startswith(".") for part in name.split("/")):
+                continue
+            body = path.read_bytes()
+            kind = content_type(name)
+            tag = hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+            variants = _read_build(self.build_dir, manifest, name, tag)
+            if variants is None:
+                variants = compress(body, kind)
+            else:
+                prebuilt += 1
+            assets[name] = Encoded(body, kind, tag, variants)
+        self.assets = assets
+        self.prebuilt = prebuilt
+        return self
+
+    def url(self, name: str) -> str:
+        """Content-hashed URL of an asset (the plain URL for files that do not exist)."""
+        asset = self.assets.get(name)
+        stem, dot, suffix = name.rpartition(".")
+        if asset is None or not dot:
+            return f"{self.prefix}/{name}"
+        return f"{self.prefix}/{stem}.{asset.tag}.{suffix}"
+
+    def resolve(self, name: str):
+        """(asset, immutable) for a requested file name, hashed or not."""
+        asset = self.assets.get(name)
+        if asset is not None:
+            return asset, False
+        match = HASHED_NAME.match(name)
+        if match is not None:
+            asset = self.assets.get(match["stem"] + match["suffix"])
+            if asset is not None:
+                # An old hash (a page from before a deploy) still gets the current file, just not for keeps
+                return asset, asset.tag == match["hash"]
+        return None, False
+
+    async def __call__(self, scope, receive, send) -> None:
+        request = Request(scope, receive)
+        if request.method not in ("GET", "HEAD"):
+            response = PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        else:
+            asset, immutable = self.resolve(scope["path"][len(scope.get("root_path", "")):].lstrip("/"))
+            if asset is None:
+                response = PlainTextResponse("Not Found", status_code=404)
+            else:
+                response = asset.response(request, IMMUTABLE if immutable else REVALIDATE)
+        await response(scope, receive, send)
+
+    def stats(self) -> Dict:
+        return {
+            "assets": len(self.assets),
+            "prebuilt": self.prebuilt,
+            "brotli": _brotli() is not None,
+            "bytes": sum(len(asset.body) for asset in self.assets.values()),
+            "gzip_bytes": sum(len(asset.variants.get("gzip", asset.body)) for asset in self.assets.values()),
+        }
+
+
+def build(directory: str = STATIC_DIR, build_dir: str = STATIC_BUILD_DIR) -> Dict:
+    """Write the compressed variants of every asset, and a manifest, to `build_dir`."""
+    output = Path(build_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    # Compressed from scratch: the previous build may be stale
+    assets = StaticAssets(directory, build_dir).load(use_build=False)
+
+    manifest = {"assets": {}}
+    for name, asset in assets.assets.items():
+        entry = {"hash": asset.tag, "size": len(asset.body), "variants": {}}
+        for encoding, data in asset.variants.items():
+            path = f"{name}.{asset.tag}.{encoding}"
+            (output / path).parent.mkdir(parents=True, exist_ok=True)
+            (output / path).write_bytes(data)
+            entry["variants"][encoding] = path
+            entry[encoding] = len(data)
+        manifest["assets"][name] = entry
+    (output / "manifest.json").write_text(json.dumps(manifest, indent=2))
+
+    current = {path for entry in manifest["assets"].values() for path in entry["variants"].values()}
+    for path in output.rglob("*"):
+        relative = path.relative_to(output).as_posix()
+        if path.is_file() and relative != "manifest.json" and relative not in current:
+            path.unlink()
+    return manifest
+
+
+static_assets = StaticAssets()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["build"]:
+        print("Usage: python -m app.backend.static_assets build")
+        sys.exit(2)
+    manifest = build()
+    for name, entry in manifest["assets"].items():
+        sizes = ", ".join(f"{encoding} {entry[encoding]}" for encoding in entry["variants"])
+        print(f"{name:<28} {entry['size']:>7} bytes  {sizes or 'not compressed'}")
+    if _brotli() is None:
+        print("brotli is not installed: only gzip variants were built")
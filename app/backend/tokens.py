@@ -0,0 +1,20 @@
+import math
+
+# Claude tokenizes English prose at roughly four characters per token. This is
+# only used for budgeting, so an offline approximation is good enough.
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate the number of model tokens in a piece of text.
+
+    Args:
+        text: The text to measure
+
+    Returns:
+        Estimated token count
+    """
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
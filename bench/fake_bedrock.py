@@ -0,0 +1,262 @@
+"""
+Local stand-in for the Bedrock runtime Messages API.
+
+Serves InvokeModel and InvokeModelWithResponseStream for Anthropic models with
+a configurable time-to-first-token, token rate, error rate and throttling, so
+the app can be load-tested without AWS. Point the app at it with
+
+    ANTHROPIC_BEDROCK_BASE_URL=http://127.0.0.1:8900
+
+(any AWS_BEDROCK_ACCESS_KEY / AWS_BEDROCK_SECRET_KEY will do; requests are
+signed but the signature is not checked).
+
+    python -m bench.fake_bedrock --port 8900 --ttft 0.5 --tokens-per-sec 80
+"""
+import json
+import uuid
+import random
+import struct
+import base64
+import asyncio
+import argparse
+import binascii
+import uvicorn
+from dataclasses import dataclass, fields
+from typing import Dict, Iterator
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "the of and to in is you that it he was for on are as with his they at be this have from "
+    "or one had by word but not what all were we when your can said there use an each which "
+    "she do how their if will up other about out many then them these so some her would make "
+    "like him into time has look two more write go see number no way could people my than first"
+).split()
+
+
+@dataclass
+class FakeBedrockSettings:
+    ttft: float = 0.5               # seconds until the first token
+    ttft_jitter: float = 0.1        # +/- uniform jitter on the first token
+    tokens_per_sec: float = 60.0    # token rate after the first token
+    tokens: int = 200               # tokens per answer, capped by the request's max_tokens
+    tokens_per_event: int = 1       # tokens carried by each content_block_delta
+    error_rate: float = 0.0         # fraction of streams that fail midway
+    throttle_rate: float = 0.0      # fraction of requests rejected with 429
+    max_concurrent: int = 0         # requests over this many in flight get 429 (0 = unlimited)
+    slow_rate: float = 0.0          # fraction of streams whose first token takes slow_ttft
+    slow_ttft: float = 5.0          # seconds until the first token of a slow stream
+    slow_prefix: str = ""           # only models starting with this (e.g. "us.") are slow ("" = all)
+    seed: int = 0                   # random seed (0 = unseeded)
+
+
+def encode_event(payload: Dict, message_type: str = "event", event_type: str = "chunk") -> bytes:
+    """Encode one AWS event stream message (the binary framing Bedrock streams use)."""
+    if message_type == "event":
+        headers = {":event-type": event_type, ":content-type": "application/json", ":message-type": "event"}
+        body = {"bytes": base64.b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")}
+    else:
+        headers = {":exception-type": event_type, ":content-type": "application/json", ":message-type": "exception"}
+        body = payload
+
+    header_bytes = b""
+    for name, value in headers.items():
+        name_bytes = name.encode("utf-8")
+        value_bytes = value.encode("utf-8")
+        # Header value type 7 is a string with a 2-byte length
+        header_bytes += struct.pack("!B", len(name_bytes)) + name_bytes
+        header_bytes += struct.pack("!BH", 7, len(value_bytes)) + value_bytes
+
+    payload_bytes = json.dumps(body).encode("utf-8")
+    total_length = 12 + len(header_bytes) + len(payload_bytes) + 4
+    prelude = struct.pack("!II", total_length, len(header_bytes))
+    prelude += struct.pack("!I", binascii.crc32(prelude) & 0xFFFFFFFF)
+    message = prelude + header_bytes + payload_bytes
+    return message + struct.pack("!I", binascii.crc32(message) & 0xFFFFFFFF)
+
+
+class FakeBedrock:
+    def __init__(self, settings: FakeBedrockSettings):
+        self.settings = settings
+        self.random = random.Random(settings.seed or None)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.counts = {"requests": 0, "streams": 0, "throttled": 0, "errors": 0, "tokens": 0, "slow": 0, "cancelled": 0}
+
+    def answer_tokens(self, max_tokens: int) -> Iterator[str]:
+        for index in range(min(self.settings.tokens, max_tokens)):
+            word = self.random.choice(WORDS)
+            yield (word.capitalize() if index == 0 else word) + " "
+
+    def throttled(self) -> bool:
+        over_limit = self.settings.max_concurrent and self.in_flight >= self.settings.max_concurrent
+        if over_limit or self.random.random() < self.settings.throttle_rate:
+            self.counts["throttled"] += 1
+            return True
+        return False
+
+    async def first_token_delay(self, model: str = "") -> None:
+        jitter = self.random.uniform(-self.settings.ttft_jitter, self.settings.ttft_jitter)
+        ttft = self.settings.ttft
+        if model.startswith(self.settings.slow_prefix) and self.random.random() < self.settings.slow_rate:
+            self.counts["slow"] += 1
+            ttft = self.settings.slow_ttft
+        await asyncio.sleep(max(0.0, ttft + jitter))
+
+    def message_start(self, model: str, input_tokens: int) -> Dict:
+        return {
+            "type": "message_start",
+            "message": {
+                "id": f"msg_bdrk_{uuid.uuid4().hex[:24]}",
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [],
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 1},
+            },
+        }
+
+    def _enter(self) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def stream(self, model: str, body: Dict):
+        self._enter()
+        self.counts["streams"] += 1
+        finished = False
+        try:
+            max_tokens = body.get("max_tokens", 1024)
+            fail_at = None
+            if self.random.random() < self.settings.error_rate:
+                fail_at = self.random.randint(0, max(0, min(self.settings.tokens, max_tokens) - 1))
+
+            yield encode_event(self.message_start(model, _input_tokens(body)))
+            await self.first_token_delay(model)
+            yield encode_event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+
+            interval = self.settings.tokens_per_event / self.settings.tokens_per_sec if self.settings.tokens_per_sec > 0 else 0.0
+            output_tokens = 0
+            pending = []
+            for index, token in enumerate(self.answer_tokens(max_tokens)):
+                if fail_at is not None and index == fail_at:
+                    self.counts["errors"] += 1
+                    finished = True
+                    yield encode_event(
+                        {"message": "The system encountered an unexpected error during processing. Try your request again."},
+                        message_type="exception",
+                        event_type="modelStreamErrorException",
+                    )
+                    return
+                pending.append(token)
+                output_tokens += 1
+                if len(pending) >= self.settings.tokens_per_event:
+                    if output_tokens > len(pending):
+                        await asyncio.sleep(interval)
+                    yield encode_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "".join(pending)}})
+                    pending = []
+            if pending:
+                yield encode_event({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "".join(pending)}})
+
+            self.counts["tokens"] += output_tokens
+            stop_reason = "max_tokens" if output_tokens >= max_tokens else "end_turn"
+            yield encode_event({"type": "content_block_stop", "index": 0})
+            yield encode_event({
+                "type": "message_delta",
+                "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                "usage": {"output_tokens": output_tokens},
+            })
+            finished = True
+            yield encode_event({"type": "message_stop"})
+        finally:
+            # A stream closed early was aborted by the client (a hedge loser or a disconnect)
+            if not finished:
+                self.counts["cancelled"] += 1
+            self.in_flight -= 1
+
+    async def invoke(self, model: str, body: Dict) -> Dict:
+        self._enter()
+        try:
+            max_tokens = body.get("max_tokens", 1024)
+            tokens = list(self.answer_tokens(max_tokens))
+            await self.first_token_delay(model)
+            if self.settings.tokens_per_sec > 0:
+                await asyncio.sleep(len(tokens) / self.settings.tokens_per_sec)
+            self.counts["tokens"] += len(tokens)
+            return {
+                **self.message_start(model, _input_tokens(body))["message"],
+                "content": [{"type": "text", "text": "".join(tokens)}],
+                "stop_reason": "max_tokens" if len(tokens) >= max_tokens else "end_turn",
+                "usage": {"input_tokens": _input_tokens(body), "output_tokens": len(tokens)},
+            }
+        finally:
+            self.in_flight -= 1
+
+
+def _input_tokens(body: Dict) -> int:
+    text = json.dumps(body.get("messages", [])) + str(body.get("system") or "")
+    return max(1, len(text) // 4)
+
+
+def throttling_response() -> JSONResponse:
+    return JSONResponse(
+        {"message": "Too many requests, please wait before trying again."},
+        status_code=429,
+        headers={"x-amzn-ErrorType": "ThrottlingException"},
+    )
+
+
+def create_app(settings: FakeBedrockSettings = None) -> FastAPI:
+    fake = FakeBedrock(settings or FakeBedrockSettings())
+    app = FastAPI()
+    app.state.fake = fake
+
+    @app.get("/")
+    async def root():
+        # Target of the client pool's pre-warm request
+        return {"fake_bedrock": True}
+
+    @app.get("/stats")
+    async def stats():
+        return {"in_flight": fake.in_flight, "peak_in_flight": fake.peak_in_flight, **fake.counts}
+
+    @app.post("/model/{model_id}/invoke-with-response-stream")
+    async def invoke_with_response_stream(model_id: str, request: Request):
+        fake.counts["requests"] += 1
+        if fake.throttled():
+            return throttling_response()
+        body = await request.json()
+        return StreamingResponse(
+            fake.stream(model_id, body),
+            media_type="application/vnd.amazon.eventstream",
+            headers={"x-amzn-bedrock-content-type": "application/json"},
+        )
+
+    @app.post("/model/{model_id}/invoke")
+    async def invoke(model_id: str, request: Request):
+        fake.counts["requests"] += 1
+        if fake.throttled():
+            return throttling_response()
+        body = await request.json()
+        return JSONResponse(await fake.invoke(model_id, body))
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    defaults = FakeBedrockSettings()
+    for field in fields(FakeBedrockSettings):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type, default=getattr(defaults, field.name))
+    args = parser.parse_args()
+
+    settings = FakeBedrockSettings(**{field.name: getattr(args, field.name) for field in fields(FakeBedrockSettings)})
+    print(f"Fake Bedrock on http://{args.host}:{args.port}: {settings}")
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Tail latency with and without hedged model calls, against a slow fake upstream.
+
+Starts bench.fake_bedrock so that a fraction of the streams on the primary
+model prefix stall before their first token, then runs the same turns through
+BaseChat twice: without hedging, and with hedging to an alternate prefix that
+is never slow. Reports time-to-first-token percentiles for both and checks that
+
+    tail      p99 time to first token with hedging stays under the stall
+    cap       hedges stay within max_rate of the calls (plus the saved burst)
+    cancel    every race loser was aborted upstream
+
+    python -m bench.hedging --turns 200 --concurrency 10 --slow-rate 0.1 --max-rate 0.2
+
+Run with --max-rate below --slow-rate to see the cap hold while the tail
+comes back. Exits 1 if a check fails.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import asyncio
+from typing import Dict, List, Optional
+from .load import RESULTS_DIR, distribution_ms, fake_bedrock_stats, start_fake_bedrock
+
+PRIMARY_PREFIX = "us"
+HEDGE_PREFIX = "eu"
+
+
+async def run_turns(args, chat, label: str) -> Dict:
+    from app.backend.chat.streaming import ResponseText
+
+    ttfts: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def turn(index: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            first: Optional[float] = None
+            response = ResponseText()
+            text = ""
+            async for event in chat.stream(f"{label} question {index} {uuid.uuid4().hex[:6]}", [], conversation_id=str(uuid.uuid4())):
+                text = response.apply(event)
+                if event.kind != "status" and first is None:
+                    first = time.perf_counter() - started
+            if first is None or text.startswith(("Error", "Streaming error")):
+                errors += 1
+            else:
+                ttfts.append(first)
+
+    before = fake_bedrock_stats() or {}
+    await asyncio.gather(*(turn(index) for index in range(args.turns)))
+    after = fake_bedrock_stats() or {}
+    return {
+        "ttft_ms": distribution_ms(ttfts),
+        "errors": errors,
+        "fake": {key: after.get(key, 0) - before.get(key, 0) for key in ("streams", "slow", "cancelled")},
+    }
+
+
+async def run(args) -> Dict:
+    from app.backend.database import init_db
+    from app.backend.persistence import message_writer
+    from app.backend.chat.interface import ChatInterface
+    from app.backend.chat.hedging import HedgeSettings, Hedger
+
+    await init_db()
+    chat = ChatInterface(bot_id=args.bot).chat
+    chat.response_cache = None
+    chat.router = None
+
+    try:
+        chat.hedger = None
+        baseline = await run_turns(args, chat, "baseline")
+
+        settings = HedgeSettings(
+            enabled=True, deadline=args.deadline, max_rate=args.max_rate, burst=args.burst,
+            region_prefix=HEDGE_PREFIX,
+        )
+        chat.hedger = Hedger(args.bot, settings)
+        hedged = await run_turns(args, chat, "hedged")
+        hedged["calls"] = chat.hedger.calls
+        hedged["hedges"] = chat.hedger.hedged
+    finally:
+        await message_writer.close()
+    return {"baseline": baseline, "hedged": hedged}
+
+
+def checks(args, results: Dict) -> List:
+    baseline, hedged = results["baseline"], results["hedged"]
+    p99 = hedged["ttft_ms"].get("p99")
+    allowed = int(args.max_rate * hedged["calls"] + args.burst)
+    # With the cap below the slow rate, some stalls cannot be hedged
+    tail_expected = args.max_rate >= args.slow_rate * 1.5
+    return [
+        ("tail", (p99 is not None and p99 < args.slow_ttft * 1000) or not tail_expected,
+         f"p99 {baseline['ttft_ms'].get('p99')} -> {p99} ms (stall {args.slow_ttft * 1000:.0f} ms"
+         f"{'' if tail_expected else ', not expected under this cap'})"),
+        ("cap", hedged["hedges"] <= allowed,
+         f"{hedged['hedges']} hedges for {hedged['calls']} calls (allowed {allowed} at max_rate {args.max_rate})"),
+        ("cancel", hedged["fake"]["cancelled"] == hedged["hedges"],
+         f"{hedged['fake']['cancelled']} streams aborted upstream for {hedged['hedges']} races"),
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bot", default="baden-guide")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--slow-rate", type=float, default=0.1, help="fraction of primary streams that stall")
+    parser.add_argument("--slow-ttft", type=float, default=4.0, help="seconds a stalled stream takes to its first token")
+    parser.add_argument("--deadline", type=float, default=1.0, help="hedging deadline in seconds")
+    parser.add_argument("--max-rate", type=float, default=0.2, help="hedging max_rate")
+    parser.add_argument("--burst", type=float, default=2.0, help="hedging burst")
+    parser.add_argument("--fake-port", type=int, default=8900)
+    args = parser.parse_args()
+    args.fake_args = (
+        f"--ttft 0.2 --ttft-jitter 0.05 --tokens 40 --tokens-per-sec 400 --seed 7 "
+        f"--slow-rate {args.slow_rate} --slow-ttft {args.slow_ttft} --slow-prefix {PRIMARY_PREFIX}."
+    )
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"hedging-{os.getpid()}.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+    os.environ["AWS_BEDROCK_REGION_PREFIX"] = PRIMARY_PREFIX
+    os.environ.setdefault("METRICS_TRACING", "false")
+
+    fake = start_fake_bedrock(args)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        fake.terminate()
+        fake.wait()
+        if os.path.exists(path):
+            os.remove(path)
+
+    for label in ("baseline", "hedged"):
+        stats = results[label]["ttft_ms"]
+        print(f"{label:9} ttft p50 {stats.get('p50'):>8} p95 {stats.get('p95'):>8} p99 {stats.get('p99'):>8} max {stats.get('max'):>8}"
+              f"  slow streams {results[label]['fake']['slow']}, errors {results[label]['errors']}")
+    failed = 0
+    for name, ok, detail in checks(args, results):
+        failed += not ok
+        print(f"{'PASS' if ok else 'FAIL'}  {name:7} {detail}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""
+Load generator for the chat service.
+
+Runs N concurrent chat sessions of several turns each, either in-process
+against BaseChat (--target chat) or over HTTP against a running server through
+the Gradio queue API (--target http), and reports time-to-first-token,
+inter-chunk latency, throughput, CPU, RSS and thread counts. Results are saved
+as JSON; pass --compare with an earlier result to flag regressions.
+
+    # Everything local: fake Bedrock in a subprocess, SQLite instead of Postgres
+    python -m bench.load --fake --database sqlite --sessions 50 --turns 3
+
+    # A running server (started with ANTHROPIC_BEDROCK_BASE_URL pointing at bench.fake_bedrock)
+    python -m bench.load --target http --url http://127.0.0.1:8000 --server-pid 1234
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import shlex
+import argparse
+import asyncio
+import datetime
+import platform
+import subprocess
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+RESULTS_DIR = "bench/results"
+
+# Text shown while a turn waits (before the answer starts)
+STATUS_PREFIXES = ("Thinking", "Waiting for a free slot")
+ERROR_PREFIXES = ("Error:", "Streaming error:")
+BUSY_PREFIX = "This bot is handling a lot of questions"
+
+
+@dataclass
+class TurnResult:
+    session: int
+    turn: int
+    ok: bool
+    ttft: Optional[float]       # seconds from sending the message to the first answer text
+    total: float                # seconds until the answer was complete
+    chunks: int
+    chars: int
+    gaps: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def distribution_ms(values: List[float]) -> Dict:
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+def classify(text: str) -> Optional[str]:
+    if text.startswith(BUSY_PREFIX):
+        return "busy"
+    if text.startswith(ERROR_PREFIXES):
+        return text[:200]
+    return None
+
+
+class ResourceSampler:
+    """Samples CPU, RSS and thread count of a process from /proc (self when pid is None)."""
+
+    def __init__(self, pid: Optional[int] = None, interval: float = 0.5):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.samples: List[Dict] = []
+        self._task: Optional[asyncio.Task] = None
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def _read(self) -> Optional[Dict]:
+        try:
+            with open(f"/proc/{self.pid}/stat") as file:
+                # Fields after the command name; utime and stime are the 12th and 13th
+                stat = file.read().rsplit(")", 1)[1].split()
+            cpu_seconds = (int(stat[11]) + int(stat[12])) / self._ticks
+            status = {}
+            with open(f"/proc/{self.pid}/status") as file:
+                for line in file:
+                    key, _, value = line.partition(":")
+                    status[key] = value.strip()
+            return {
+                "cpu_seconds": cpu_seconds,
+                "rss_mb": int(status["VmRSS"].split()[0]) / 1024,
+                "threads": int(status["Threads"]),
+            }
+        except (OSError, KeyError, IndexError, ValueError):
+            if self.pid != os.getpid():
+                return None
+            # Not Linux: only the own process can be sampled
+            import resource
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            scale = 1024 * 1024 if platform.system() == "Darwin" else 1024
+            return {
+                "cpu_seconds": usage.ru_utime + usage.ru_stime,
+                "rss_mb": usage.ru_maxrss / scale,
+                "threads": threading.active_count(),
+            }
+
+    async def _run(self) -> None:
+        previous = self._read()
+        previous_time = time.perf_counter()
+        while True:
+            await asyncio.sleep(self.interval)
+            current = self._read()
+            now = time.perf_counter()
+            if current is None or previous is None:
+                previous, previous_time = current, now
+                continue
+            cpu_percent = (current["cpu_seconds"] - previous["cpu_seconds"]) / (now - previous_time) * 100
+            self.samples.append({"cpu_percent": cpu_percent, "rss_mb": current["rss_mb"], "threads": current["threads"]})
+            previous, previous_time = current, now
+
+    def start(self) -> None:
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> Dict:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if not self.samples:
+            return {"pid": self.pid, "samples": 0}
+        cpu = [sample["cpu_percent"] for sample in self.samples]
+        rss = [sample["rss_mb"] for sample in self.samples]
+        threads = [sample["threads"] for sample in self.samples]
+        return {
+            "pid": self.pid,
+            "samples": len(self.samples),
+            "cpu_percent": {"mean": round(sum(cpu) / len(cpu), 1), "max": round(max(cpu), 1)},
+            "rss_mb": {"start": round(rss[0], 1), "mean": round(sum(rss) / len(rss), 1), "max": round(max(rss), 1)},
+            "threads": {"mean": round(sum(threads) / len(threads), 1), "max": max(threads)},
+        }
+
+
+def prompts_for(args, examples: List[str]) -> List[str]:
+    base = examples or ["Tell me something interesting."]
+    return [
+        prompt if args.repeat_prompts else f"{prompt} (session {{session}}, turn {{turn}})"
+        for prompt in base
+    ]
+
+
+class TurnTimer:
+    def __init__(self, session: int, turn: int):
+        self.session = session
+        self.turn = turn
+        self.started = time.perf_counter()
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.gaps: List[float] = []
+        self.chunks = 0
+
+    def content(self) -> None:
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        else:
+            self.gaps.append(now - self.last)
+        self.last = now
+        self.chunks += 1
+
+    def result(self, text: str, error: Optional[str] = None) -> TurnResult:
+        error = error or classify(text)
+        return TurnResult(
+            session=self.session,
+            turn=self.turn,
+            ok=error is None,
+            ttft=self.first - self.started if self.first is not None else None,
+            total=time.perf_counter() - self.started,
+            chunks=self.chunks,
+            chars=len(text),
+            gaps=self.gaps,
+            error=error,
+        )
+
+
+async def run_chat_target(args, results: List[TurnResult]) -> None:
+    # Imported here so --database/--fake have set the environment first
+    from app.backend.database import init_db
+    from app.backend.persistence import message_writer
+    from app.backend.chat.interface import ChatInterface
+    from app.backend.chat.streaming import ResponseText
+
+    if args.database == "sqlite":
+        await init_db()
+
+    interface = ChatInterface(bot_id=args.bot)
+    chat = interface.chat
+    if not args.cache:
+        chat.response_cache = None
+    mode = args.stream_mode or chat.stream_settings.mode
+    prompts = prompts_for(args, interface.get_examples())
+
+    async def session(index: int) -> None:
+        await asyncio.sleep(args.ramp * index / max(1, args.sessions))
+        history: List[Dict] = []
+        conversation_id = str(uuid.uuid4())
+        for turn in range(args.turns):
+            message = prompts[(index + turn) % len(prompts)].format(session=index, turn=turn)
+            timer = TurnTimer(index, turn)
+            text = ""
+            try:
+                if mode == "cumulative":
+                    async for text in chat.get_response(message, history, conversation_id=conversation_id):
+                        if not text.startswith(STATUS_PREFIXES):
+                            timer.content()
+                else:
+                    response = ResponseText()
+                    async for event in chat.stream(message, history, conversation_id=conversation_id):
+                        text = response.apply(event)
+                        if event.kind != "status":
+                            timer.content()
+                results.append(timer.result(text))
+            except Exception as e:
+                results.append(timer.result(text, error=f"{type(e).__name__}: {e}"))
+            history += [{"role": "user", "content": message}, {"role": "assistant", "content": text}]
+            await asyncio.sleep(args.think_time)
+
+    try:
+        await asyncio.gather(*(session(index) for index in range(args.sessions)))
+    finally:
+        await message_writer.close()
+
+
+def _frame_text(output: Dict) -> Optional[str]:
+    """The answer text carried by a Gradio process_generating frame, if any (status frames excluded)."""
+    for item in output.get("data", [[]])[0]:
+        if isinstance(item, dict):
+            # Full chatbot value: look at the last (assistant) message
+            continue
+        operation, _, value = item
+        if operation == "append" or (operation in ("replace", "add") and isinstance(value, str)
+                                     and not value.startswith(STATUS_PREFIXES)):
+            return value
+    data = output.get("data", [[]])[0]
+    if data and isinstance(data[-1], dict) and data[-1].get("role") == "assistant":
+        content = data[-1].get("content") or ""
+        if content and not content.startswith(STATUS_PREFIXES):
+            return content
+    return None
+
+
+async def run_http_target(args, results: List[TurnResult]) -> None:
+    import httpx
+
+    url = args.url.rstrip("/")
+    limits = httpx.Limits(max_connections=args.sessions * 2 + 10)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        bots = (await client.get(f"{url}/api/bots")).json()
+        if args.bot not in bots:
+            raise SystemExit(f"Unknown bot {args.bot}; available: {', '.join(bots)}")
+        chat_url = url + bots[args.bot]["chat_path"]
+        if not chat_url.endswith("/"):
+            chat_url += "/"
+
+        config = (await client.get(f"{chat_url}config")).json()
+        fn_index = next(
+            (dependency["id"] for dependency in config["dependencies"] if dependency.get("api_name") == args.api_name),
+            None,
+        )
+        if fn_index is None:
+            raise SystemExit(f"No event with api_name {args.api_name} in {chat_url}config")
+        examples = [
+            component["props"]["value"]
+            for component in config["components"]
+            if component.get("type") == "button" and component["props"].get("size") == "sm"
+        ]
+        prompts = prompts_for(args, examples)
+
+        async def turn(index: int, number: int, history: List[Dict], conversation_id: str) -> List[Dict]:
+            message = prompts[(index + number) % len(prompts)].format(session=index, turn=number)
+            sent = history + [{"role": "user", "content": message}]
+            session_hash = uuid.uuid4().hex[:11]
+            timer = TurnTimer(index, number)
+            text = ""
+            try:
+                joined = await client.post(f"{chat_url}gradio_api/queue/join", json={
+                    "data": [sent, conversation_id, None],
+                    "fn_index": fn_index,
+                    "session_hash": session_hash,
+                    "event_data": None,
+                    "trigger_id": None,
+                })
+                joined.raise_for_status()
+                async with client.stream("GET", f"{chat_url}gradio_api/queue/data", params={"session_hash": session_hash}) as response:
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        message_data = json.loads(line[5:])
+                        kind = message_data.get("msg")
+                        if kind == "process_generating" and _frame_text(message_data["output"]) is not None:
+                            timer.content()
+                        elif kind == "process_completed":
+                            output = message_data.get("output") or {}
+                            if not message_data.get("success", False):
+                                raise RuntimeError(output.get("error") or "process failed")
+                            messages = output["data"][0]
+                            text = messages[-1]["content"] if messages else ""
+                            break
+                results.append(timer.result(text))
+            except Exception as e:
+                results.append(timer.result(text, error=f"{type(e).__name__}: {e}"))
+            return sent + [{"role": "assistant", "content": text}]
+
+        async def session(index: int) -> None:
+            await asyncio.sleep(args.ramp * index / max(1, args.sessions))
+            history: List[Dict] = []
+            conversation_id = str(uuid.uuid4())
+            for number in range(args.turns):
+                history = await turn(index, number, history, conversation_id)
+                await asyncio.sleep(args.think_time)
+
+        await asyncio.gather(*(session(index) for index in range(args.sessions)))
+
+
+def summarize(args, results: List[TurnResult], wall: float, resources: Dict, fake_stats: Optional[Dict]) -> Dict:
+    ok = [result for result in results if result.ok]
+    errors: Dict[str, int] = {}
+    for result in results:
+        if not result.ok:
+            errors[result.error] = errors.get(result.error, 0) + 1
+    chars = sum(result.chars for result in ok)
+    return {
+        "run": {
+            "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "args": vars(args),
+        },
+        "turns": len(results),
+        "ok": len(ok),
+        "failed": len(results) - len(ok),
+        "errors": errors,
+        "ttft_ms": distribution_ms([result.ttft for result in ok if result.ttft is not None]),
+        "inter_chunk_ms": distribution_ms([gap for result in ok for gap in result.gaps]),
+        "turn_ms": distribution_ms([result.total for result in ok]),
+        "throughput": {
+            "wall_seconds": round(wall, 3),
+            "turns_per_sec": round(len(ok) / wall, 3) if wall else 0.0,
+            "chars_per_sec": round(chars / wall, 1) if wall else 0.0,
+            # ~4 characters per token, as in app/backend/tokens.py
+            "tokens_per_sec": round(chars / 4 / wall, 1) if wall else 0.0,
+        },
+        "resources": resources,
+        "fake_bedrock": fake_stats,
+    }
+
+
+# Metric path -> True when higher is better
+COMPARED_METRICS = {
+    ("ttft_ms", "p50"): False,
+    ("ttft_ms", "p95"): False,
+    ("ttft_ms", "p99"): False,
+    ("inter_chunk_ms", "p50"): False,
+    ("inter_chunk_ms", "p95"): False,
+    ("turn_ms", "p95"): False,
+    ("throughput", "turns_per_sec"): True,
+    ("throughput", "tokens_per_sec"): True,
+    ("resources", "cpu_percent", "mean"): False,
+    ("resources", "rss_mb", "max"): False,
+    ("resources", "threads", "max"): False,
+}
+
+
+def _lookup(summary: Dict, path) -> Optional[float]:
+    value = summary
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(summary: Dict, baseline_path: str, tolerance: float) -> List[str]:
+    """Print current vs baseline per metric and return the metrics that regressed beyond tolerance."""
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    regressions = []
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for path, higher_is_better in COMPARED_METRICS.items():
+        before, after = _lookup(baseline, path), _lookup(summary, path)
+        name = ".".join(path)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = "REGRESSION" if worse > tolerance else ""
+        if flag:
+            regressions.append(name)
+        print(f"  {name:32} {before:>12} -> {after:<12} {change:+.1%} {flag}")
+    return regressions
+
+
+def start_fake_bedrock(args) -> subprocess.Popen:
+    command = [sys.executable, "-m", "bench.fake_bedrock", "--port", str(args.fake_port)] + shlex.split(args.fake_args)
+    process = subprocess.Popen(command)
+    os.environ["ANTHROPIC_BEDROCK_BASE_URL"] = f"http://127.0.0.1:{args.fake_port}"
+    # Requests are signed even though the fake does not check the signature
+    os.environ.setdefault("AWS_BEDROCK_ACCESS_KEY", "bench")
+    os.environ.setdefault("AWS_BEDROCK_SECRET_KEY", "bench")
+    os.environ.setdefault("AWS_BEDROCK_REGION", "us-east-1")
+    # Nothing else may reach AWS either: embed locally and search the local index
+    os.environ.setdefault("EMBEDDING_BACKEND", "hashing")
+    os.environ.setdefault("RETRIEVAL_BACKEND", "local")
+
+    import httpx
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(os.environ["ANTHROPIC_BEDROCK_BASE_URL"], timeout=1.0)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("Fake Bedrock did not start")
+
+
+def fake_bedrock_stats() -> Optional[Dict]:
+    base_url = os.getenv("ANTHROPIC_BEDROCK_BASE_URL")
+    if not base_url:
+        return None
+    import httpx
+    try:
+        return httpx.get(f"{base_url}/stats", timeout=2.0).json()
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+def print_summary(summary: Dict) -> None:
+    print(f"\n{summary['ok']}/{summary['turns']} turns ok in {summary['throughput']['wall_seconds']}s")
+    for name in ("ttft_ms", "inter_chunk_ms", "turn_ms"):
+        stats = summary[name]
+        if stats.get("count"):
+            print(f"  {name:16} p50 {stats['p50']:>9} p95 {stats['p95']:>9} p99 {stats['p99']:>9} max {stats['max']:>9}")
+    throughput = summary["throughput"]
+    print(f"  throughput       {throughput['turns_per_sec']} turns/s, ~{throughput['tokens_per_sec']} tokens/s")
+    resources = summary["resources"]
+    if resources.get("samples"):
+        print(f"  cpu              mean {resources['cpu_percent']['mean']}% max {resources['cpu_percent']['max']}%")
+        print(f"  rss              max {resources['rss_mb']['max']} MB (start {resources['rss_mb']['start']} MB)")
+        print(f"  threads          max {resources['threads']['max']}")
+    for error, count in summary["errors"].items():
+        print(f"  {count} x {error}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["chat", "http"], default="chat")
+    parser.add_argument("--bot", default="aoe2-tactician")
+    parser.add_argument("--sessions", type=int, default=20, help="concurrent chat sessions")
+    parser.add_argument("--turns", type=int, default=3, help="turns per session")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which sessions start")
+    parser.add_argument("--think-time", type=float, default=0.0, help="pause between a session's turns")
+    parser.add_argument("--stream-mode", choices=["delta", "cumulative"], help="chat target: override the bot's streaming mode")
+    parser.add_argument("--cache", action="store_true", help="chat target: keep the response cache enabled")
+    parser.add_argument("--repeat-prompts", action="store_true", help="send the example prompts verbatim")
+    parser.add_argument("--database", choices=["default", "sqlite"], default="default",
+                        help="sqlite: use a throwaway SQLite database instead of Postgres")
+    parser.add_argument("--fake", action="store_true", help="start bench.fake_bedrock and point the client at it")
+    parser.add_argument("--fake-port", type=int, default=8900)
+    parser.add_argument("--fake-args", default="", help='extra fake_bedrock options, e.g. "--ttft 0.8 --throttle-rate 0.05"')
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="http target: server base URL")
+    parser.add_argument("--api-name", default="bot", help="http target: Gradio event that streams the answer")
+    parser.add_argument("--server-pid", type=int, help="http target: sample this process's resources")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--out", help="result file (default bench/results/<target>-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    if args.database == "sqlite":
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"bench-{os.getpid()}.db")
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{path}"
+
+    fake = start_fake_bedrock(args) if args.fake else None
+    try:
+        results: List[TurnResult] = []
+
+        async def run() -> Dict:
+            pid = args.server_pid if args.target == "http" else None
+            sampler = ResourceSampler(pid)
+            sampler.start()
+            started = time.perf_counter()
+            if args.target == "chat":
+                await run_chat_target(args, results)
+            else:
+                await run_http_target(args, results)
+            wall = time.perf_counter() - started
+            return summarize(args, results, wall, await sampler.stop(), fake_bedrock_stats())
+
+        summary = asyncio.run(run())
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.wait()
+        if args.database == "sqlite" and os.path.exists(path):
+            os.remove(path)
+
+    print_summary(summary)
+    out = args.out or os.path.join(RESULTS_DIR, f"{args.target}-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w") as file:
+        json.dump({**summary, "samples": [asdict(result) for result in results]}, file, indent=2)
+    print(f"\nSaved {out}")
+
+    if args.compare and compare(summary, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""
+Recall and latency of semantic message search against the HNSW index.
+
+Fills chat_messages with synthetic user questions spread over the past year
+and several bots, embedded with the hashing embedder, builds the HNSW index
+and then runs perturbed questions through search_messages at several
+hnsw.ef_search values. The exact top-k of every query (with its bot and date
+filters) is computed in NumPy while the rows are generated, so recall@k is
+measured against the true nearest neighbours. For comparison it also times
+the same searches as an exact scan and a plain ILIKE match.
+
+    python -m bench.message_search --database-url postgresql+asyncpg://user@127.0.0.1/ragnode_bench --rows 1000000
+
+Needs Postgres with pgvector. Use a scratch database: the chat messages in it
+are replaced (--reset). Exits 1 if recall at the default ef_search is below
+--min-recall.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import asyncio
+import datetime
+from typing import Dict, Tuple
+import numpy as np
+from .load import distribution_ms
+
+BOTS = ["baden-guide", "aoe2-tactician", "wine-advisor", "tax-helper"]
+PLACES = [
+    "Baden", "Zurich", "Bern", "Lucerne", "Basel", "Geneva", "Lugano", "Aarau", "Brugg", "Wettingen",
+    "the old town", "the river", "the lake", "the castle", "the station", "the thermal baths", "the vineyard",
+    "the market", "the museum", "the cathedral",
+]
+TOPICS = [
+    "hiking trails", "restaurants", "opening hours", "parking", "tickets", "guided tours", "bike rental",
+    "hotels", "festivals", "wine tasting", "swimming", "playgrounds", "bakeries", "train connections",
+    "late night bars", "accessibility", "dog friendly places", "rainy day activities", "viewpoints", "souvenirs",
+    "castle archers", "fast castle builds", "knight rushes", "trade routes", "tax deductions", "invoices",
+]
+QUALIFIERS = [
+    "for families", "this weekend", "in winter", "on a budget", "with kids", "near the centre", "after 6pm",
+    "for a group of ten", "without a car", "in the morning", "for beginners", "on Sundays", "in English",
+]
+TEMPLATES = [
+    "Where can I find {topic} in {place} {qualifier}?",
+    "What are the best {topic} near {place} {qualifier}",
+    "any tips for {topic} around {place} {qualifier}",
+    "Is it worth looking for {topic} in {place} {qualifier}?",
+    "recommend {topic} close to {place} {qualifier} please",
+    "How expensive are {topic} in {place} {qualifier}?",
+    "{topic} {place} {qualifier}",
+]
+
+
+def question(rng: random.Random) -> str:
+    return rng.choice(TEMPLATES).format(
+        topic=rng.choice(TOPICS), place=rng.choice(PLACES), qualifier=rng.choice(QUALIFIERS),
+    )
+
+
+def perturbed(rng: random.Random, text: str) -> str:
+    # A rephrasing of a stored question: drop a word or two and add another
+    words = text.rstrip("?").split()
+    for _ in range(rng.randint(1, 2)):
+        if len(words) > 3:
+            words.pop(rng.randrange(len(words)))
+    words.insert(rng.randrange(len(words) + 1), rng.choice(["really", "good", "nice", "cheap", "quiet"]))
+    return " ".join(words)
+
+
+class Queries:
+    """Search queries with their filters and the running exact top-k of each."""
+
+    def __init__(self, args, now: datetime.datetime, embedder):
+        rng = random.Random(args.seed + 1)
+        self.k = args.k
+        self.texts, self.bots, self.ranges = [], [], []
+        for index in range(args.queries):
+            self.texts.append(perturbed(rng, question(rng)))
+            filtered = index % 2 == 1      # every other query filters by bot and a date range
+            self.bots.append(rng.choice(BOTS) if filtered else None)
+            if filtered:
+                months_back = rng.randint(1, 10)
+                start = now - datetime.timedelta(days=30 * months_back)
+                self.ranges.append((start, start + datetime.timedelta(days=30 * rng.randint(1, 3))))
+            else:
+                self.ranges.append((None, None))
+        self.vectors = embedder.embed_array(self.texts)
+        self.best_ids = np.full((len(self.texts), self.k), -1, dtype=np.int64)
+        self.best_distances = np.full((len(self.texts), self.k), np.inf, dtype=np.float32)
+
+    def update(self, ids: np.ndarray, bots: np.ndarray, stamps: np.ndarray, vectors: np.ndarray) -> None:
+        # Embeddings are L2-normalized, so cosine distance is 1 - dot product
+        distances = 1.0 - self.vectors @ vectors.T
+        for index in range(len(self.texts)):
+            row = distances[index].copy()
+            if self.bots[index] is not None:
+                row[bots != self.bots[index]] = np.inf
+            start, end = self.ranges[index]
+            if start is not None:
+                row[(stamps < np.datetime64(start)) | (stamps >= np.datetime64(end))] = np.inf
+            merged_ids = np.concatenate([self.best_ids[index], ids])
+            merged = np.concatenate([self.best_distances[index], row])
+            order = np.argsort(merged, kind="stable")[:self.k]
+            self.best_ids[index] = merged_ids[order]
+            self.best_distances[index] = merged[order]
+
+    def truth(self, index: int) -> set:
+        return {int(i) for i, d in zip(self.best_ids[index], self.best_distances[index]) if np.isfinite(d)}
+
+
+async def load_rows(args, now: datetime.datetime) -> Tuple[Queries, Dict]:
+    import asyncpg
+    from pgvector.asyncpg import register_vector
+    from sqlalchemy import text
+    from app.backend.database import engine
+    from app.backend.knowledge.embeddings import HashingEmbedder
+    from app.backend.retention import MESSAGE_EMBEDDING_DDL, add_months, ensure_partitions, month_start
+
+    embedder = HashingEmbedder(args.dim)
+    queries = Queries(args, now, embedder)
+    timings = {}
+
+    async with engine.begin() as conn:
+        existing = (await conn.execute(text("SELECT count(*) FROM chat_messages"))).scalar()
+        if existing and not args.reset:
+            raise SystemExit(f"chat_messages has {existing} rows; pass --reset to replace them")
+        await conn.execute(text("TRUNCATE chat_messages"))
+        # Loading without the index and building it once is much faster than indexing row by row
+        await conn.execute(text("DROP INDEX IF EXISTS ix_chat_messages_embedding_hnsw"))
+        first = add_months(month_start(now), -(args.months - 1))
+        await ensure_partitions(conn, now=first, ahead=args.months - 1)
+
+    dsn = args.database_url.replace("postgresql+asyncpg://", "postgresql://")
+    raw = await asyncpg.connect(dsn)
+    await register_vector(raw)
+    rng = random.Random(args.seed)
+    span = (now - first).total_seconds()
+    started = time.perf_counter()
+    embed_seconds = 0.0
+    try:
+        for offset in range(0, args.rows, args.chunk):
+            count = min(args.chunk, args.rows - offset)
+            ids = np.arange(offset + 1, offset + count + 1, dtype=np.int64)
+            texts = [question(rng) for _ in range(count)]
+            bots = np.array([rng.choice(BOTS) for _ in range(count)])
+            stamps = [now - datetime.timedelta(seconds=rng.random() * span) for _ in range(count)]
+            embed_started = time.perf_counter()
+            vectors = embedder.embed_array(texts)
+            embed_seconds += time.perf_counter() - embed_started
+            queries.update(ids, bots, np.array(stamps, dtype="datetime64[us]"), vectors)
+            await raw.copy_records_to_table(
+                "chat_messages",
+                columns=["id", "bot_id", "seq", "role", "content", "timestamp", "embedding"],
+                records=[
+                    (int(ids[row]), str(bots[row]), 0, "user", texts[row], stamps[row], vectors[row])
+                    for row in range(count)
+                ],
+            )
+            print(f"  loaded {offset + count}/{args.rows} rows", end="\r", flush=True)
+        await raw.execute(f"SELECT setval('chat_messages_id_seq', {args.rows})")
+        print()
+        timings["load_s"] = round(time.perf_counter() - started, 1)
+        timings["embed_s"] = round(embed_seconds, 1)
+
+        started = time.perf_counter()
+        await raw.execute(f"SET maintenance_work_mem = '{args.maintenance_work_mem}'")
+        await raw.execute(next(statement for statement in MESSAGE_EMBEDDING_DDL if "USING hnsw" in statement))
+        timings["index_build_s"] = round(time.perf_counter() - started, 1)
+        await raw.execute("ANALYZE chat_messages")
+    finally:
+        await raw.close()
+    return queries, timings
+
+
+async def measure(args, queries: Queries) -> Dict:
+    from sqlalchemy import select, text
+    from app.backend.database import async_session
+    from app.backend.models import ChatMessage
+    from app.backend.message_search import _filters, _rank_pgvector, search_messages
+
+    results = {}
+    for ef_search in args.ef_search:
+        hits, latencies = 0, []
+        for index, query in enumerate(queries.texts):
+            start, end = queries.ranges[index]
+            started = time.perf_counter()
+            page = await search_messages(
+                query, bot_id=queries.bots[index], start=start, end=end,
+                limit=args.k, answers=False, ef_search=ef_search,
+            )
+            latencies.append(time.perf_counter() - started)
+            truth = queries.truth(index)
+            hits += len(truth & {result["id"] for result in page.results}) / max(len(truth), 1)
+        results[f"hnsw ef_search={ef_search}"] = {
+            "recall": round(hits / len(queries.texts), 4),
+            "latency_ms": distribution_ms(latencies),
+        }
+
+    # The same ranking without the index: an exact scan of every matching row
+    latencies, sample = [], range(min(args.baseline_queries, len(queries.texts)))
+    for index in sample:
+        start, end = queries.ranges[index]
+        started = time.perf_counter()
+        async with async_session() as session:
+            await session.execute(text("SET LOCAL enable_indexscan = off"))
+            await _rank_pgvector(
+                session, queries.vectors[index].tolist(), _filters(queries.bots[index], start, end), args.k, 0, 40,
+            )
+        latencies.append(time.perf_counter() - started)
+    results["exact scan"] = {"recall": 1.0, "latency_ms": distribution_ms(latencies)}
+
+    # What searching history looked like before: a substring match on one word
+    latencies = []
+    for index in sample:
+        word = max(queries.texts[index].split(), key=len)
+        started = time.perf_counter()
+        async with async_session() as session:
+            await session.execute(
+                select(ChatMessage.id).where(ChatMessage.role == "user", ChatMessage.content.ilike(f"%{word}%")).limit(args.k)
+            )
+        latencies.append(time.perf_counter() - started)
+    results["ilike"] = {"recall": None, "latency_ms": distribution_ms(latencies)}
+    return results
+
+
+async def run(args) -> Dict:
+    from app.backend.database import engine, init_db
+
+    await init_db()
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    try:
+        queries, timings = await load_rows(args, now)
+        results = await measure(args, queries)
+    finally:
+        await engine.dispose()
+    return {"timings": timings, "results": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True, help="postgresql+asyncpg:// URL of a scratch database")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--dim", type=int, default=1024, help="embedding dimension (EMBEDDING_DIM)")
+    parser.add_argument("--months", type=int, default=12, help="months the messages are spread over")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10, help="results per search; recall is recall@k")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 20, 40, 80, 160, 320])
+    parser.add_argument("--baseline-queries", type=int, default=20, help="queries timed for the exact and ILIKE baselines")
+    parser.add_argument("--chunk", type=int, default=20000, help="rows generated and copied at a time")
+    parser.add_argument("--maintenance-work-mem", default="1GB", help="for the index build")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="required recall at MESSAGE_SEARCH_EF")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--reset", action="store_true", help="replace the chat messages already in the database")
+    args = parser.parse_args()
+
+    # Read at import time by the app modules
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["EMBEDDING_DIM"] = str(args.dim)
+    os.environ["EMBEDDING_BACKEND"] = "hashing"
+    os.environ["MESSAGE_EMBED_INTERVAL"] = "0"
+    os.environ.setdefault("METRICS_TRACING", "false")
+
+    summary = asyncio.run(run(args))
+    from app.backend.message_search import MESSAGE_SEARCH_EF
+
+    timings = summary["timings"]
+    print(f"{args.rows} rows, dim {args.dim}: load {timings['load_s']}s (embedding {timings['embed_s']}s), "
+          f"HNSW build {timings['index_build_s']}s")
+    print(f"{'':24} {'recall@' + str(args.k):>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for label, result in summary["results"].items():
+        latency = result["latency_ms"]
+        recall = "-" if result["recall"] is None else f"{result['recall']:.3f}"
+        print(f"{label:24} {recall:>10} {latency.get('p50'):>9} {latency.get('p95'):>9} {latency.get('p99'):>9}")
+
+    default = summary["results"].get(f"hnsw ef_search={MESSAGE_SEARCH_EF}")
+    if default is None:
+        print(f"SKIP  recall  ef_search={MESSAGE_SEARCH_EF} (MESSAGE_SEARCH_EF) was not measured")
+        sys.exit(0)
+    ok = default["recall"] >= args.min_recall
+    print(f"{'PASS' if ok else 'FAIL'}  recall  {default['recall']:.3f} at ef_search={MESSAGE_SEARCH_EF} (required {args.min_recall})")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
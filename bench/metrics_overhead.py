@@ -0,0 +1,69 @@
+"""
+Cost of the hot-path instrumentation per call, enabled vs disabled.
+
+Each mode runs in a fresh interpreter because METRICS_ENABLED is read at import.
+
+    python -m bench.metrics_overhead
+"""
+import os
+import sys
+import json
+import subprocess
+
+CALLS = 1_000_000
+
+MEASURE = """
+import json, time
+from app.backend import metrics
+
+def run(operation, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        operation()
+    return (time.perf_counter() - started) / calls * 1e9
+
+trace = metrics.start_trace("bench")
+results = {
+    "baseline (empty call)": run(lambda: None, CALLS),
+    "histogram.observe": run(lambda: metrics.INTER_TOKEN_GAP.observe(0.004, "bench"), CALLS),
+    "counter.inc": run(lambda: metrics.OUTPUT_TOKENS.inc("bench", amount=3), CALLS),
+}
+
+def timed():
+    with metrics.SAVE_MESSAGE_TIME.time("bench"):
+        pass
+
+def span():
+    with trace.span("bench"):
+        pass
+
+results["histogram.time block"] = run(timed, CALLS // 10)
+results["trace.span block"] = run(span, CALLS // 10)
+print(json.dumps(results))
+"""
+
+
+def measure(enabled: bool) -> dict:
+    env = {
+        **os.environ,
+        "METRICS_ENABLED": "true" if enabled else "false",
+        "METRICS_TRACING": "true" if enabled else "false",
+        "PYTHONPATH": os.getcwd(),
+    }
+    output = subprocess.run(
+        [sys.executable, "-c", f"CALLS = {CALLS}\n{MEASURE}"],
+        env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    disabled = measure(False)
+    enabled = measure(True)
+    print(f"{'operation':24} {'disabled ns':>12} {'enabled ns':>12}")
+    for name in disabled:
+        print(f"{name:24} {disabled[name]:>12.1f} {enabled[name]:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
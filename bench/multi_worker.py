@@ -0,0 +1,209 @@
+"""
+Start several workers on one database and check that they behave as one app.
+
+Each worker is a separate uvicorn process on its own port, as separate nodes
+behind a load balancer would be, all pointed at bench.fake_bedrock. Requests are
+sent to specific workers through the headless chat API:
+
+    admission    a bot's max_concurrent holds across all workers together
+    continuity   consecutive turns of a conversation on different workers keep one history
+    exclusivity  another worker refuses a second turn while one is running (409)
+    cancel       a turn running on one worker is cancelled through another
+    cache        an answer cached by one worker is served by another without a model call
+
+    python -m bench.multi_worker --database-url postgresql+asyncpg://user@127.0.0.1/ragnode --workers 3
+
+With --shared-state memory the workers share nothing, which shows what fails
+without the Postgres backend. Exits 1 if a check fails.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import asyncio
+import subprocess
+from typing import Dict, List, Tuple
+import httpx
+from .load import start_fake_bedrock
+
+BOT = "baden-guide"
+MAX_CONCURRENT = 8   # admission.max_concurrent in the bot's config
+
+
+def start_workers(args) -> List[subprocess.Popen]:
+    env = {
+        **os.environ,
+        "DATABASE_URL": args.database_url,
+        "SHARED_STATE_BACKEND": args.shared_state,
+        "BOT_LOADING": "lazy",
+        "METRICS_TRACING": "false",
+    }
+    workers = []
+    for index in range(args.workers):
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port + index), "--log-level", "warning"]
+        workers.append(subprocess.Popen(command, env=env))
+
+    deadline = time.monotonic() + 60
+    for index in range(args.workers):
+        while True:
+            try:
+                httpx.get(f"{worker_url(args, index)}/api/health", timeout=1.0)
+                break
+            except httpx.HTTPError:
+                if time.monotonic() > deadline:
+                    raise SystemExit(f"Worker {index} did not start")
+                time.sleep(0.3)
+    return workers
+
+
+def worker_url(args, index: int) -> str:
+    return f"http://127.0.0.1:{args.port + index % args.workers}"
+
+
+async def stream_turn(client: httpx.AsyncClient, url: str, message: str, conversation_id: str = None,
+                      on_start=None) -> Tuple[int, Dict]:
+    """Run one SSE turn; returns the status code and the start + done payloads merged (or the error body)."""
+    body = {"message": message, "conversation_id": conversation_id}
+    async with client.stream("POST", f"{url}/api/bots/{BOT}/chat", json=body) as response:
+        if response.status_code != 200:
+            return response.status_code, json.loads(await response.aread())
+        result = {}
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            payload = json.loads(line[5:])
+            if payload["type"] in ("start", "done"):
+                result.update(payload)
+            if payload["type"] == "start" and on_start is not None:
+                await on_start(payload)
+        return 200, result
+
+
+async def fake_stats(client: httpx.AsyncClient) -> Dict:
+    return (await client.get(f"{os.environ['ANTHROPIC_BEDROCK_BASE_URL']}/stats")).json()
+
+
+async def check_admission(args, client: httpx.AsyncClient) -> Tuple[bool, str]:
+    turns = MAX_CONCURRENT * args.workers
+    results = await asyncio.gather(*(
+        stream_turn(client, worker_url(args, index), f"admission {uuid.uuid4().hex}")
+        for index in range(turns)
+    ))
+    peak = (await fake_stats(client))["peak_in_flight"]
+    completed = sum(1 for status, done in results if status == 200 and done.get("status") == "complete")
+    # The workers' shares add up to the limit, but the fake counts a stream until its last bytes
+    # are sent, a moment after the worker has released the slot to the next turn
+    allowed = MAX_CONCURRENT + args.workers
+    return peak <= allowed, f"{turns} turns over {args.workers} workers, peak {peak} model calls (limit {MAX_CONCURRENT}, allowed {allowed}), {completed} completed"
+
+
+async def check_continuity(args, client: httpx.AsyncClient) -> Tuple[bool, str]:
+    from app.backend.repository import conversations
+
+    conversation_id = None
+    turns = 3
+    for turn in range(turns):
+        status, done = await stream_turn(client, worker_url(args, turn), f"continuity turn {turn} {uuid.uuid4().hex}", conversation_id)
+        if status != 200:
+            return False, f"turn {turn} returned {status}"
+        conversation_id = done["conversation_id"]
+
+    # Let the write-behind queues flush
+    await asyncio.sleep(1.5)
+    messages = await conversations.load_history(conversation_id)
+    seqs = [message["seq"] for message in messages]
+    ok = seqs == list(range(turns * 2))
+    return ok, f"{turns} turns on {min(turns, args.workers)} workers stored seqs {seqs}"
+
+
+async def check_exclusivity_and_cancel(args, client: httpx.AsyncClient) -> List[Tuple[str, bool, str]]:
+    started = asyncio.Event()
+    start_payload: Dict = {}
+
+    async def on_start(payload: Dict) -> None:
+        start_payload.update(payload)
+        started.set()
+
+    running = asyncio.ensure_future(stream_turn(client, worker_url(args, 0), f"long turn {uuid.uuid4().hex}", on_start=on_start))
+    await asyncio.wait_for(started.wait(), 30)
+    await asyncio.sleep(0.3)
+
+    other = worker_url(args, 1)
+    status, _ = await stream_turn(client, other, "second turn", start_payload["conversation_id"])
+    exclusivity = (status == 409, f"second turn on another worker returned {status}")
+
+    requested = time.perf_counter()
+    response = await client.post(f"{other}/api/bots/{BOT}/chat/{start_payload['request_id']}/cancel",
+                                 params={"conversation_id": start_payload["conversation_id"]})
+    _, done = await running
+    elapsed = time.perf_counter() - requested
+    cancel = (
+        response.status_code == 200 and done.get("status") == "cancelled",
+        f"cancel via another worker returned {response.status_code}, turn ended {done.get('status')} after {elapsed:.2f}s",
+    )
+    return [("exclusivity", *exclusivity), ("cancel", *cancel)]
+
+
+async def check_cache(args, client: httpx.AsyncClient) -> Tuple[bool, str]:
+    message = f"What is there to see in Baden? {uuid.uuid4().hex[:6]}"
+    _, first = await stream_turn(client, worker_url(args, 0), message)
+    before = (await fake_stats(client))["streams"]
+    _, second = await stream_turn(client, worker_url(args, 1), message)
+    after = (await fake_stats(client))["streams"]
+    ok = after == before and first.get("response") == second.get("response")
+    return ok, f"model calls for the repeat on another worker: {after - before}"
+
+
+async def run_checks(args) -> List[Tuple[str, bool, str]]:
+    async with httpx.AsyncClient(timeout=120) as client:
+        results = [("admission", *await check_admission(args, client))]
+        results.append(("continuity", *await check_continuity(args, client)))
+        results.extend(await check_exclusivity_and_cancel(args, client))
+        results.append(("cache", *await check_cache(args, client)))
+        return results
+
+
+async def prepare_database() -> None:
+    from app.backend.database import engine, init_db
+    await init_db()
+    # The checks run on another event loop
+    await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", required=True, help="database shared by the workers")
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8100, help="port of the first worker")
+    parser.add_argument("--shared-state", choices=["postgres", "memory"], default="postgres")
+    parser.add_argument("--fake-port", type=int, default=8900)
+    parser.add_argument("--fake-args", default="--ttft 0.3 --tokens 60 --tokens-per-sec 30")
+    args = parser.parse_args()
+    if args.workers < 2:
+        parser.error("--workers must be at least 2")
+
+    os.environ["DATABASE_URL"] = args.database_url
+    asyncio.run(prepare_database())
+
+    fake = start_fake_bedrock(args)
+    workers: List[subprocess.Popen] = []
+    try:
+        workers = start_workers(args)
+        results = asyncio.run(run_checks(args))
+    finally:
+        for process in workers + [fake]:
+            process.terminate()
+        for process in workers + [fake]:
+            process.wait()
+
+    failed = 0
+    for name, ok, detail in results:
+        failed += not ok
+        print(f"{'PASS' if ok else 'FAIL'}  {name:12} {detail}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Requests per second for the landing/bot pages and static assets, with and
+without the page cache and precompressed assets.
+
+Starts the app twice under uvicorn, with WEB_CACHE_ENABLED=false (templates
+rendered per request, plain StaticFiles) and with the cache, and drives each
+with concurrent clients that accept gzip and brotli:
+
+    page         GET / and a bot page
+    revalidate   the same with If-None-Match, as a browser reload sends it
+    asset        GET the stylesheet the page links to
+
+Server CPU time per request is reported next to requests per second, as the
+clients compete with the server for the CPU on a single machine. It then
+replays a browser's repeat visit: the page is revalidated and every linked
+asset is fetched again unless its Cache-Control says it is immutable.
+
+    python -m bench.pages --duration 10 --concurrency 20
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+import subprocess
+from typing import Dict, List
+import httpx
+from .load import RESULTS_DIR, ResourceSampler, distribution_ms, start_fake_bedrock
+
+ACCEPT = {"Accept-Encoding": "gzip, deflate, br"}
+ASSET_LINK = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+
+
+def start_server(args, cached: bool, path: str) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "WEB_CACHE_ENABLED": "true" if cached else "false",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{path}",
+        "BOT_LOADING": "lazy",
+        "MESSAGE_EMBED_INTERVAL": "0",
+        "METRICS_TRACING": "false",
+    }
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"]
+    server = subprocess.Popen(command, env=env)
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            httpx.get(f"{base_url(args)}/api/health", timeout=1.0)
+            return server
+        except httpx.HTTPError:
+            if time.monotonic() > deadline:
+                server.terminate()
+                raise SystemExit("Server did not start")
+            time.sleep(0.3)
+
+
+def base_url(args) -> str:
+    return f"http://127.0.0.1:{args.port}"
+
+
+async def drive(args, client: httpx.AsyncClient, requests: List[Dict]) -> Dict:
+    """Send `requests` round-robin from `concurrency` clients for `duration` seconds."""
+    # The client shares the machine with the server, so server CPU per request is the fairer number
+    server = ResourceSampler(args.server_pid)
+    cpu_before = server._read()["cpu_seconds"]
+    latencies: List[float] = []
+    sizes: List[int] = []
+    statuses: Dict[int, int] = {}
+    deadline = time.perf_counter() + args.duration
+
+    async def worker(offset: int) -> None:
+        index = offset
+        while time.perf_counter() < deadline:
+            request = requests[index % len(requests)]
+            index += 1
+            started = time.perf_counter()
+            response = await client.get(request["url"], headers=request["headers"])
+            latencies.append(time.perf_counter() - started)
+            # Bytes on the wire: the body as sent, before the client decodes it
+            sizes.append(int(response.headers.get("content-length", len(response.content))))
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(offset) for offset in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    cpu = server._read()["cpu_seconds"] - cpu_before
+    return {
+        "rps": round(len(latencies) / elapsed, 1),
+        "server_cpu_ms": round(cpu * 1000 / max(len(latencies), 1), 3),
+        "latency_ms": distribution_ms(latencies),
+        "bytes": round(sum(sizes) / max(len(sizes), 1)),
+        "statuses": statuses,
+    }
+
+
+async def repeat_visit(client: httpx.AsyncClient, page: str) -> Dict:
+    """Requests and bytes of a reload of `page` by a browser that kept the first visit in its cache."""
+    first = await client.get(page, headers=ACCEPT)
+    links = sorted(set(ASSET_LINK.findall(first.text)))
+    cached = {}
+    for link in links:
+        response = await client.get(link, headers=ACCEPT)
+        if response.status_code == 200:
+            cached[link] = response.headers
+
+    requests = wire_bytes = 0
+    conditional = {**ACCEPT, "If-None-Match": first.headers["etag"]} if "etag" in first.headers else ACCEPT
+    response = await client.get(page, headers=conditional)
+    requests += 1
+    wire_bytes += int(response.headers.get("content-length", 0))
+    for link, headers in cached.items():
+        if "immutable" in headers.get("cache-control", ""):
+            continue
+        conditional = {**ACCEPT, "If-None-Match": headers["etag"]} if "etag" in headers else ACCEPT
+        response = await client.get(link, headers=conditional)
+        requests += 1
+        wire_bytes += int(response.headers.get("content-length", 0))
+    return {"requests": requests, "bytes": wire_bytes, "assets": len(links)}
+
+
+async def measure(args) -> Dict:
+    async with httpx.AsyncClient(base_url=base_url(args), limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        pages = ["/", f"/{args.bot}-chat"]
+        page = await client.get("/", headers=ACCEPT)
+        stylesheet = next(link for link in ASSET_LINK.findall(page.text) if link.endswith(".css"))
+        etags = {path: (await client.get(path, headers=ACCEPT)).headers.get("etag") for path in pages}
+
+        results = {}
+        results["page"] = await drive(args, client, [{"url": path, "headers": ACCEPT} for path in pages])
+        results["revalidate"] = await drive(args, client, [
+            {"url": path, "headers": {**ACCEPT, "If-None-Match": etags[path]} if etags[path] else ACCEPT}
+            for path in pages
+        ])
+        results["asset"] = await drive(args, client, [{"url": stylesheet, "headers": ACCEPT}])
+        results["repeat_visit"] = await repeat_visit(client, "/")
+        return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--bot", default="baden-guide")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--fake-port", type=int, default=8900)
+    args = parser.parse_args()
+    args.fake_args = ""
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"pages-{os.getpid()}.db")
+    fake = start_fake_bedrock(args)
+    summary = {}
+    try:
+        for label, cached in (("before", False), ("after", True)):
+            server = start_server(args, cached, path)
+            args.server_pid = server.pid
+            try:
+                summary[label] = asyncio.run(measure(args))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        fake.terminate()
+        fake.wait()
+        if os.path.exists(path):
+            os.remove(path)
+
+    print(f"{'':8} {'scenario':11} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'cpu ms/req':>11} {'bytes':>7}  statuses")
+    for label, results in summary.items():
+        for scenario in ("page", "revalidate", "asset"):
+            result = results[scenario]
+            latency = result["latency_ms"]
+            print(f"{label:8} {scenario:11} {result['rps']:>8} {latency.get('p50'):>8} {latency.get('p95'):>8} "
+                  f"{result['server_cpu_ms']:>11} {result['bytes']:>7}  {result['statuses']}")
+    for label, results in summary.items():
+        visit = results["repeat_visit"]
+        print(f"{label:8} repeat visit: {visit['requests']} requests, {visit['bytes']} bytes "
+              f"(page + {visit['assets']} linked assets)")
+
+
+if __name__ == "__main__":
+    main()
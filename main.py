@@ -1,18 +1,33 @@
-from fastapi import FastAPI, Request, BackgroundTasks
+from fastapi import Depends, FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
-import gradio as gr
 import os
 import asyncio
+import datetime
 import signal
 from dotenv import load_dotenv
 
 if not os.getenv("ANTHROPIC_API_KEY"):
     load_dotenv()
 
-from app.backend.chat.interface import ChatInterface, get_available_bots
+from app.backend.chat.interface import get_available_bots
+from app.backend.chat.lazy import BotLoader
+from app.backend.chat.api import create_chat_router
+from app.backend.persistence import message_writer
+from app.backend.chat.client_pool import client_pool
+from app.backend.chat.scheduler import scheduler
+from app.backend.chat.registry import bot_registry
+from app.backend.chat.routing import routing_log, summarize
+from app.backend.chat.generations import generations
+from app.backend.shared_state import shared_state
+from app.backend.retention import message_retention
+from app.backend.message_search import message_embedder, search_messages
+from app.backend.admin import require_admin
+from app.backend.page_cache import PageCache
+from app.backend.static_assets import WEB_CACHE_ENABLED, static_assets
+from app.backend.metrics import METRICS_TRACING, registry, traces
 
 app = FastAPI()
 
@@ -32,57 +47,213 @@ app.add_middleware(
 
 templates = Jinja2Templates(directory="app/static")
 
-# Create a global variable to hold all Gradio apps
-gradio_apps = []
+# Content-hashed, precompressed assets under /static (WEB_CACHE_ENABLED=false serves the plain files)
+if WEB_CACHE_ENABLED:
+    static_assets.load()
+    templates.env.globals["asset_url"] = static_assets.url
+else:
+    templates.env.globals["asset_url"] = lambda name: f"/static/{name}"
+
+@app.on_event("shutdown")
+async def flush_messages():
+    # Cancel running generations so their partial answers are saved, then write out
+    # chat messages still waiting in the write-behind queue
+    await generations.close()
+    await message_writer.close()
 
 # Get all available bots from config files
 bots = get_available_bots()
 
-# Create and mount interfaces for each bot
-for bot_id, bot_config in bots.items():
-    try:
-        # Create the interface
-        interface = ChatInterface(bot_id=bot_id).create_interface()
-        gradio_apps.append(interface)
-        
-        # Mount the interface
-        chat_path = bot_config.get("chat_path", f"/{bot_id}/")
-        app = gr.mount_gradio_app(app, interface, path=chat_path)
-        
-        print(f"Mounted {bot_id} interface at {chat_path}")
-        
-    except Exception as e:
-        print(f"Error mounting interface for {bot_id}: {str(e)}")
+# Create and mount interfaces for each bot (eagerly, or on first hit with BOT_LOADING=lazy/warmup)
+bot_loader = BotLoader(bots)
+app = bot_loader.mount_all(app)
+
+# Headless JSON/SSE/WebSocket chat for machine clients, next to the Gradio UIs
+app.include_router(create_chat_router(bot_loader))
+
+@app.on_event("startup")
+async def start_warmup():
+    bot_loader.start_warmup()
+
+@app.on_event("shutdown")
+async def close_bots():
+    await bot_loader.close()
+
+@app.on_event("startup")
+async def watch_bot_files():
+    # Recompile a bot's prompt when its config or knowledge file changes, without a restart
+    bot_registry.start()
+
+@app.on_event("shutdown")
+async def stop_registry():
+    await bot_registry.stop()
+
+def announce_reload(compiled):
+    # Other workers re-scan right away instead of at their next poll
+    asyncio.ensure_future(shared_state.publish("bot_registry", {"bot_id": compiled.bot_id, "hash": compiled.hash}))
+
+@app.on_event("startup")
+async def start_shared_state():
+    # Multi-worker mode (SHARED_STATE_BACKEND=postgres): listen for other workers' messages
+    # and count their admitted turns against each bot's limit
+    await shared_state.start()
+    scheduler.start_sync(shared_state)
+    if shared_state.distributed:
+        bot_registry.subscribe(announce_reload)
+        shared_state.subscribe("bot_registry", lambda message: bot_registry.refresh())
+
+@app.on_event("shutdown")
+async def stop_shared_state():
+    await scheduler.stop_sync(shared_state)
+    await shared_state.close()
+
+@app.on_event("startup")
+async def start_retention():
+    # Create upcoming chat_messages partitions and archive expired months (Postgres only)
+    message_retention.start()
+
+@app.on_event("shutdown")
+async def stop_retention():
+    await message_retention.stop()
+
+@app.on_event("startup")
+async def start_message_embedding():
+    # Embed new and not yet embedded user messages for /api/messages/search
+    message_embedder.start()
+
+@app.on_event("shutdown")
+async def stop_message_embedding():
+    await message_embedder.stop()
+
+prewarm_task = None
+
+@app.on_event("startup")
+async def prewarm_bedrock():
+    # Open Bedrock connections in the background so the first chat skips the TLS handshake
+    global prewarm_task
+    prewarm_task = asyncio.create_task(client_pool.prewarm())
+
+@app.on_event("shutdown")
+async def close_client_pool():
+    await client_pool.close()
 
 # Routes
+def page_context(page: str) -> dict:
+    # Current configs of the mounted bots, so hot-reloaded titles and descriptions show up
+    current = bot_registry.configs()
+    configs = {bot_id: current.get(bot_id, config) for bot_id, config in bots.items()}
+    if page == "home" or page not in configs:
+        return {"page": "home", "title": "Home" if page == "home" else "Home - Page Not Found", "bots": configs}
+
+    bot_config = configs[page]
+    return {
+        "page": page,
+        "title": bot_config["title"],
+        "description": bot_config["description"],
+        "chat_path": bot_config["chat_path"],
+        "bots": configs
+    }
+
+def render_page(page: str) -> str:
+    return templates.get_template("unified-template.html").render(page_context(page))
+
+# Rendered pages, dropped when the bot registry installs a new version
+page_cache = PageCache(render_page, lambda: bot_registry.version)
+
+def serve_page(request: Request, page: str):
+    if WEB_CACHE_ENABLED:
+        return page_cache.response(request, page)
+    return templates.TemplateResponse("unified-template.html", {"request": request, **page_context(page)})
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
-    return templates.TemplateResponse("unified-template.html", {
-        "request": request,
-        "page": "home",
-        "title": "Home",
-        "bots": bots
-    })
+    return serve_page(request, "home")
 
 @app.get("/{bot_id}-chat", response_class=HTMLResponse)
 async def chat_page(request: Request, bot_id: str):
-    if bot_id not in bots:
-        return templates.TemplateResponse("unified-template.html", {
-            "request": request,
-            "page": "home",
-            "title": "Home - Page Not Found",
-            "bots": bots
-        })
-    
-    bot_config = bots[bot_id]
-    return templates.TemplateResponse("unified-template.html", {
-        "request": request,
-        "page": bot_id,
-        "title": bot_config["title"],
-        "description": bot_config["description"],
-        "chat_path": bot_config["chat_path"],
-        "bots": bots
-    })
+    # Unknown ids share one cached "not found" page, so arbitrary URLs cannot grow the cache
+    return serve_page(request, bot_id if bot_id in bots else "not-found")
+
+@app.get("/api/health")
+async def health():
+    # Serving: the process is up and routes are mounted, bots may still be cold
+    return {"serving": True, **bot_loader.report()}
+
+@app.get("/api/ready")
+async def ready():
+    # Ready: every bot interface has been built
+    report = bot_loader.report()
+    return JSONResponse(report, status_code=200 if report["all_warm"] else 503)
+
+@app.get("/api/pool")
+async def pool_stats():
+    return client_pool.stats()
+
+@app.get("/api/admission")
+async def admission_stats():
+    return scheduler.stats()
+
+@app.get("/api/registry")
+async def registry_report():
+    # Active prompt version (content hash) and size per bot
+    return bot_registry.report()
+
+@app.get("/api/routing")
+async def routing_report(limit: int = 20):
+    # Turns, TTFT and estimated cost per model tier, with the most recent decisions
+    entries = list(routing_log)
+    return {**summarize(entries), "recent": entries[-limit:] if limit > 0 else []}
+
+# Past messages of every user: operators only (ADMIN_TOKEN)
+@app.get("/api/messages/search", dependencies=[Depends(require_admin)])
+async def message_search(
+    q: str,
+    bot_id: str = None,
+    start: datetime.datetime = None,
+    end: datetime.datetime = None,
+    limit: int = 20,
+    offset: int = 0,
+    answers: bool = True,
+):
+    # Past user messages similar to q, most similar first; page with offset=next_offset
+    if not q.strip() or not 1 <= limit <= 100 or offset < 0:
+        raise HTTPException(status_code=400, detail="q must not be empty, limit must be 1-100, offset >= 0")
+    try:
+        page = await search_messages(q, bot_id=bot_id, start=start, end=end, limit=limit, offset=offset, answers=answers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"results": page.results, "next_offset": page.next_offset}
+
+@app.get("/api/messages/embedding", dependencies=[Depends(require_admin)])
+async def message_embedding_status():
+    # Embedded and pending user messages
+    return await message_embedder.status()
+
+@app.get("/api/generations")
+async def generation_stats():
+    # Server-side generations kept for reattaching, running and finished
+    return generations.stats()
+
+# Queue and pool state, read when /metrics is scraped
+registry.gauge("ragnode_model_calls_in_flight", "Model calls holding a client pool slot",
+               lambda: {(): client_pool.in_flight})
+registry.gauge("ragnode_admission_active", "Turns admitted by the scheduler per bot",
+               lambda: {(bot_id,): bot["active"] for bot_id, bot in scheduler.stats()["bots"].items()}, labels=("bot",))
+registry.gauge("ragnode_admission_queued", "Turns waiting for admission per bot",
+               lambda: {(bot_id,): bot["queued"] for bot_id, bot in scheduler.stats()["bots"].items()}, labels=("bot",))
+registry.gauge("ragnode_generations_running", "Server-side generations still producing an answer",
+               lambda: {(): sum(not generation.done for generation in generations.generations.values())})
+registry.gauge("ragnode_message_queue_size", "Chat messages waiting in the write-behind queue",
+               lambda: {(): message_writer.queue.qsize() if message_writer.queue else 0})
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/traces", dependencies=[Depends(require_admin)])
+async def recent_traces(limit: int = 50):
+    # Spans of the most recent chat turns (METRICS_TRACING=true)
+    return {"enabled": METRICS_TRACING, "traces": list(traces)[-limit:]}
 
 @app.get("/api/bots")
 async def list_bots():
@@ -95,4 +266,12 @@ async def list_bots():
         for bot_id, cfg in bots.items()
     }
 
-app.mount("/static", StaticFiles(directory="app/static"), name="static")
\ No newline at end of file
+@app.get("/api/web-cache")
+async def web_cache_stats():
+    # Cached pages and the static assets with their compressed sizes
+    return {"enabled": WEB_CACHE_ENABLED, "pages": page_cache.stats(), "static": static_assets.stats()}
+
+if WEB_CACHE_ENABLED:
+    app.mount("/static", static_assets, name="static")
+else:
+    app.mount("/static", StaticFiles(directory="app/static"), name="static")
\ No newline at end of file